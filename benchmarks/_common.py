@@ -0,0 +1,69 @@
+"""
+Helpers shared by the benchmark scripts.
+The benchmarks are meant to be run from the repository root, for example:
+    python benchmarks/bench_dispatch.py
+"""
+import ast
+import logging
+import pathlib
+import sys
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+# The formatter's modules import each other as top level modules (see main.py).
+sys.path[:0] = [str(ROOT), str(ROOT / "lib")]
+
+import _rewrite  # noqa: E402
+
+# Long lines are reported with logging.warning(), keep the benchmark output clean.
+logging.disable(logging.WARNING)
+
+
+def corpus():
+    """
+    Reads and parses all the tests/*/input.py files.
+    :return: List of (path, parsed tree) tuples.
+    """
+    trees = []
+    for path in sorted(ROOT.joinpath("tests").glob("*/input.py")):
+        with open(path) as f:
+            trees.append((path, ast.parse(f.read(), str(path))))
+    return trees
+
+
+def count_nodes(trees):
+    """
+    Counts the nodes of all the given trees.
+    :param trees: List of (path, parsed tree) tuples.
+    :return: Total number of nodes.
+    """
+    return sum(1 for _, tree in trees for _ in ast.walk(tree))
+
+
+def format_tree(visitor, tree):
+    """
+    Formats a parsed tree in memory.
+    :param visitor: Rewrite object.
+    :param tree: Parsed tree.
+    :return: None
+    """
+    visitor.visit(tree)
+    visitor.emitter.getvalue()
+    visitor.cleanup()
+
+
+def best_of(function, repeat=5, number=20):
+    """
+    Times a function.
+    :param function: Function without arguments.
+    :param repeat: Number of measurements.
+    :param number: Calls per measurement.
+    :return: Best time of a single call in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
@@ -0,0 +1,40 @@
+"""
+Measures checking whether a generated module is formatted, by formatting all of it and
+comparing (format_source) and by comparing each statement as soon as it is formatted
+(check_source), when the first statement is not formatted, when the last one is not,
+and when the module is formatted.
+"""
+import _common
+import _rewrite
+
+
+def generate(count):
+    """Source of a formatted module of <count> small functions."""
+    return "".join(
+        f"def function_{i}(first, second=None):\n"
+        f"    return [first, second, {i}]\n\n\n"
+        for i in range(count)
+    ).rstrip("\n") + "\n"
+
+
+def main():
+    visitor = _rewrite.Rewrite()
+    formatted = visitor.format_source(generate(500))
+    sources = {
+        "first statement": "x  =  1\n\n\n" + formatted,
+        "last statement": formatted + "\n\nx  =  1\n",
+        "formatted": formatted,
+    }
+    for name, source in sources.items():
+        full = _common.best_of(
+            lambda: visitor.format_source(source) != source, number=1
+        )
+        check = _common.best_of(lambda: visitor.check_source(source), number=1)
+        print(
+            f"{name:<20}format_source {full * 1000:>8.1f} ms"
+            f"    check_source {check * 1000:>8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
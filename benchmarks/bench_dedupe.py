@@ -0,0 +1,76 @@
+"""
+Measures a check only run over 400 generated modules, when all of them are different
+and when they are copies of 20 modules (e.g. vendored or generated stubs), in which
+case each content is formatted once. The number of times the files are opened is
+counted in a run with a single job, so that all of them are opened in this process:
+each file is read once.
+"""
+import contextlib
+import io
+import os
+import tempfile
+
+import _common
+import _rewrite
+
+
+def module(i):
+    """Source of a small unformatted module, different for each <i>."""
+    return "".join(
+        f"def function_{i}_{j}(first,second = None):\n"
+        f"    return [first,second,{i},{j}]\n\n\n"
+        for j in range(20)
+    )
+
+
+def write_tree(root, count, distinct):
+    """Writes <count> modules, with <distinct> different contents."""
+    paths = []
+    for i in range(count):
+        path = os.path.join(root, f"module_{i}.py")
+        with open(path, "w") as f:
+            f.write(module(i % distinct))
+        paths.append(path)
+    return paths
+
+
+def run(paths, *argv):
+    visitor = _rewrite.configure("--target-file", "", "-nc", "-c", *argv)
+    visitor.files = paths
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            _rewrite.reformat(visitor)
+        except SystemExit:
+            pass
+
+
+def count_reads(paths):
+    """Number of times the files are opened by a run with a single job."""
+    opened = []
+
+    def counting_open(file, *args, **kwargs):
+        opened.append(file)
+        return open(file, *args, **kwargs)
+
+    _rewrite.open = counting_open
+    try:
+        run(paths, "--jobs", "1")
+    finally:
+        del _rewrite.open
+    return len(opened)
+
+
+def main():
+    for distinct in (400, 20):
+        with tempfile.TemporaryDirectory() as root:
+            paths = write_tree(root, 400, distinct)
+            seconds = _common.best_of(lambda: run(paths), repeat=3, number=1)
+            reads = count_reads(paths)
+        print(
+            f"{distinct:>4} different contents {seconds * 1000:>10.1f} ms "
+            f"{reads / len(paths):>6.2f} reads per file"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Measures visited nodes per second on the tests/*/input.py corpus, comparing the
+type keyed dispatch table with the previous "visit_" + class name getattr() lookup.
+"""
+import ast
+
+import _common
+import _rewrite
+
+
+class NameDispatchRewrite(_rewrite.Rewrite):
+    def visit(self, node, new_line=True):
+        """The dispatch used before the dispatch table was introduced."""
+        method = "visit_" + node.__class__.__name__
+        visitor = getattr(self, method, self.generic_visit)
+        children = visitor(node)
+        if children is not None:
+            for child, child_new_line in children:
+                self.visit(child, child_new_line)
+        if new_line and not isinstance(node, ast.Module):
+            self.new_line()
+
+
+def run(visitor, trees):
+    for _, tree in trees:
+        _common.format_tree(visitor, tree)
+
+
+def main():
+    trees = _common.corpus()
+    nodes = _common.count_nodes(trees)
+    variants = {
+        "getattr dispatch": NameDispatchRewrite(),
+        "dispatch table": _rewrite.Rewrite(),
+    }
+    print(f"{len(trees)} files, {nodes} nodes")
+    for name, visitor in variants.items():
+        seconds = _common.best_of(lambda: run(visitor, trees))
+        print(f"{name:<20}{nodes / seconds:>12,.0f} nodes/sec")
+
+
+if __name__ == "__main__":
+    main()
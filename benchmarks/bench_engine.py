@@ -0,0 +1,50 @@
+"""
+Compares the recursive and the iterative traversal engines, on the tests/*/input.py
+corpus and on statements containing a growing chain of additions, which the recursive
+engine visits one level of recursion per operation.
+"""
+import ast
+
+import _common
+import _rewrite
+from _exceptions import NoSolutionError
+
+
+def chain(count):
+    """A statement containing a chain of <count> additions."""
+    return "total = " + " + ".join(f"operand_{i}" for i in range(count)) + "\n"
+
+
+def run(visitor, trees):
+    for _, tree in trees:
+        _common.format_tree(visitor, tree)
+
+
+def main():
+    trees = _common.corpus()
+    nodes = _common.count_nodes(trees)
+    print(f"{len(trees)} files, {nodes} nodes")
+    for engine in _rewrite.ENGINES:
+        visitor = _rewrite.configure("", "--engine", engine)
+        seconds = _common.best_of(lambda: run(visitor, trees))
+        print(f"{engine:<20}{nodes / seconds:>12,.0f} nodes/sec")
+
+    print(f"\n{'operations':<12}" + "".join(f"{e:>20}" for e in _rewrite.ENGINES))
+    for count in (250, 500, 1000, 2000):
+        source = chain(count)
+        ast.parse(source)
+        times = []
+        for engine in _rewrite.ENGINES:
+            visitor = _rewrite.configure("", "--engine", engine)
+            try:
+                seconds = _common.best_of(
+                    lambda: visitor.format_source(source), number=5
+                )
+                times.append(f"{seconds * 1000:.2f} ms")
+            except NoSolutionError:
+                times.append("no solution")
+        print(f"{count:<12}" + "".join(f"{time:>20}" for time in times))
+
+
+if __name__ == "__main__":
+    main()
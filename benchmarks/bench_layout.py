@@ -0,0 +1,59 @@
+"""
+Compares the legacy and the document layout engines on statements that exceed the
+maximum line length, with a growing number of nested calls and of operations.
+The legacy engine formats a line again each time it overflows and may fail with
+NoSolutionError, the document engine lays each file out in a single pass.
+"""
+import ast
+
+import _common
+import _rewrite
+from _exceptions import NoSolutionError
+
+
+def nested_calls(depth):
+    """Statements containing <depth> nested calls with long arguments."""
+    call = "argument"
+    for i in range(depth):
+        call = f"function_number_{i}({call}, keyword_argument_{i}=value_{i})"
+    return f"result = {call}\n" * 10
+
+
+def operations(count):
+    """Statements containing a chain of <count> additions."""
+    return ("total = " + " + ".join(f"operand_{i}" for i in range(count)) + "\n") * 10
+
+
+def measure(layout, source):
+    """
+    Formats the source code.
+    :return: Time of a single formatting in milliseconds, None if it has no solution.
+    """
+    visitor = _rewrite.configure("--layout", layout, "--max-line", "60")
+    ast.parse(source)
+    try:
+        visitor.format_source(source)
+    except NoSolutionError:
+        return None
+    return _common.best_of(lambda: visitor.format_source(source), number=5) * 1000
+
+
+def main():
+    print(f"{'':<19}" + "".join(f"{layout:>16}" for layout in _rewrite.LAYOUTS))
+    for name, generate, sizes in (
+        ("nested calls", nested_calls, (5, 10, 20, 40)),
+        ("operations", operations, (50, 100, 200, 400)),
+    ):
+        for size in sizes:
+            source = generate(size)
+            results = []
+            for layout in _rewrite.LAYOUTS:
+                milliseconds = measure(layout, source)
+                results.append(
+                    "no solution" if milliseconds is None else f"{milliseconds:.2f} ms"
+                )
+            print(f"{name:<14}{size:>5}" + "".join(f"{r:>16}" for r in results))
+
+
+if __name__ == "__main__":
+    main()
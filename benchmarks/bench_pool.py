@@ -0,0 +1,46 @@
+"""
+Measures formatting many small files with a new formatter for each file, as the worker
+threads did before formatters were reused, and with formatters taken from a
+_rewrite.FormatterPool, which are reset between files instead.
+"""
+import _common
+import _rewrite
+
+
+def small_files(count):
+    """Sources of <count> small files."""
+    return [
+        f"import os\n\n\ndef function_{i}(argument):\n    return argument + {i}\n"
+        for i in range(count)
+    ]
+
+
+def fresh(sources, settings):
+    for source in sources:
+        _rewrite.Rewrite.from_settings(settings).format_source(source)
+
+
+def pooled(sources, pool, config):
+    for source in sources:
+        with pool.formatter(config) as formatter:
+            formatter.format_source(source)
+
+
+def main():
+    sources = small_files(1000)
+    visitor = _rewrite.Rewrite()
+    pool = _rewrite.FormatterPool()
+    times = {
+        "new formatter": _common.best_of(
+            lambda: fresh(sources, visitor.settings()), number=1
+        ),
+        "formatter pool": _common.best_of(
+            lambda: pooled(sources, pool, visitor.config()), number=1
+        ),
+    }
+    for name, seconds in times.items():
+        print(f"{name:<20}{len(sources) / seconds:>12,.0f} files/sec")
+
+
+if __name__ == "__main__":
+    main()
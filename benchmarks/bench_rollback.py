@@ -0,0 +1,75 @@
+"""
+Measures the recovery from a long line at the end of a growing "if" block.
+"whole statement" formats the top level statement again when one of its lines
+overflows, as the formatter did before the emitter checkpoints were introduced.
+"smallest statement" rolls back and formats again only the statement that contains the
+long line.
+The flat width table is disabled in both, so each long line is found only after it is
+printed. Only the time spent in check_line() is measured, the rest of the block is the
+same in both.
+"""
+import ast
+import time
+
+import _common
+import _rewrite
+
+
+class SmallestStatementRewrite(_rewrite.Rewrite):
+    # Time spent in check_line() in seconds.
+    check_line_seconds = 0
+
+    def check_line(self):
+        start = time.perf_counter()
+        super().check_line()
+        self.check_line_seconds += time.perf_counter() - start
+
+    def _visit_body_node(self, node, new_line=True):
+        """Lines are found to be long only after they are printed."""
+        self.state.starting_new_line_node = node
+        self.state.starting_new_line_checkpoint = self.emitter.checkpoint()
+        yield node, new_line
+
+
+class WholeStatementRewrite(SmallestStatementRewrite):
+    def _visit_list(self, nodes_list, *, _new_line_at_finish=True):
+        """The top level statement stays the node that starts the line."""
+        for i, node in enumerate(nodes_list):
+            yield node, i + 1 != len(nodes_list) or _new_line_at_finish
+
+
+def long_block(size):
+    """An "if" block of <size> statements, the last one exceeds the line length."""
+    lines = ["if condition:\n"]
+    lines.extend(f"    value_{i} = {i}\n" for i in range(size - 1))
+    arguments = ", ".join(f"argument_{j}" for j in range(10))
+    lines.append(f"    function({arguments})\n")
+    return "".join(lines)
+
+
+def measure(visitor, tree, repeat=20):
+    """
+    Formats a parsed tree.
+    :return: Best time spent in check_line() by a single formatting, in milliseconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        visitor.check_line_seconds = 0
+        _common.format_tree(visitor, tree)
+        best = min(best, visitor.check_line_seconds)
+    return best * 1000
+
+
+def main():
+    print(f"{'block lines':<12}{'whole statement':>20}{'smallest statement':>20}")
+    for size in (250, 500, 1000, 2000):
+        tree = ast.parse(long_block(size))
+        times = [
+            f"{measure(visitor, tree):.3f} ms"
+            for visitor in (WholeStatementRewrite(), SmallestStatementRewrite())
+        ]
+        print(f"{size:<12}{times[0]:>20}{times[1]:>20}")
+
+
+if __name__ == "__main__":
+    main()
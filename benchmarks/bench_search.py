@@ -0,0 +1,61 @@
+"""
+Measures finding the Python files of a generated tree that looks like a checkout with
+a large .git directory, node_modules and a virtual environment, with the os.walk()
+search that filtered the paths after walking every directory, and with
+_search.walk(), which prunes the excluded directories.
+Usage: python benchmarks/bench_search.py [number of packages, default 200]
+"""
+import os
+import sys
+import tempfile
+
+import _common
+import _search
+
+
+def generate(root, packages):
+    """Writes a tree with <packages> source packages and large excluded directories."""
+    for i in range(packages):
+        package = os.path.join(root, "src", f"package_{i}")
+        os.makedirs(package)
+        for j in range(10):
+            open(os.path.join(package, f"module_{j}.py"), "w").close()
+    for excluded in (".git/objects", "node_modules", ".venv/lib", ".tox/py38"):
+        for i in range(packages * 2):
+            directory = os.path.join(root, excluded, f"directory_{i}")
+            os.makedirs(directory)
+            for j in range(10):
+                open(os.path.join(directory, f"file_{j}.py"), "w").close()
+
+
+def os_walk(root, suffixes):
+    """The search before _search.walk(), see git history."""
+    files = []
+    for path, subdirs, names in os.walk(root):
+        if "formatter" in path:
+            continue
+        for name in names:
+            if any(name.endswith(suffix) for suffix in suffixes) and (
+                "venv" not in path
+            ):
+                files.append(os.path.join(path, name))
+    return files
+
+
+def main():
+    packages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    suffixes = ["py"]
+    with tempfile.TemporaryDirectory() as root:
+        generate(root, packages)
+        file_filter = _search.FileFilter(suffixes)
+        searches = {
+            "os.walk": lambda: os_walk(root, suffixes),
+            "_search.walk": lambda: list(_search.walk(root, file_filter)),
+        }
+        for name, search in searches.items():
+            found = len(search())
+            seconds = _common.best_of(search, number=1)
+            print(f"{name:<20}{seconds * 1000:>10.1f} ms  ({found} files found)")
+
+if __name__ == "__main__":
+    main()
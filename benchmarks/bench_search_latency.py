@@ -0,0 +1,59 @@
+"""
+Measures finding the Python files of a generated tree on a simulated slow file system,
+where each os.scandir() call waits a fixed latency before listing the directory (as an
+NFS round trip would), with _search.walk(), which lists one directory at a time, and
+with _search.walk_concurrently() using several threads.
+Usage: python benchmarks/bench_search_latency.py [latency in ms, default 2]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import _common
+import _search
+
+
+def generate(root, packages=20, depth=3):
+    """Writes a tree of nested packages, each package has a few modules."""
+    for i in range(packages):
+        directory = root
+        for level in range(depth):
+            directory = os.path.join(directory, f"package_{i}_{level}")
+            os.makedirs(directory)
+            for j in range(5):
+                open(os.path.join(directory, f"module_{j}.py"), "w").close()
+
+
+def slow_scandir(latency):
+    """Returns os.scandir() waiting <latency> seconds before each listing."""
+    scandir = os.scandir
+
+    def wrapper(path):
+        time.sleep(latency)
+        return scandir(path)
+
+    return wrapper
+
+
+def main():
+    latency = (float(sys.argv[1]) if len(sys.argv) > 1 else 2) / 1000
+    file_filter = _search.FileFilter(["py"])
+    with tempfile.TemporaryDirectory() as root:
+        generate(root)
+        os.scandir = slow_scandir(latency)
+        searches = {
+            "walk": lambda: list(_search.walk(root, file_filter)),
+        }
+        for threads in (4, 16, 64):
+            searches[f"concurrent, {threads} threads"] = lambda threads=threads: list(
+                _search.walk_concurrently(root, file_filter, threads)
+            )
+        for name, search in searches.items():
+            found = len(search())
+            seconds = _common.best_of(search, repeat=3, number=1)
+            print(f"{name:<28}{seconds * 1000:>10.1f} ms  ({found} files found)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares the latency of checking a single file with a new formatter process (cold CLI)
+and with a formatter daemon started by --serve (warm daemon), through the client
+command line and through a client that is already running.
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import _common
+import _client
+
+
+def latency(function, repeat=20):
+    """
+    Times a function.
+    :return: Median time of a call in milliseconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    target_file = os.path.join(directory, "target.py")
+    with open(target_file, "w") as f:
+        f.write("def function(first, second):\n    return first + second\n")
+    socket_path = os.path.join(directory, "formatter.sock")
+    daemon = subprocess.Popen(
+        [sys.executable, "main.py", "--serve", socket_path], cwd=_common.ROOT
+    )
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        message = {"command": "check", "path": target_file}
+        times = {
+            "cold CLI": latency(
+                lambda: subprocess.run(
+                    [sys.executable, "main.py", "-c", "-nc", "-t", target_file],
+                    cwd=_common.ROOT,
+                    stdout=subprocess.DEVNULL,
+                )
+            ),
+            "client CLI": latency(
+                lambda: subprocess.run(
+                    [sys.executable, "client.py", socket_path, "--check", target_file],
+                    cwd=_common.ROOT,
+                )
+            ),
+            "running client": latency(lambda: _client.request(socket_path, message)),
+        }
+    finally:
+        daemon.terminate()
+        daemon.wait()
+    for name, milliseconds in times.items():
+        print(f"{name:<20}{milliseconds:>10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Measures the peak memory of formatting a large generated module, by reading and
+formatting the whole file at once (format_source) and statement by statement
+(format_stream). Each measurement runs in its own process.
+Usage: python benchmarks/bench_stream.py [size in MB, default 50]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tokenize
+
+import _common
+import _rewrite
+
+
+def generate(path, size):
+    """Writes a module of about <size> bytes, made of small functions and tables."""
+    with open(path, "w") as f:
+        i = 0
+        while f.tell() < size:
+            f.write(
+                f"def function_{i}(first, second=None):\n"
+                f"    table = {{'key_{i}': [first, second, {i}], 'other': {i}}}\n"
+                f"    return table['key_{i}'][0] + {i} * second\n\n\n"
+                f"VALUE_{i} = function_{i}({i}, second={i} + 1)\n"
+            )
+            i += 1
+
+
+def child(mode, path):
+    """Formats the file in the measured process, prints the peak memory and time."""
+    visitor = _rewrite.Rewrite()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as output:
+        if mode == "whole file":
+            with tokenize.open(path) as f:
+                output.write(visitor.format_source(f.read(), path))
+        else:
+            with tokenize.open(path) as f:
+                visitor.format_stream(f.readline, output.write, path)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode:<20}{peak:>10.0f} MB peak{seconds:>10.1f} s")
+
+
+def main():
+    size = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "generated.py")
+        generate(path, int(size * 1024 * 1024))
+        print(f"module of {os.path.getsize(path) / 1024 / 1024:.0f} MB")
+        for mode in ("whole file", "statement stream"):
+            subprocess.run(
+                [sys.executable, __file__, "--child", mode, path], cwd=_common.ROOT
+            )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(*sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,32 @@
+"""
+Measures the cost of the trace messages on the tests/*/input.py corpus.
+"eager messages" builds every trace message and hands it to logging, which drops it,
+as the formatter did before the messages were guarded by _trace.enabled.
+"""
+import _common
+import _rewrite
+import _trace
+
+
+def run(visitor, trees):
+    for _, tree in trees:
+        _common.format_tree(visitor, tree)
+
+
+def main():
+    trees = _common.corpus()
+    nodes = _common.count_nodes(trees)
+    visitor = _rewrite.Rewrite()
+    print(f"{len(trees)} files, {nodes} nodes")
+    results = {}
+    for name, enabled in (("tracing off", False), ("eager messages", True)):
+        _trace.enabled = enabled
+        results[name] = _common.best_of(lambda: run(visitor, trees))
+        print(f"{name:<20}{results[name] * 1000:>10.2f} ms")
+    _trace.enabled = False
+    saved = 1 - results["tracing off"] / results["eager messages"]
+    print(f"tracing off saves {saved:.0%} of the formatting time")
+
+
+if __name__ == "__main__":
+    main()
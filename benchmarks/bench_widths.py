@@ -0,0 +1,57 @@
+"""
+Measures the flat width table on statements that exceed the maximum line length.
+"render on overflow" prints each long statement, finds that it is too long and prints
+it again in its long form, as the formatter did before the table was introduced.
+The table is also measured on its own, on a file of more than 100,000 nodes.
+"""
+import ast
+import time
+
+import _common
+import _rewrite
+from _widths import FlatWidths
+
+
+class OverflowRewrite(_rewrite.Rewrite):
+    def _visit_body_node(self, node, new_line=True):
+        """Lines are found to be long only after they are printed."""
+        self.state.starting_new_line_node = node
+        self.state.starting_new_line_checkpoint = self.emitter.checkpoint()
+        yield node, new_line
+
+
+def long_statements(count):
+    """Source code of <count> calls, half of them exceed the maximum line length."""
+    lines = []
+    for i in range(count):
+        arguments = ", ".join(f"argument_{j}" for j in range(2 + (i % 2) * 8))
+        lines.append(f"function_{i}({arguments})\n")
+    return "".join(lines)
+
+
+def main():
+    tree = ast.parse(long_statements(2000))
+    nodes = _common.count_nodes([(None, tree)])
+    print(f"{nodes} nodes")
+    for name, visitor in (
+        ("render on overflow", OverflowRewrite()),
+        ("flat width table", _rewrite.Rewrite()),
+    ):
+        seconds = _common.best_of(
+            lambda: _common.format_tree(visitor, tree),
+            number=5,
+        )
+        print(f"{name:<20}{seconds * 1000:>10.2f} ms")
+
+    tree = ast.parse(long_statements(20000))
+    nodes = _common.count_nodes([(None, tree)])
+    widths = FlatWidths(_rewrite.Rewrite())
+    start = time.perf_counter()
+    for statement in tree.body:
+        widths.width(statement)
+    seconds = time.perf_counter() - start
+    print(f"table of {nodes} nodes built in {seconds * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
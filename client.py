@@ -0,0 +1,54 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "lib"))
+import _client
+
+USAGE = """Usage: python -m client <socket_path> [--check] [FILE ...]
+
+Sends the files to a formatter daemon that was started with --serve <socket_path>,
+the files are rewritten if they are not formatted. Without files, the source code is
+read from stdin and the formatted code is written to stdout.
+With --check, nothing is written and the exit code is 1 if the code is not formatted.
+"""
+
+
+def main(*argv):
+    """
+    Runs the client.
+    :param argv: The command line arguments provided by the user.
+    :return: 0 if the code is formatted, 1 if check found code to format, 2 on errors.
+    """
+    arguments = list(argv[1:])
+    if not arguments or arguments[0] in ("-h", "--help"):
+        print(USAGE, end="")
+        return 0 if arguments else 2
+    socket_path = arguments.pop(0)
+    command = "format"
+    if "--check" in arguments:
+        arguments.remove("--check")
+        command = "check"
+    if arguments:
+        messages = [
+            {"command": command, "path": os.path.abspath(path)} for path in arguments
+        ]
+    else:
+        messages = [{"command": command, "source": sys.stdin.read()}]
+    exit_code = 0
+    for message in messages:
+        response = _client.request(socket_path, message)
+        if "error" in response:
+            print(response["error"], file=sys.stderr)
+            exit_code = 2
+            continue
+        if "output" in response:
+            sys.stdout.write(response["output"])
+        if command == "check" and response["changed"]:
+            if "path" in message:
+                print(f"would reformat {message['path']}", file=sys.stderr)
+            exit_code = max(exit_code, 1)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv))
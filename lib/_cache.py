@@ -0,0 +1,112 @@
+# Ignore file
+import hashlib
+import json
+import os
+import sys
+import _write
+
+# Directory of the cache, relative to the current working directory.
+DIRECTORY = ".pyformatter_cache"
+
+
+def digest(data):
+    """
+    Hashes the content of a file.
+    :param data: Bytes.
+    :return: Hexadecimal digest.
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def formatter_version():
+    """
+    Hashes the code of the formatter, so entries written by another version of the
+    formatter are never used.
+    :return: Hexadecimal digest.
+    """
+    lib_directory = os.path.dirname(os.path.abspath(__file__))
+    version = hashlib.blake2b(digest_size=16)
+    for name in sorted(os.listdir(lib_directory)):
+        if name.endswith(".py"):
+            with open(os.path.join(lib_directory, name), "rb") as f:
+                version.update(f.read())
+    return version.hexdigest()
+
+
+class Cache:
+    """
+    Remembers the files that are known to be formatted.
+    Each combination of formatting configurations and formatter version has its own
+    cache file, an entry maps the absolute path of a formatted file to its
+    modification time, size and content digest. A file whose modification time and
+    size did not change is formatted, without being read, and a file whose content
+    digest is known is formatted, without being parsed.
+    """
+
+    def __init__(self, settings, directory=DIRECTORY):
+        """
+        Loads the cache.
+        :param settings: The formatting configurations, see Rewrite.settings().
+        :param directory: Directory of the cache files.
+        """
+        fingerprint = json.dumps(
+            [sorted(settings.items()), formatter_version(), sys.version_info[:2]]
+        )
+        self.directory = directory
+        self.path = os.path.join(directory, digest(fingerprint.encode()) + ".json")
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            # No cache yet, or a cache file that cannot be used.
+            self.entries = {}
+
+    def formatted_digests(self):
+        """
+        Returns the content digests of all the formatted files.
+        :return: frozenset of digests.
+        """
+        return frozenset(entry[2] for entry in self.entries.values())
+
+    def is_formatted(self, target_file):
+        """
+        Checks whether a file is known to be formatted by its modification time and
+        size, the file itself is not read.
+        :param target_file: Path of the file.
+        :return: True if the file did not change since it was found formatted.
+        """
+        entry = self.entries.get(os.path.abspath(target_file))
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(target_file)
+        except OSError:
+            return False
+        return entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size
+
+    def record(self, target_file, entry):
+        """
+        Remembers that a file is formatted.
+        :param target_file: Path of the file.
+        :param entry: Tuple containing the modification time in nanoseconds, the size
+                      and the content digest of the file.
+        :return: None
+        """
+        self.entries[os.path.abspath(target_file)] = list(entry)
+
+    def forget(self, target_file):
+        """
+        Removes the entry of a file that is not formatted.
+        :param target_file: Path of the file.
+        :return: None
+        """
+        self.entries.pop(os.path.abspath(target_file), None)
+
+    def save(self):
+        """
+        Writes the cache file, the file is replaced at once so concurrent runs never
+        read a partially written cache.
+        :return: None
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        _write.write_atomic(self.path, json.dumps(self.entries).encode())
@@ -0,0 +1,25 @@
+# Ignore file
+import json
+import socket
+
+# Note that the client does not import the formatter, so a client process starts
+# quickly, see _serve.py for the requests and responses.
+
+
+def request(socket_path, message):
+    """
+    Sends a single request to a formatter daemon and waits for its response.
+    :param socket_path: Path of the Unix socket of the daemon.
+    :param message: The request, a dictionary.
+    :return: The response, a dictionary.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(json.dumps(message).encode() + b"\n")
+        chunks = []
+        while not chunks or not chunks[-1].endswith(b"\n"):
+            chunk = client.recv(64 * 1024)
+            if not chunk:
+                raise ConnectionError("the daemon closed the connection")
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks))
@@ -1,6 +1,8 @@
 # Ignore file
 import os
 import pathlib
+import _ranges
+import _trace
 
 current_dir = os.path.abspath(os.path.dirname(__file__))
 parent_dir = pathlib.Path(current_dir).parent
@@ -31,6 +33,10 @@ class Conf:
             visitor.vertical_definition_lines = int(
                 conf_dict["VERTICAL_DEFINITION_LINES"]
             )
+        if conf_dict.get("ENGINE"):
+            visitor.engine = conf_dict["ENGINE"].strip()
+        if conf_dict.get("LAYOUT"):
+            visitor.layout = conf_dict["LAYOUT"].strip()
         if conf_dict.get("NESTED_LINES"):
             visitor.nested_lines = int(conf_dict["NESTED_LINES"])
         if str(conf_dict.get("DIRECT_FILE")) == "TRUE":
@@ -49,6 +55,13 @@ class Conf:
         if conf_dict.get("DIRECTORY"):
             visitor.direct_file = conf_dict["DIRECT_FILE"]
 
+        # Get all the markers of generated files, see _skip.SkipPolicy.
+        if conf_dict.get("GENERATED_MARKERS"):
+            for marker in conf_dict["GENERATED_MARKERS"].split(","):
+                visitor.generated_markers.append(marker.strip())
+        if conf_dict.get("MAX_FILE_SIZE"):
+            visitor.max_file_size = int(conf_dict["MAX_FILE_SIZE"])
+
         # Get all suffixes and remove leading and ending whitespaces.
         if conf_dict.get("SUFFIXES"):
             suffixes = conf_dict["SUFFIXES"].split(",")
@@ -76,9 +89,39 @@ class Conf:
             elif argv[i] in ["-t", "--target-file"]:
                 visitor.target_file = argv[i + 1]
                 i += 1
+            elif argv[i] == "--changed-since":
+                visitor.changed_since = argv[i + 1]
+                i += 1
+            elif argv[i] == "--exclude":
+                visitor.exclude.append(argv[i + 1])
+                i += 1
+            elif argv[i] == "--generated-marker":
+                visitor.generated_markers.append(argv[i + 1])
+                i += 1
+            elif argv[i] == "--max-file-size":
+                visitor.max_file_size = int(argv[i + 1])
+                i += 1
+            elif argv[i] == "--include":
+                visitor.include.append(argv[i + 1])
+                i += 1
+            elif argv[i] in ["-e", "--engine"]:
+                visitor.engine = argv[i + 1]
+                i += 1
+            elif argv[i] == "--fail-fast":
+                visitor.fail_fast = True
+            elif argv[i] == "--fsync":
+                visitor.fsync = True
+            elif argv[i] in ["-j", "--jobs"]:
+                visitor.jobs = int(argv[i + 1])
+                i += 1
+            elif argv[i] in ["-l", "--layout"]:
+                visitor.layout = argv[i + 1]
+                i += 1
             elif argv[i] in ["-ml", "--max-line"]:
                 visitor.max_line = int(argv[i + 1])
                 i += 1
+            elif argv[i] in ["-nc", "--no-cache"]:
+                visitor.use_cache = False
             elif argv[i] in ["-nl", "--nested-lines"]:
                 visitor.nested_lines = int(argv[i + 1])
                 i += 1
@@ -94,6 +137,27 @@ class Conf:
                 visitor.space_between_arguments = True
             elif argv[i] in ["-mi", "--multiple-imports"]:
                 visitor.multiple_imports = True
+            elif argv[i] == "--serve":
+                visitor.serve_socket = argv[i + 1]
+                i += 1
+            elif argv[i] == "--stdin":
+                visitor.stdin = True
+            elif argv[i] == "--stream":
+                visitor.stream = True
+            elif argv[i] == "--line-ranges":
+                visitor.line_ranges = _ranges.parse_line_ranges(argv[i + 1])
+                i += 1
+            elif argv[i] == "--stdin-filename":
+                visitor.stdin_filename = argv[i + 1]
+                i += 1
+            elif argv[i] == "--search-threads":
+                visitor.search_threads = int(argv[i + 1])
+                i += 1
+            elif argv[i] in ["-th", "--threads"]:
+                visitor.threads = int(argv[i + 1])
+                i += 1
+            elif argv[i] == "--trace":
+                _trace.enable()
             elif argv[i] in ["-h", "--help"]:
                 print_help()
                 exit(0)
@@ -101,6 +165,9 @@ class Conf:
                 if i != 0:
                     raise ValueError(f"unknown argument {argv[i]}.")
             i += 1
+        if visitor.stream and not visitor.stdin:
+            # The files are read entirely, so that they can be compared and written.
+            raise ValueError("--stream requires --stdin.")
 
 
 def print_help():
@@ -117,6 +184,11 @@ def print_help():
             "-t",
             "--target-file <target_file>",
         ): "Specify the target file to be formatted",
+        (None, "--stdin"): "Format stdin and write the formatted code to stdout",
+        (
+            None,
+            "--changed-since <git_ref>",
+        ): "Reformat the files that changed since a git revision, and untracked files",
     }
 
     options = {
@@ -125,12 +197,44 @@ def print_help():
             "-cfg",
             "--configuration <configuration file>",
         ): "Use this option to provide a configuration file",
+        (
+            "-e",
+            "--engine <recursive|iterative>",
+        ): "Traversal engine, iterative has no depth limit (default: recursive)",
+        (
+            None,
+            "--exclude <glob>",
+        ): "Do not search files or directories (ending with /) matching the pattern",
+        (
+            None,
+            "--fail-fast",
+        ): "Stop at the first file that must change, recently modified files first",
+        (None, "--fsync"): "Flush changed files to the disk before replacing them",
+        (
+            None,
+            "--generated-marker <text>",
+        ): "Skip files containing the text in their first 4 KB, e.g. @generated",
         ("-h", "--help"): "Display the help message",
+        (None, "--include <glob>"): "Also search files matching the pattern",
+        (
+            None,
+            "--line-ranges <first-last,...>",
+        ): "Format only the statements in these lines, e.g. 10-40,120-130",
+        (
+            "-j",
+            "--jobs <number>",
+        ): "Number of processes used to format files (default: CPU count)",
+        (
+            "-l",
+            "--layout <legacy|document>",
+        ): "Layout engine used to break long lines (default: legacy)",
+        (None, "--max-file-size <bytes>"): "Skip files larger than the size",
         ("-ml", "--max-line <max_line>"): "Specify the maximum line length",
         (
             "-mi",
             "--multiple-imports",
         ): "Allow importing multiples modules in a single line",
+        ("-nc", "--no-cache"): "Format files even if they are known to be formatted",
         (
             "-nl",
             "--nested-lines <lines>",
@@ -143,6 +247,24 @@ def print_help():
             "-s",
             "--suffix"
         ): "Add a non-Python suffix to reformat (Python syntax)",
+        (
+            None,
+            "--search-threads <number>",
+        ): "Threads listing directories concurrently, e.g. on NFS (follows symlinks)",
+        (None, "--serve <socket_path>"): "Run a formatter daemon on a Unix socket",
+        (
+            None,
+            "--stream",
+        ): "With --stdin, format statement by statement, for very large code",
+        (
+            None,
+            "--stdin-filename <path>",
+        ): "Name of the file read with --stdin, for its suffix",
+        (
+            "-th",
+            "--threads <number>",
+        ): "Number of threads used to format files concurrently",
+        (None, "--trace"): "Write a detailed trace of the formatter to stderr",
         (
             "-vdl",
             "--vertical-definition-lines <number>",
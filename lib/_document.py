@@ -0,0 +1,301 @@
+# Ignore file
+
+# Kinds of the tokens of a document, each token is a tuple starting with its kind.
+# (TEXT, text): Text that is always printed as is.
+TEXT = 0
+# (MARGIN, indentation): Starts a line that is indented by <indentation> spaces.
+MARGIN = 1
+# (HARDLINE,): Ends a line.
+HARDLINE = 2
+# (LINE, flat_text): Ends a line if the enclosing group is broken, otherwise prints
+# flat_text.
+LINE = 3
+# (IF_BREAK, text): Prints text if the enclosing group is broken, e.g. a trailing comma.
+IF_BREAK = 4
+# (BEGIN_GROUP,) and (END_GROUP,): A group is printed in a single line (flat) if it
+# fits in the maximum line length, otherwise, all of its lines are broken.
+BEGIN_GROUP = 5
+END_GROUP = 6
+# (INDENT,) and (DEDENT,): Lines that are broken between them are indented by four more
+# spaces.
+INDENT = 7
+DEDENT = 8
+
+# Width of a group that contains a hard line, such a group is never flat.
+_INFINITE = float("inf")
+
+
+class Document:
+    """
+    Collects the formatted code as a document, a sequence of tokens describing text,
+    groups, indentation and the places where a line may be broken.
+    Unlike Emitter, nothing is decided while the code is visited: getvalue() lays the
+    document out in a single linear pass, breaking a group only when it does not fit in
+    the maximum line length. A line that cannot be shortened, such as a long name, is
+    printed as is, so the layout always finishes.
+    Note that Document has the interface of Emitter, see Rewrite.layout.
+    """
+
+    def __init__(self, max_line=88):
+        """
+        Initializes all the object's variables.
+        :param max_line: Maximum line length, including the terminating new line.
+        """
+        self.max_line = max_line
+        # Tokens of the document, the tokens of the line that is currently being
+        # written start at line_start.
+        self.tokens = []
+        # Index of the first token of the current line.
+        self.line_start = 0
+        # Space indentation in any given moment.
+        self.indentation = 0
+        # True if nothing was written in the current line yet.
+        self.in_new_line = True
+
+    @property
+    def line_length(self):
+        """Flat length of the current line, including its indentation."""
+        length = 0
+        for token in self.tokens[self.line_start :]:
+            if token[0] == MARGIN:
+                length += token[1]
+            elif token[0] in (TEXT, LINE):
+                length += len(token[1])
+        return length
+
+    @property
+    def current_line(self):
+        """Flat content of the current line."""
+        return "".join(
+            " " * token[1] if token[0] == MARGIN else token[1]
+            for token in self.tokens[self.line_start :]
+            if token[0] in (TEXT, MARGIN, LINE)
+        )
+
+    def _append(self, token):
+        """
+        Appends a token to the current line, indents the line if the token is the first
+        token in it.
+        :param token: Token tuple.
+        :return: None
+        """
+        if self.in_new_line:
+            self.tokens.append((MARGIN, self.indentation))
+            self.in_new_line = False
+        self.tokens.append(token)
+
+    def write(self, text):
+        """
+        Writes text to the current line, indents the line if the text is the first
+        text in it.
+        :param text: Text to write.
+        :return: None
+        """
+        self._append((TEXT, text))
+
+    def newline(self):
+        """
+        Finishes the current line, or writes an empty line if the current line is empty.
+        :return: None
+        """
+        self.tokens.append((HARDLINE,))
+        self.line_start = len(self.tokens)
+        self.in_new_line = True
+
+    def line(self, flat_text=" "):
+        """
+        Allows breaking the line, see LINE.
+        :param flat_text: Text printed instead if the line is not broken.
+        :return: None
+        """
+        self._append((LINE, flat_text))
+
+    def softline(self):
+        """
+        Allows breaking the line, nothing is printed if the line is not broken.
+        :return: None
+        """
+        self._append((LINE, ""))
+
+    def if_break(self, text):
+        """
+        Writes text only if the enclosing group is broken.
+        :param text: Text to write.
+        :return: None
+        """
+        self._append((IF_BREAK, text))
+
+    def begin_group(self):
+        """Starts a group, see BEGIN_GROUP."""
+        self._append((BEGIN_GROUP,))
+
+    def end_group(self):
+        """Ends the latest group that was started."""
+        self._append((END_GROUP,))
+
+    def indent(self):
+        """Indents the lines that are broken from now on by four more spaces."""
+        self._append((INDENT,))
+
+    def dedent(self):
+        """Cancels the latest call to indent()."""
+        self._append((DEDENT,))
+
+    def discard_line(self):
+        """
+        Removes the content of the current line.
+        :return: None
+        """
+        del self.tokens[self.line_start :]
+        self.in_new_line = True
+
+    def checkpoint(self):
+        """
+        Marks the current position, everything that is written after it can be removed
+        by rollback().
+        :return: The checkpoint, an opaque value.
+        """
+        return len(self.tokens), self.line_start, self.in_new_line
+
+    def rollback(self, checkpoint):
+        """
+        Removes everything that was written since a checkpoint.
+        :param checkpoint: Value returned by checkpoint().
+        :return: None
+        """
+        size, self.line_start, self.in_new_line = checkpoint
+        del self.tokens[size:]
+
+    def getvalue(self):
+        """
+        Lays out the document and returns the formatted code.
+        :return: String containing all the finished lines.
+        """
+        return "".join(layout(self.tokens[: self.line_start], self.max_line))
+
+    def flush(self, write):
+        """
+        Lays out the finished lines, hands them over and removes them, only the current
+        line is kept. The finished lines must not be inside a group.
+        Note that checkpoints that were taken before cannot be used anymore.
+        :param write: Function receiving the text of the finished lines.
+        :return: None
+        """
+        write("".join(layout(self.tokens[: self.line_start], self.max_line)))
+        del self.tokens[: self.line_start]
+        self.line_start = 0
+
+    def reset(self):
+        """
+        Removes everything that was written in order to start a new file.
+        :return: None
+        """
+        self.tokens.clear()
+        self.line_start = 0
+        self.indentation = 0
+        self.in_new_line = True
+
+
+def _measure(tokens):
+    """
+    Measures the groups of a document.
+    :param tokens: Tokens of the document.
+    :return: Dictionary mapping the index of each BEGIN_GROUP token to a tuple
+             containing the flat width of the group and the width of the text that
+             follows the group up to the next place where the line may be broken.
+    """
+    # Width of the text that follows each END_GROUP token, measured backwards. Note that
+    # a group is measured only if the enclosing group is broken, so the text of
+    # IF_BREAK tokens, e.g. the trailing comma that follows an argument, is counted.
+    trailing = {}
+    width = 0
+    for i in range(len(tokens) - 1, -1, -1):
+        kind = tokens[i][0]
+        if kind in (TEXT, IF_BREAK):
+            width += len(tokens[i][1])
+        elif kind in (LINE, HARDLINE):
+            width = 0
+        elif kind == END_GROUP:
+            trailing[i] = width
+    # Flat width of each group, measured forwards. A group containing a hard line is
+    # never flat.
+    groups = {}
+    stack = []
+    position = 0
+    hard_lines = 0
+    for i, token in enumerate(tokens):
+        kind = token[0]
+        if kind in (TEXT, LINE):
+            position += len(token[1])
+        elif kind == MARGIN:
+            position += token[1]
+        elif kind == HARDLINE:
+            hard_lines += 1
+        elif kind == BEGIN_GROUP:
+            stack.append((i, position, hard_lines))
+        elif kind == END_GROUP:
+            begin, begin_position, begin_hard_lines = stack.pop()
+            group_width = (
+                position - begin_position
+                if hard_lines == begin_hard_lines
+                else _INFINITE
+            )
+            groups[begin] = group_width, trailing[i]
+    return groups
+
+
+def layout(tokens, max_line):
+    """
+    Prints a document, each group is printed flat if it fits in the rest of the line,
+    together with the text that follows it up to the next place where the line may be
+    broken. Otherwise, the group is broken and its content is laid out again group by
+    group.
+    Note that the length of a line includes its terminating new line, see
+    Rewrite.print().
+    :param tokens: Tokens of the document.
+    :param max_line: Maximum line length.
+    :return: List of strings, the formatted code.
+    """
+    groups = _measure(tokens)
+    output = []
+    # Flat state of the enclosing groups, code outside of groups is broken.
+    flat_stack = [False]
+    column = 0
+    margin = 0
+    level = 0
+    for i, token in enumerate(tokens):
+        kind = token[0]
+        if kind == TEXT:
+            output.append(token[1])
+            column += len(token[1])
+        elif kind == LINE:
+            if flat_stack[-1]:
+                output.append(token[1])
+                column += len(token[1])
+            else:
+                column = margin + 4 * level
+                output.append("\n" + " " * column)
+        elif kind == BEGIN_GROUP:
+            if flat_stack[-1]:
+                flat_stack.append(True)
+            else:
+                width, trailing = groups[i]
+                flat_stack.append(column + width + trailing + 1 <= max_line)
+        elif kind == END_GROUP:
+            flat_stack.pop()
+        elif kind == IF_BREAK:
+            if not flat_stack[-1]:
+                output.append(token[1])
+                column += len(token[1])
+        elif kind == MARGIN:
+            margin = token[1]
+            column = margin + 4 * level
+            output.append(" " * column)
+        elif kind == HARDLINE:
+            output.append("\n")
+            column = 0
+        elif kind == INDENT:
+            level += 1
+        elif kind == DEDENT:
+            level -= 1
+    return output
@@ -0,0 +1,142 @@
+# Ignore file
+
+
+class Emitter:
+    """
+    Collects the formatted code in memory.
+    The output is kept as a list of fragments and joined only once, by getvalue(), the
+    caller then decides whether to compare the text, write it or discard it.
+    """
+
+    # Indentation strings, shared by all emitters, indentation_string(n) is " " * n.
+    _indentation_strings = {}
+
+    def __init__(self):
+        """
+        Initializes all the object's variables.
+        """
+        # Fragments of the formatted code, the fragments of the line that is currently
+        # being written start at line_start.
+        self.fragments = []
+        # Index of the first fragment of the current line.
+        self.line_start = 0
+        # Length of the current line, including its indentation.
+        self.line_length = 0
+        # Space indentation in any given moment.
+        self.indentation = 0
+        # True if nothing was written in the current line yet.
+        self.in_new_line = True
+
+    @classmethod
+    def indentation_string(cls, indentation):
+        """
+        Returns the string used to indent a line.
+        :param indentation: Number of spaces.
+        :return: String containing <indentation> spaces.
+        """
+        try:
+            return cls._indentation_strings[indentation]
+        except KeyError:
+            return cls._indentation_strings.setdefault(indentation, " " * indentation)
+
+    @property
+    def current_line(self):
+        """Content of the current line."""
+        return "".join(self.fragments[self.line_start :])
+
+    def write(self, text):
+        """
+        Writes text to the current line, indents the line if the text is the first
+        text in it.
+        :param text: Text to write.
+        :return: None
+        """
+        if self.in_new_line:
+            indentation = self.indentation_string(self.indentation)
+            self.fragments.append(indentation)
+            self.line_length += len(indentation)
+            self.in_new_line = False
+        self.fragments.append(text)
+        self.line_length += len(text)
+
+    def newline(self):
+        """
+        Finishes the current line, or writes an empty line if the current line is empty.
+        :return: None
+        """
+        self.fragments.append("\n")
+        self.line_start = len(self.fragments)
+        self.line_length = 0
+        self.in_new_line = True
+
+    def discard_line(self):
+        """
+        Removes the content of the current line.
+        :return: None
+        """
+        del self.fragments[self.line_start :]
+        self.line_length = 0
+        self.in_new_line = True
+
+    def reopen_line(self):
+        """
+        Cancels the latest newline(), the line that it finished becomes the current
+        line again.
+        :return: None
+        """
+        fragments = self.fragments
+        del fragments[-1]
+        start = len(fragments)
+        while start and fragments[start - 1] != "\n":
+            start -= 1
+        self.line_start = start
+        self.line_length = sum(len(fragment) for fragment in fragments[start:])
+        self.in_new_line = False
+
+    def checkpoint(self):
+        """
+        Marks the current position, everything that is written after it can be removed
+        by rollback().
+        :return: The checkpoint, an opaque value.
+        """
+        return len(self.fragments), self.line_start, self.line_length, self.in_new_line
+
+    def rollback(self, checkpoint):
+        """
+        Removes everything that was written since a checkpoint.
+        Note that the indentation is not restored, it belongs to the scope that is
+        being printed when the rollback happens.
+        :param checkpoint: Value returned by checkpoint().
+        :return: None
+        """
+        size, self.line_start, self.line_length, self.in_new_line = checkpoint
+        del self.fragments[size:]
+
+    def getvalue(self):
+        """
+        Returns the formatted code.
+        :return: String containing all the finished lines.
+        """
+        return "".join(self.fragments[: self.line_start])
+
+    def flush(self, write):
+        """
+        Hands the finished lines over and removes them, only the current line is kept.
+        Note that checkpoints that were taken before cannot be used anymore.
+        :param write: Function receiving the text of the finished lines.
+        :return: None
+        """
+        write("".join(self.fragments[: self.line_start]))
+        del self.fragments[: self.line_start]
+        self.line_start = 0
+
+    def reset(self):
+        """
+        Removes everything that was written in order to start a new file.
+        :return: None
+        """
+        self.fragments.clear()
+        self.line_start = 0
+        self.line_length = 0
+        self.indentation = 0
+        self.in_new_line = True
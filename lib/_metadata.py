@@ -0,0 +1,113 @@
+# Ignore file
+import _ast
+import ast
+
+# Statements that are separated from their neighbours by empty lines, see
+# Rewrite.visit_Module().
+DEFINITIONS = (_ast.FunctionDef, _ast.ClassDef)
+
+
+def stream_metadata(statements):
+    """
+    Computes the facts of BodyMetadata for top level statements that are parsed one by
+    one, looking a single statement ahead, see Rewrite.format_stream().
+    :param statements: Iterable of top level statement nodes.
+    :return: Generator of (statement, is docstring, is last statement, definition
+             follows) tuples.
+    """
+    statements = iter(statements)
+    statement = next(statements, None)
+    first = True
+    while statement is not None:
+        next_statement = next(statements, None)
+        yield (
+            statement,
+            first and bool(ast.get_docstring(ast.Module(body=[statement]))),
+            next_statement is None,
+            next_statement is not None
+            and not isinstance(statement, DEFINITIONS)
+            and isinstance(next_statement, DEFINITIONS),
+        )
+        statement = next_statement
+        first = False
+
+
+class BodyMetadata:
+    """
+    Memoized facts about the body of a module, class or function: whether it starts
+    with a docstring, which definition is the last one in it, and which statements are
+    followed by a definition.
+    The facts of a node are computed in a single pass over its body, the first time
+    that one of them is needed, and they are kept until the table is cleared, so the
+    visitors never scan a body or clean a docstring more than once per file.
+    """
+
+    def __init__(self):
+        """
+        Initializes all the object's variables.
+        """
+        # Dictionary mapping each node to a tuple containing whether it has a
+        # docstring, its last definition, whether the last definition is the last
+        # statement and the flags of definition_follows().
+        self.table = {}
+
+    def clear(self):
+        """
+        Removes all the facts in order to format another file.
+        :return: None
+        """
+        self.table.clear()
+
+    def has_docstring(self, node):
+        """
+        Returns whether the body of a node starts with a non empty docstring.
+        :param node: _ast.Module, _ast.ClassDef or _ast.FunctionDef node.
+        :return: True if ast.get_docstring() finds a docstring, False otherwise.
+        """
+        return self._metadata(node)[0]
+
+    def last_definition(self, node):
+        """
+        Returns the last function/class definition in the body of a node and whether
+        it is the last statement in the body.
+        :param node: _ast.Module, _ast.ClassDef or _ast.FunctionDef node.
+        :return: Tuple containing the last definition and whether its the last item in
+                 body, (None, None) if the body has no definitions.
+        """
+        return self._metadata(node)[1:3]
+
+    def definition_follows(self, node):
+        """
+        Returns, for each statement in the body of a node, whether the statement is
+        not a definition and the next statement is one.
+        :param node: _ast.Module, _ast.ClassDef or _ast.FunctionDef node.
+        :return: Tuple of booleans, one for each statement.
+        """
+        return self._metadata(node)[3]
+
+    def _metadata(self, node):
+        """
+        Computes the facts of a node and stores them.
+        :param node: _ast.Module, _ast.ClassDef or _ast.FunctionDef node.
+        :return: Tuple, see table.
+        """
+        try:
+            return self.table[node]
+        except KeyError:
+            pass
+        body = node.body
+        is_definition = [isinstance(statement, DEFINITIONS) for statement in body]
+        last_definition = None, None
+        for i in range(len(body) - 1, -1, -1):
+            if is_definition[i]:
+                last_definition = body[i], i + 1 == len(body)
+                break
+        definition_follows = tuple(
+            not is_definition[i] and is_definition[i + 1] for i in range(len(body) - 1)
+        ) + (False,)
+        metadata = self.table[node] = (
+            bool(ast.get_docstring(node)),
+            *last_definition,
+            definition_follows,
+        )
+        return metadata
@@ -0,0 +1,191 @@
+# Ignore file
+import _ast
+
+# Fields of compound statements that contain statements, see _bodies().
+_BODY_FIELDS = ("body", "orelse", "finalbody")
+
+
+def parse_line_ranges(text):
+    """
+    Parses line ranges, e.g. "10-40,120-130", or "7" for a single line.
+    :param text: Comma separated ranges of line numbers, the first line is 1.
+    :return: List of (first line, last line) tuples, both lines are included.
+    """
+    line_ranges = []
+    for item in text.split(","):
+        first, _, last = item.strip().partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if first < 1 or last < first:
+            raise ValueError(f"invalid line range {item}.")
+        line_ranges.append((first, last))
+    return line_ranges
+
+
+def format_units(tree, lines, line_ranges):
+    """
+    Finds the statements that must be formatted in order to format some lines.
+    A statement that overlaps the lines is formatted as a whole, unless it is a
+    compound statement whose header is not covered, in that case only the statements
+    in its bodies that overlap the lines are formatted, and its header is kept as is.
+    Statements that share a line (e.g. "x = 1; y = 2") are formatted together, and so
+    are consecutive top level statements, so the empty lines between them are
+    formatted too.
+    :param tree: The parsed code.
+    :param lines: Lines of the code, including their line endings.
+    :param line_ranges: List of (first line, last line) tuples, see
+                        parse_line_ranges().
+    :return: List of (first line, last line, statements) tuples sorted by line, the
+             lines that the statements span are replaced by their formatted code.
+    """
+    units = _units(tree.body, lines, line_ranges, merge=True)
+    if units is None:
+        # A top level statement is followed by code in its last line, e.g. "x = 1;",
+        # so the whole code is formatted.
+        units = [(1, len(lines), tree.body)]
+    units.sort(key=lambda unit: unit[0])
+    # The empty lines at the start and at the end of the code are removed with the
+    # first and the last statements.
+    if units and units[0][2][0] is tree.body[0]:
+        first, last, statements = units[0]
+        if not "".join(lines[: first - 1]).strip():
+            units[0] = (1, last, statements)
+    if units and units[-1][2][-1] is tree.body[-1]:
+        first, last, statements = units[-1]
+        if not "".join(lines[last:]).strip():
+            units[-1] = (first, len(lines), statements)
+    return units
+
+
+def _units(body, lines, line_ranges, merge=False):
+    """
+    Finds the units of a list of statements, see format_units().
+    :param merge: Format consecutive statements together.
+    :return: List of units, or None if a statement that overlaps the lines cannot be
+             formatted on its own, e.g. a statement in the same line as its header.
+    """
+    units = []
+    # Index of the group that the last unit ends with, if the unit formats whole
+    # groups.
+    merged_group = None
+    for index, group in enumerate(_line_groups(body)):
+        first, last = _first_line(group[0]), group[-1].end_lineno
+        if not _overlaps(first, last, line_ranges):
+            continue
+        if not _starts_line(group[0], lines) or not _ends_line(group[-1], lines):
+            return None
+        statement = group[0]
+        bodies = _bodies(statement) if len(group) == 1 else []
+        if bodies and not _header_overlaps(statement, bodies, lines, line_ranges):
+            body_units = []
+            for statements in bodies:
+                inner_units = _units(statements, lines, line_ranges)
+                if inner_units is None:
+                    break
+                body_units.extend(inner_units)
+            else:
+                units.extend(body_units)
+                merged_group = None
+                continue
+        if _is_elif(statement, lines):
+            # An "elif" cannot be formatted without the "if" that precedes it.
+            return None
+        if merge and merged_group == index - 1:
+            units[-1] = (units[-1][0], last, units[-1][2] + group)
+        else:
+            units.append((first, last, group))
+        merged_group = index
+    return units
+
+
+def _line_groups(body):
+    """
+    Splits a list of statements into groups of statements that share lines.
+    :param body: List of statements.
+    :return: List of lists of statements.
+    """
+    groups = []
+    for statement in body:
+        if groups and groups[-1][-1].end_lineno == _first_line(statement):
+            groups[-1].append(statement)
+        else:
+            groups.append([statement])
+    return groups
+
+
+def _overlaps(first, last, line_ranges):
+    """True if some of the lines from <first> to <last> are in the line ranges."""
+    return any(start <= last and first <= end for start, end in line_ranges)
+
+
+def _header_overlaps(statement, bodies, lines, line_ranges):
+    """
+    True if the line ranges cover code of a compound statement that is not in its
+    bodies, e.g. its header, an else clause or an except clause.
+    :param statement: AST compound statement node.
+    :param bodies: The bodies of the statement, see _bodies().
+    :param lines: Lines of the code.
+    :param line_ranges: List of (first line, last line) tuples.
+    :return: bool
+    """
+    body_lines = set()
+    for statements in bodies:
+        for body_statement in statements:
+            body_lines.update(
+                range(_first_line(body_statement), body_statement.end_lineno + 1)
+            )
+    for number in range(_first_line(statement), statement.end_lineno + 1):
+        if number in body_lines or not _overlaps(number, number, line_ranges):
+            continue
+        code = lines[number - 1].strip()
+        if code and not code.startswith("#"):
+            return True
+    return False
+
+
+def _first_line(statement):
+    """The first line of a statement, including its decorators."""
+    decorators = getattr(statement, "decorator_list", None)
+    if decorators:
+        return min(statement.lineno, decorators[0].lineno)
+    return statement.lineno
+
+
+def _starts_line(statement, lines):
+    """
+    True if only spaces precede a statement in its first line. Note that a statement
+    indented by tabs is not formatted on its own, its indentation would become spaces.
+    """
+    line = lines[_first_line(statement) - 1].encode()
+    return line[: statement.col_offset] == b" " * statement.col_offset
+
+
+def _ends_line(statement, lines):
+    """True if only spaces or a comment follow a statement in its last line."""
+    rest = lines[statement.end_lineno - 1].encode()[statement.end_col_offset :].strip()
+    return not rest or rest.startswith(b"#")
+
+
+def _is_elif(statement, lines):
+    """True if a statement is the "elif" clause of an "if" statement."""
+    line = lines[statement.lineno - 1].encode()
+    return isinstance(statement, _ast.If) and line[statement.col_offset :].startswith(
+        b"elif"
+    )
+
+
+def _bodies(statement):
+    """
+    Returns the lists of statements that a compound statement contains.
+    :param statement: AST statement node.
+    :return: List of lists of statements, empty for simple statements.
+    """
+    bodies = []
+    for field in _BODY_FIELDS:
+        statements = getattr(statement, field, None)
+        if statements:
+            bodies.append(statements)
+    for field in ("handlers", "cases"):
+        for clause in getattr(statement, field, ()):
+            bodies.append(clause.body)
+    return bodies
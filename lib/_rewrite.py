@@ -1,54 +1,169 @@
 # Ignore file
 import ast
 import _ast
+import contextlib
+import hashlib
+import io
+import itertools
 import logging
-import filecmp
 import os
+import sys
+import threading
+import tokenize
+import _cache
+import _ranges
 import _search
+import _serve
+import _skip
+import _stream
+import _trace
+import _write
 from lib import _conf
-from collections import OrderedDict
-from shutil import copyfile
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from _document import Document
+from _emitter import Emitter
 from _exceptions import NoSolutionError
+from _metadata import BodyMetadata, stream_metadata
+from _state import LayoutState
+from _widths import FlatWidths
+
+# Run with --trace to see the formatter's trace on stderr, see _trace.py.
+
+# Number of bytes of source code that are sent to a worker process at once.
+BATCH_SIZE = 64 * 1024
+# Number of jobs (files or batches) per worker that are handed over ahead of the
+# results, see imap_files(). The files are read as they are handed over, so this
+# bounds the code that is held in memory.
+JOBS_AHEAD = 2
+# Number of bytes of formatted code that reformat() keeps for the files whose content
+# is the same as the content of a file found later, see _copy_formatted().
+MAX_KEPT_FORMATTED = 16 * 1024 * 1024
+
+# Layout engines, see Rewrite.layout.
+LEGACY_LAYOUT = "legacy"
+DOCUMENT_LAYOUT = "document"
+LAYOUTS = (LEGACY_LAYOUT, DOCUMENT_LAYOUT)
+
+# Traversal engines, see Rewrite.engine.
+RECURSIVE_ENGINE = "recursive"
+ITERATIVE_ENGINE = "iterative"
+ENGINES = (RECURSIVE_ENGINE, ITERATIVE_ENGINE)
+
+# Configurations that affect the formatted code, see Rewrite.config(). A Config cannot
+# be changed, so it can be shared by threads and used as a dictionary key.
+Config = namedtuple(
+    "Config",
+    (
+        "engine",
+        "layout",
+        "max_line",
+        "multiple_imports",
+        "nested_lines",
+        "space_between_arguments",
+        "vertical_definition_lines",
+    ),
+)
+
+
+class TypeDispatchVisitor(ast.NodeVisitor):
+    """
+    NodeVisitor that finds the visit_<Class> method of a node by its type.
+    The table mapping node types to method names is built once per class, and it is
+    resolved into bound methods once per instance, so visiting a node costs a single
+    dictionary lookup instead of building "visit_" + name and calling getattr().
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Builds the dispatch table of a newly created visitor class.
+        """
+        super().__init_subclass__(**kwargs)
+        cls._visit_methods = {}
+        for name in dir(cls):
+            if not name.startswith("visit_"):
+                continue
+            node_type = getattr(ast, name[len("visit_") :], None)
+            if isinstance(node_type, type) and issubclass(node_type, ast.AST):
+                cls._visit_methods[node_type] = name
+
+    def __init__(self):
+        """
+        Resolves the class's dispatch table into bound methods.
+        """
+        self._dispatch = {
+            node_type: getattr(self, name)
+            for node_type, name in self._visit_methods.items()
+        }
 
-# Remove the following comment to see print log on stdout.
-# To see more detailed logging, change level to logging.DEBUG.
-# logging.getLogger().setLevel(logging.INFO)
 
+class Rewrite(TypeDispatchVisitor):
+    # Names of the configurations that affect the formatted code, see clone().
+    formatting_settings = Config._fields
+    # The equivalent of each ast node and its symbol.
+    ar_ops = {
+        _ast.Add: "+",
+        _ast.Sub: "-",
+        _ast.Mult: "*",
+        _ast.MatMult: "@",
+        _ast.Div: "/",
+        _ast.Mod: "%",
+        _ast.Pow: "**",
+        _ast.LShift: "<<",
+        _ast.RShift: ">>",
+        _ast.BitOr: "|",
+        _ast.BitXor: "^",
+        _ast.BitAnd: "&",
+        _ast.FloorDiv: "//",
+    }
+    # Precedence of the binary operators, the document layout breaks a chain of
+    # operations only between operators of the same precedence.
+    ar_precedence = {
+        _ast.BitOr: 0,
+        _ast.BitXor: 1,
+        _ast.BitAnd: 2,
+        _ast.LShift: 3,
+        _ast.RShift: 3,
+        _ast.Add: 4,
+        _ast.Sub: 4,
+        _ast.Mult: 5,
+        _ast.MatMult: 5,
+        _ast.Div: 5,
+        _ast.Mod: 5,
+        _ast.FloorDiv: 5,
+        _ast.Pow: 6,
+    }
+    unary_ops = {_ast.Not: "not", _ast.Invert: "~", _ast.UAdd: "+", _ast.USub: "-"}
+    compare_ops = {
+        _ast.Eq: "==",
+        _ast.NotEq: "!=",
+        _ast.Lt: "<",
+        _ast.LtE: "<=",
+        _ast.Gt: ">",
+        _ast.GtE: ">=",
+        _ast.Is: "is",
+        _ast.IsNot: "is not",
+        _ast.In: "in",
+        _ast.NotIn: "not in",
+    }
 
-class Rewrite(ast.NodeVisitor):
     def __init__(self):
         """
         Initializes all the object's variables.
         """
+        super().__init__()
         # Allowed file suffixes when using search by directory, the default suffix
         # contains .py suffix only and can be added through the conf.txt file.
         self.allowed_suffixes = []
-        # The equivalent of each ast node and its symbol.
-        self.ar_ops = {
-            _ast.Add: "+",
-            _ast.Sub: "-",
-            _ast.Mult: "*",
-            _ast.MatMult: "@",
-            _ast.Div: "/",
-            _ast.Mod: "%",
-            _ast.Pow: "**",
-            _ast.LShift: "<<",
-            _ast.RShift: ">>",
-            _ast.BitOr: "|",
-            _ast.BitXor: "^",
-            _ast.BitAnd: "&",
-            _ast.FloorDiv: "//",
-        }
+        # Git revision, if set, only the files that changed since the revision are
+        # formatted, see _search.changed_since().
+        self.changed_since = None
         # Path of the configuration file, the default value is conf.txt but can be
         # by using -cfg or --configuration option.
         self.configuration_file = "conf.txt"
         # If check_only is set to True, the software only checks whether the code is
         # properly formatter or not.
         self.check_only = False
-        # Line length.
-        self.current_line_len = 0
-        # Content of the current line.
-        self.current_line = ""
         # If set to True, only one target will be reformatted, otherwise, the system
         # will look for all Python files in directory to reformat.  TODO finish.
         self.direct_file = True
@@ -56,95 +171,389 @@ class Rewrite(ast.NodeVisitor):
         # if provided, the system will search recursively for all the python files
         # in the directory and its sub-directories.
         self.directory = None
-        # Is this the first node that is part of a long node.
-        self.first_long_node = False  # TODO name is not clear, choose better wording.
-        # List containing all the python files that needs to be reformatted.
-        # Note that this list will be used only when using --directory argument.
+        # Glob patterns of the files and directories that are not searched, in addition
+        # to _search.DEFAULT_EXCLUDES, see _search.FileFilter.
+        self.exclude = []
+        # Name of the traversal engine, see engine.
+        self.engine = RECURSIVE_ENGINE
+        # Maximum size of a formatted file in bytes, larger files are skipped without
+        # being read, None for no limit.
+        self.max_file_size = None
+        # If set to True, the run stops at the first file that must change, and the
+        # files are handled from the most recently modified, see reformat().
+        self.fail_fast = False
+        # Number of processes used to format the files, see map_files().
+        self.jobs = os.cpu_count() or 1
+        # Name of the layout engine, it also sets the emitter, see layout.
+        self.layout = LEGACY_LAYOUT
+        # Widths of the nodes that start a line, used to find long lines before they
+        # are printed, see _visit_body_node().
+        self.flat_widths = FlatWidths(self)
+        # Docstrings, last definitions and definition neighbours of the bodies, see
+        # visit_Module(), visit_FunctionDef() and visit_ClassDef().
+        self.body_metadata = BodyMetadata()
+        # Strings marking generated files, these files are not formatted, see
+        # _skip.SkipPolicy.
+        self.generated_markers = []
+        # Glob patterns of files that are searched in addition to the files with the
+        # allowed suffixes, see _search.FileFilter.
+        self.include = []
+        # Iterable of all the python files that needs to be reformatted, the files of a
+        # directory are found lazily, see _search.walk().
         self.files = []
-        # Space indentation in any given moment.
-        self.indentation = 0
-        # True if the system is starting a new line, False otherwise.
-        self.in_new_line = True
-        # List which holds data about the nested body of a function, each item in the
-        # list contains a tuple, the first value stores the node of the function, and
-        # the second value holds a boolean value which indicates whether the nested
-        # function is the last item in the body.
-        # Note that in case of a function which does not include any nested function
-        # declaration, the list will hold a tuple containing None values (None, None).
-        self.last_body_node = []
-        # True if the system is handling the last node in Module, False otherwise.
-        self.last_node = False
-        # True if the the system is handling the last node in a class body, False
-        # otherwise.
-        self.latest_class = False
-        # Are we managing a node that exceeds the limit.
-        self.long_node = False
+        # If set to True, changed files are flushed to the disk before they replace
+        # the original files.
+        self.fsync = False
+        # If set to True, files that are known to be formatted are skipped, see
+        # _cache.Cache.
+        self.use_cache = True
         # Max line length, default value is 88 according to PEP8.
         self.max_line = 88
         # Allow importing multiples modules in a single line
         self.multiple_imports = False
         # Number of empty lines between nested function/class definitions
         self.nested_lines = 1
-        # Scope level that indicates the indentation/nested levels.
-        # The starting value is zero which translates to global scope, with each new
-        # scope, the value will be incremented later decremented when the scope ends.
-        self.nested_scope = 0
+        # State of the file that is being formatted, see cleanup().
+        self.state = LayoutState()
         # Print spaces between arguments with default values/keywords and their values
         # if set to True, otherwise, the equal sign will be right next the keyword and
         # the value.
         self.space_between_arguments = False
-        # Latest node that starts a line (in body/function/class).
-        self.starting_new_line_node = None
         # The path of the file to be formatter.
         # Note that target_file will be empty if and only if direct_file is also set to
         # True.
         self.target_file = ""
+        # Path of the Unix socket of the formatter daemon, if set, the formatter
+        # serves requests instead of formatting files, see _serve.py.
+        self.serve_socket = None
+        # If set to True, the code is read from stdin and the formatted code is written
+        # to stdout, see format_stdin().
+        self.stdin = False
+        # If set to True, the code read from stdin is formatted statement by statement
+        # while it is read, see format_stream().
+        self.stream = False
+        # Name of the file whose code is read from stdin, used for the suffixes and in
+        # error messages.
+        self.stdin_filename = "<stdin>"
+        # List of (first line, last line) tuples, if set, only the statements that
+        # overlap these lines are formatted, see format_ranges().
+        self.line_ranges = None
+        # Number of threads listing the directories concurrently, if greater than one,
+        # see _search.walk_concurrently().
+        self.search_threads = 1
+        # Number of threads used to format the files concurrently, see map_files().
+        self.threads = 1
         # Number of empty lines between class/function definitions
         self.vertical_definition_lines = 2
 
+    @property
+    def engine(self):
+        """
+        Name of the traversal engine, one of ENGINES.
+        The recursive engine calls visit() for each child of a node, so the depth of
+        the trees that it can format is limited by the recursion limit. The iterative
+        engine visits the tree with an explicit stack, see _visit_iteratively().
+        """
+        return self._engine
+
+    @engine.setter
+    def engine(self, value):
+        if value not in ENGINES:
+            raise ValueError(f"unknown engine {value}.")
+        self._engine = value
+
+    @property
+    def layout(self):
+        """
+        Name of the layout engine, one of LAYOUTS.
+        The legacy engine writes the code to an Emitter, and when a line exceeds the
+        maximum line length, the line is formatted again in its long form, see
+        check_line(). The document engine writes the code to a _document.Document, the
+        visitors only mark the groups and the places where a line may be broken, and
+        the lines are broken once the whole file was visited.
+        """
+        return self._layout
+
+    @layout.setter
+    def layout(self, value):
+        if value not in LAYOUTS:
+            raise ValueError(f"unknown layout {value}.")
+        self._layout = value
+        # Collects the formatted code, it also holds the current line and indentation.
+        self.emitter = Document() if value == DOCUMENT_LAYOUT else Emitter()
+
+    def clone(self):
+        """
+        Creates a new formatter with the same formatting configurations.
+        A formatter keeps the state of the file it is formatting, therefore, formatting
+        files concurrently requires a formatter for each thread.
+        :return: Rewrite object.
+        """
+        return self.from_settings(self.settings())
+
+    def settings(self):
+        """
+        Returns the configurations that affect the formatted code.
+        :return: Dictionary mapping each name of formatting_settings to its value.
+        """
+        return {name: getattr(self, name) for name in self.formatting_settings}
+
+    def config(self):
+        """
+        Returns the configurations that affect the formatted code as an immutable
+        object.
+        :return: Config object.
+        """
+        return Config(**self.settings())
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Creates a new formatter.
+        :param settings: Formatting configurations, see settings().
+        :return: Rewrite object.
+        """
+        formatter = cls()
+        for name, value in settings.items():
+            setattr(formatter, name, value)
+        return formatter
+
+    def format_source(self, source, filename="<unknown>", line_ranges=None):
+        """
+        Formats Python source code.
+        :param source: The source code.
+        :param filename: Name of the file, used in error messages.
+        :param line_ranges: If given, only the statements that overlap these lines are
+                            formatted, see format_ranges().
+        :return: The formatted code.
+        """
+        # Parse the python code and extract the AST.
+        parsed = ast.parse(source, filename)
+        if line_ranges is not None:
+            return self.format_ranges(source, parsed, line_ranges, filename)
+        if self._layout == DOCUMENT_LAYOUT:
+            # The document is laid out when the formatted code is requested.
+            self.emitter.max_line = self.max_line
+        try:
+            # Rewrite the code by using the AST.
+            self.visit(parsed)
+            return self.emitter.getvalue()
+        # Recursion Error usually happens when the system fails to format the file.
+        # An example of this would be a maximum line length that exceeds an
+        # identifier's name.
+        except RecursionError:
+            raise _no_solution_error(filename)
+        finally:
+            # Reset all the object's attributes to their default value.
+            self.cleanup()
+
+    def format_ranges(self, source, parsed, line_ranges, filename="<unknown>"):
+        """
+        Formats the statements that overlap some lines, the rest of the code is copied
+        as is, see _ranges.format_units().
+        :param source: The source code.
+        :param parsed: The parsed source code.
+        :param line_ranges: List of (first line, last line) tuples.
+        :param filename: Name of the file, used in error messages.
+        :return: The code, with the statements formatted.
+        """
+        # Note that the line endings are kept, and that only the line endings that
+        # Python recognizes split lines.
+        lines = io.StringIO(source, newline="").readlines()
+        # The formatted statements end their lines as the first line of the source
+        # code does, so the line endings of a file are not mixed.
+        newline = lines[0][len(lines[0].rstrip("\r\n")) :] if lines else ""
+        pieces = []
+        position = 0
+        for first, last, statements in _ranges.format_units(parsed, lines, line_ranges):
+            pieces.extend(lines[position : first - 1])
+            if self._layout == DOCUMENT_LAYOUT:
+                self.emitter.max_line = self.max_line
+            try:
+                # The statements keep their indentation, see _ranges._starts_line().
+                self.emitter.indentation = statements[0].col_offset
+                self.visit(ast.Module(body=statements, type_ignores=[]))
+                formatted = self.emitter.getvalue()
+                if newline and newline != "\n":
+                    formatted = formatted.replace("\n", newline)
+                pieces.append(formatted)
+            except RecursionError:
+                raise _no_solution_error(filename)
+            finally:
+                self.cleanup()
+            position = last
+        pieces.extend(lines[position:])
+        return "".join(pieces)
+
+    def format_stream(self, readline, write, filename="<unknown>"):
+        """
+        Formats Python source code one top level statement at a time, while the code is
+        being read. Each statement is parsed when it is reached, and its formatted code
+        is handed over as soon as the statement is formatted, so the memory in use
+        depends on the largest statement rather than on the size of the code.
+        The formatted code is the same as the code returned by format_source().
+        :param readline: Function returning the next line of the code, "" at the end.
+        :param write: Function receiving the formatted code, piece by piece.
+        :param filename: Name of the file, used in error messages.
+        :return: None
+        """
+        statements = _stream.parse_statements(readline, filename)
+        self._format_statements(statements, write, filename)
+
+    def check_source(self, source, filename="<unknown>"):
+        """
+        Checks whether formatting Python source code changes it, without formatting
+        all of it when it does: the formatted code of each top level statement is
+        compared with the source code as soon as the statement is formatted, and the
+        formatting stops at the first difference.
+        :param source: The source code.
+        :param filename: Name of the file, used in error messages.
+        :return: True if the formatted code differs from the source code.
+        """
+        statements = ast.parse(source, filename).body
+        sink = _ComparingSink(source)
+        try:
+            self._format_statements(statements, sink.write, filename)
+        except _Mismatch:
+            return True
+        return not sink.finished()
+
+    def _format_statements(self, statements, write, filename):
+        """
+        Formats top level statements, the formatted code is handed over statement by
+        statement, see format_stream().
+        :param statements: Iterable of top level statement nodes.
+        :param write: Function receiving the formatted code, piece by piece.
+        :param filename: Name of the file, used in error messages.
+        :return: None
+        """
+        if self._layout == DOCUMENT_LAYOUT:
+            self.emitter.max_line = self.max_line
+
+        def flush():
+            self.emitter.flush(write)
+            # Nothing refers to the statements that were formatted anymore.
+            self.flat_widths.clear()
+            self.body_metadata.clear()
+
+        try:
+            children = self._visit_module_body(stream_metadata(statements), flush)
+            for child, new_line in children:
+                self.visit(child, new_line)
+            flush()
+        except RecursionError:
+            raise _no_solution_error(filename)
+        finally:
+            self.cleanup()
+
     def __enter__(self):
         """
         Called when starting a nested scope, e.g. Functions body.
         Note that this function is called automatically when using "with" statement.
         """
-        logging.info(f"Start indentation = {self.indentation + 4}")
+        if _trace.enabled:
+            logging.info(f"Start indentation = {self.emitter.indentation + 4}")
         self.change_indentation(4)
-        self.nested_scope += 1
+        self.state.nested_scope += 1
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
         Called to close a scope, e.g. the end of a functions body.
         Note that this function is called automatically when using "with" statement.
         """
-        logging.info(f"Close indentation = {self.indentation - 4}")
+        if _trace.enabled:
+            logging.info(f"Close indentation = {self.emitter.indentation - 4}")
         self.change_indentation(-4)
-        self.nested_scope -= 1
+        self.state.nested_scope -= 1
 
     def visit(self, node, new_line=True):
         """
         Visit a node, this overrides NodeVisitor visit method as we need to
         start a new line between each body element.
-        """
-        method = "visit_" + node.__class__.__name__
+        A visitor that visits the children of its node is a generator, it yields a
+        (child, new_line) tuple for each child, and it is resumed once the child was
+        visited. The recursive engine visits each child by calling visit() again, the
+        iterative engine keeps the visitors on an explicit stack instead, see
+        _visit_iteratively().
+        """
+        if self._engine == ITERATIVE_ENGINE:
+            self._visit_iteratively(node, new_line)
+            return
         # Get the visit_Class method, if not found, return generic_visit() method.
-        visitor = getattr(self, method, self.generic_visit)
-        logging.info(f"in visit(), visitor={visitor.__name__}")
-        # Call the visitor function
-        visitor_ = visitor(node)
+        visitor = self._dispatch.get(type(node), self.generic_visit)
+        if _trace.enabled:
+            logging.info(f"in visit(), visitor={visitor.__name__}")
+        # Call the visitor function, and visit the children that it requests.
+        children = visitor(node)
+        if children is not None:
+            try:
+                for child, child_new_line in children:
+                    self.visit(child, child_new_line)
+            except BaseException:
+                # Close the visitor now rather than when it is garbage collected, so
+                # its scopes (e.g. "with self") do not change the next file.
+                children.close()
+                raise
         if new_line and not isinstance(node, ast.Module):
             self.new_line()
-        return visitor_
+
+    def _visit_iteratively(self, node, new_line=True):
+        """
+        Visits a node without recursion, no matter how deep the tree is.
+        Each visitor that is visiting children is kept on a work stack with the node
+        that it visits. Entering a node calls its visitor, and if the visitor is a
+        generator, it is pushed to the stack. Exiting a node, once its visitor returned
+        or was exhausted, starts a new line if it was requested.
+        :param node: AST node.
+        :param new_line: Start a new line after the node.
+        :return: None
+        """
+        dispatch = self._dispatch
+        generic_visit = self.generic_visit
+        # Stack of (children, node, new_line) tuples, children is the generator of the
+        # visitor of the node.
+        stack = []
+        try:
+            while True:
+                # Enter the node.
+                visitor = dispatch.get(type(node), generic_visit)
+                if _trace.enabled:
+                    logging.info(f"in visit(), visitor={visitor.__name__}")
+                children = visitor(node)
+                if children is not None:
+                    stack.append((children, node, new_line))
+                elif new_line and not isinstance(node, ast.Module):
+                    self.new_line()
+                # Find the next node, exiting the nodes whose visitors are exhausted.
+                while stack:
+                    children, parent, parent_new_line = stack[-1]
+                    child = next(children, None)
+                    if child is not None:
+                        node, new_line = child
+                        break
+                    stack.pop()
+                    if parent_new_line and not isinstance(parent, ast.Module):
+                        self.new_line()
+                else:
+                    return
+        except BaseException:
+            # Close the visitors from the innermost one, as the recursive engine would
+            # unwind them, so their scopes (e.g. "with self") are closed in order.
+            for children, _, _ in reversed(stack):
+                children.close()
+            raise
 
     def generic_visit(self, node):
         """Called if no explicit visitor function exists for a node."""
-        logging.info(f"in generic_visit(), node={type(node).__name__}")
+        if _trace.enabled:
+            logging.info(f"in generic_visit(), node={type(node).__name__}")
         for field, value in ast.iter_fields(node):
             if isinstance(value, _ast.AST):
-                self.visit(value, False)
+                yield value, False
             elif isinstance(value, list):
                 for item in value:
                     if isinstance(item, _ast.AST):
-                        self.visit(item, False)
+                        yield item, False
 
     def visit_Expr(self, node):
         """
@@ -156,57 +565,58 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Expr Node
         :return: None
         """
-        for field, value in ast.iter_fields(node):
-            if isinstance(value, _ast.AST):
-                value.exceeds_maximum_length = node.exceeds_maximum_length
-                self.visit(value, False)
-                value.exceeds_maximum_length = False
-            elif isinstance(value, list):
-                for item in value:
-                    if isinstance(item, _ast.AST):
-                        value.exceeds_maximum_length = node.exceeds_maximum_length
-                        self.visit(item, False)
-                        value.exceeds_maximum_length = False
+        # The expression exceeds the maximum line length if the statement does.
+        if node in self.state.exceeding_nodes:
+            self.state.exceeding_nodes.add(node.value)
+        yield node.value, False
+        self.state.exceeding_nodes.discard(node.value)
 
-    def _prepare_line(self, value, _new_line, _is_iterable, _special_attribute):
+    @staticmethod
+    def string_literal(value):
+        """
+        Returns the code of a string.
+        The string is put between double quotes, or single quotes if it contains double
+        quotes. Backslashes, the quote and the characters that are not printable (e.g.
+        new lines) are escaped, so the string is printed in a single line.
+        :param value: The string.
+        :return: The code of the string, including its quotes.
+        """
+        quote = '"' if '"' not in value else "'"
+        if value.isprintable() and "\\" not in value and quote not in value:
+            return f"{quote}{value}{quote}"
+        characters = []
+        for character in value:
+            if character == "\\" or character == quote:
+                characters.append("\\" + character)
+            elif character.isprintable():
+                characters.append(character)
+            else:
+                # The escape sequence of the character, e.g. \n or \x00.
+                characters.append(repr(character)[1:-1])
+        return f"{quote}{''.join(characters)}{quote}"
+
+    @staticmethod
+    def _prepare_line(value, _is_iterable, _special_attribute):
         """
-        Prepares a line to be printed.
+        Prepares the text to be printed.
         :param value: Value required to print.
-        :param _new_line: End line with a \n.
         :param _is_iterable: Is the value iterable (list, tuple, etc...).
         :param _special_attribute: Special attribute that we need to print instead of value.
-        :return: None.
+        :return: The text to be printed.
         """
-        to_print = ""
-        if _new_line and not value:
-            # Finish current line or start a new one.
-            to_print = "\n"
-            self.in_new_line = True
-            return to_print
-        if self.in_new_line:
-            to_print = " " * self.indentation
-            self.in_new_line = False
         if _is_iterable:
             assert hasattr(value, "__iter__")  # Make sure the item is iterable.
-            iterable_size = len(value)
-            for i, item in enumerate(value):
-                to_print += (
-                    str(item)
-                    if not _special_attribute
-                    else f"{getattr(item, _special_attribute)}"
-                )
-                if i + 1 != iterable_size:
-                    to_print += ", "
-        else:
-            to_print += (
-                f"{value}"
+            return ", ".join(
+                str(item)
                 if not _special_attribute
-                else f"{getattr(value, _special_attribute)}"
+                else f"{getattr(item, _special_attribute)}"
+                for item in value
             )
-        if _new_line:
-            to_print += "\n"
-            self.in_new_line = True
-        return to_print
+        return (
+            f"{value}"
+            if not _special_attribute
+            else f"{getattr(value, _special_attribute)}"
+        )
 
     def print(
         self,
@@ -215,7 +625,6 @@ class Rewrite(ast.NodeVisitor):
         _new_line=False,
         _is_iterable=False,
         _special_attribute=None,
-        _use_visit=False,
     ):
         """
         outputs required value to target file.
@@ -223,32 +632,42 @@ class Rewrite(ast.NodeVisitor):
         :param _new_line: End line with a \n.
         :param _is_iterable: Is the value iterable (list, tuple, etc...).
         :param _special_attribute: Special attribute that we need to print instead of value.
-        :param _use_visit: should item be printed directly or use visit_class() method.
         :return: None.
         """
-        if not _use_visit:
-            to_print = self._prepare_line(
-                value, _new_line, _is_iterable, _special_attribute
-            )
-            logging.debug(f"in print(), to_print='{to_print}'")
-            self.current_line_len += len(to_print)
-            self.current_line += to_print
+        emitter = self.emitter
+        # An empty value that ends the line only finishes the current line or
+        # prints an empty line.
+        if not (_new_line and not value):
+            to_print = self._prepare_line(value, _is_iterable, _special_attribute)
+            if _trace.enabled:
+                logging.debug(f"in print(), to_print='{to_print}'")
+            emitter.write(to_print)
+        if _trace.enabled:
             logging.debug(
-                f"current line={self.current_line}, line length={self.current_line_len}"
+                f"current line={emitter.current_line}, "
+                f"line length={emitter.line_length}"
             )
-            if _new_line and self.current_line_len <= self.max_line:
-                file.write(self.current_line)
-                self.current_line_len = 0
-                self.current_line = ""
-            elif _new_line:  # Exceeded line limitation
-                # TODO: Handle writing long lines properly
-                self.check_line()
-
-        elif _is_iterable and _use_visit:
-            for i, item in enumerate(value):
-                self.visit(item, new_line=False)
-                if i + 1 != len(value):
-                    self.print(", ")
+        # Note that the length of a line includes its terminating new line, and
+        # that the document layout breaks long lines by itself.
+        if _new_line and (
+            self._layout == DOCUMENT_LAYOUT
+            or emitter.line_length + 1 <= self.max_line
+        ):
+            emitter.newline()
+        elif _new_line:  # Exceeded line limitation
+            # TODO: Handle writing long lines properly
+            self.check_line()
+
+    def _visit_elements(self, elements):
+        """
+        Visits a comma separated list of nodes, e.g. the elements of a list.
+        :param elements: List of nodes.
+        :return: Generator of the nodes to visit, see visit().
+        """
+        for i, element in enumerate(elements):
+            yield element, False
+            if i + 1 != len(elements):
+                self.print(", ")
 
     def check_line(self):
         """
@@ -256,36 +675,110 @@ class Rewrite(ast.NodeVisitor):
         variables to start a new line and calls the main node that starts the line.
         If the node supports checking for long lines, it will be handled well, the
         program will go into an endless recursion.
+        Everything that was printed since the node started is removed first, so only
+        the statement that contains the long line is printed again.
+        The line is finished even if the node has no long form (e.g. an assignment),
+        the line is then kept as is.
         :return: None
         """
-        if self.current_line_len > self.max_line:
+        if (
+            self._layout == LEGACY_LAYOUT
+            and self.emitter.line_length + 1 > self.max_line
+        ):
             logging.warning("Line exceeded limit")
             self._init_values_for_long_line()
-            self.visit(self.starting_new_line_node, new_line=False)
-            self.starting_new_line_node.exceeds_maximum_length = False
-            self.long_node = False
+            self.visit(self.state.starting_new_line_node, new_line=False)
+            self.state.exceeding_nodes.discard(self.state.starting_new_line_node)
+            self.state.long_node = False
+            if not self.emitter.in_new_line:
+                self.emitter.newline()
+
+    def _visit_body_node(self, node, new_line=True):
+        """
+        Visits a node that starts a line, i.e. the starting_new_line_node.
+        If the node is known to exceed the maximum line length, its long form is
+        printed right away, as check_line() would do after printing the line and
+        finding that it is too long.
+        :param node: AST node.
+        :param new_line: Start a new line after the node.
+        :return: None
+        """
+        emitter = self.emitter
+        self.state.starting_new_line_node = node
+        self.state.starting_new_line_checkpoint = emitter.checkpoint()
+        if (
+            new_line
+            and self._layout == LEGACY_LAYOUT
+            and not self.state.long_node
+            and emitter.in_new_line
+        ):
+            # Statements that are short in the source code are not measured, the
+            # formatted code is rarely twice as long, and if it is, check_line()
+            # still finds the long line.
+            if (
+                node.lineno == node.end_lineno
+                and emitter.indentation + 2 * (node.end_col_offset - node.col_offset)
+                < self.max_line
+            ):
+                width = None
+            else:
+                width = self.flat_widths.width(node)
+            if width is not None and emitter.indentation + width + 1 > self.max_line:
+                logging.warning("Line exceeded limit")
+                self._init_values_for_long_line()
+                yield node, False
+                self.state.exceeding_nodes.discard(node)
+                self.state.long_node = False
+                # The long form finishes its line, unless the node has none, as
+                # check_line() does.
+                if not emitter.in_new_line:
+                    emitter.newline()
+                return
+        yield node, new_line
 
     def new_line(self, num=1):
         """Prints <num> new line(s)"""
-        logging.debug(f"printing {num} new line")
+        if _trace.enabled:
+            logging.debug(f"printing {num} new line")
         [self.print("", _new_line=True) for _ in range(num)]
 
     def visit_Module(self, node):
-        logging.info("in visit_Module")
-        for i, body_node in enumerate(node.body):
-            self.starting_new_line_node = body_node
-            if i == 0 and ast.get_docstring(node):  # Docstring
+        if _trace.enabled:
+            logging.info("in visit_Module")
+        has_docstring = self.body_metadata.has_docstring(node)
+        definition_follows = self.body_metadata.definition_follows(node)
+        yield from self._visit_module_body(
+            (
+                body_node,
+                i == 0 and has_docstring,
+                i + 1 == len(node.body),
+                definition_follows[i],
+            )
+            for i, body_node in enumerate(node.body)
+        )
+
+    def _visit_module_body(self, statements, flush=None):
+        """
+        Visits the top level statements of a module.
+        :param statements: Iterable of (statement, is docstring, is last statement,
+                           definition follows) tuples, see BodyMetadata.
+        :param flush: Function called before each statement, once the code that
+                      precedes the statement is finished, see format_stream().
+        :return: None
+        """
+        for body_node, is_docstring, is_last, definition_follows in statements:
+            if flush is not None:
+                flush()
+            if is_docstring:  # Docstring
+                self.state.starting_new_line_node = body_node
+                self.state.starting_new_line_checkpoint = self.emitter.checkpoint()
                 self.visit_Constant(body_node.value, is_docstring=True)
             else:
-                if i + 1 == len(node.body):
+                if is_last:
                     # Mark the last node in module.
-                    self.last_node = True
-                self.visit(body_node)
-            if (
-                i + 1 != len(node.body)
-                and not isinstance(node.body[i], (_ast.FunctionDef, _ast.ClassDef))
-                and isinstance(node.body[i + 1], (_ast.FunctionDef, _ast.ClassDef))
-            ):
+                    self.state.last_node = True
+                yield from self._visit_body_node(body_node)
+            if definition_follows:
                 # If the current node is not a definition node and the next node is a
                 # definition node, add <vertical_definition_lines> empty lines.
                 self.new_line(self.vertical_definition_lines)
@@ -296,7 +789,8 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Import node.
         :return: None
         """
-        logging.info(f"in visit_Import")
+        if _trace.enabled:
+            logging.info(f"in visit_Import")
         imports_list = node.names
         if self.multiple_imports:
             self.print("import ")
@@ -319,7 +813,8 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.ImportFrom node
         :return: None
         """
-        logging.info(f"in visit_ImportFrom")
+        if _trace.enabled:
+            logging.info(f"in visit_ImportFrom")
         import_list = node.names
         # Note that if the user wrote multiple import from statements using the same
         # library more than once, these import from lines won't be joined together as
@@ -334,14 +829,14 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.UnaryOp node.
         :return: None
         """
-        ops = {_ast.Not: "not", ast.Invert: "~", ast.UAdd: "+", ast.USub: "-"}
-        op = ops[type(node.op)]
-        logging.info(f"in visit_UnaryOp, op={op}, operand={node.operand}")
+        op = self.unary_ops[type(node.op)]
+        if _trace.enabled:
+            logging.info(f"in visit_UnaryOp, op={op}, operand={node.operand}")
 
         self.print(f"{op}")
         if isinstance(node.op, _ast.Not):
             self.print(" ")
-        self.visit(node.operand, False)
+        yield node.operand, False
 
     def visit_BinOp(self, node):
         """
@@ -349,30 +844,47 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.BinOp node.
         :return: None.
         """
-        logging.info(
-            f"in visit_BinOp, left={type(node.left).__name__}, "
-            f"op={self.ar_ops[type(node.op)]}, right={type(node.right).__name__}"
-        )
+        if _trace.enabled:
+            logging.info(
+                f"in visit_BinOp, left={type(node.left).__name__}, "
+                f"op={self.ar_ops[type(node.op)]}, right={type(node.right).__name__}"
+            )
+        if self._layout == DOCUMENT_LAYOUT:
+            # Collect the chain of operations, e.g. a + b - c, without recursion.
+            precedence = self.ar_precedence[type(node.op)]
+            operands = []
+            operators = []
+            while (
+                isinstance(node, _ast.BinOp)
+                and self.ar_precedence[type(node.op)] == precedence
+            ):
+                operands.append(node.right)
+                operators.append(self.ar_ops[type(node.op)])
+                node = node.left
+            operands.append(node)
+            yield from self._print_operations(operands[::-1], operators[::-1])
+            return
         first_recursive = False
-        if self.long_node:
+        if self.state.long_node:
             # If the line length, print each operator in a new line.
-            if self.first_long_node:  # Starting node of the sequence of inner nodes.
+            # Starting node of the sequence of inner nodes.
+            if self.state.first_long_node:
                 self.print("(", _new_line=True)
-                self.first_long_node = False
+                self.state.first_long_node = False
                 self.change_indentation(4)
                 first_recursive = True
-            self.visit(node.left, new_line=False)
+            yield node.left, False
             self.new_line()
             self.print(f"{self.ar_ops[type(node.op)]} ")
-            self.visit(node.right, new_line=False)
+            yield node.right, False
             if first_recursive:
                 self.change_indentation(-4)
                 self.new_line()
                 self.print(")", _new_line=True)
             return
-        self.visit(node.left, False)
+        yield node.left, False
         self.print(f" {self.ar_ops[type(node.op)]} ")
-        self.visit(node.right, False)
+        yield node.right, False
 
     def visit_AugAssign(self, node):
         """
@@ -380,12 +892,14 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.AugAssign node
         :return: None
         """
-        logging.info(
-            f"in visit_AugAssign, target={node.target} op={self.ar_ops[type(node.op)]}, value={node.value}"
-        )
-        self.visit(node.target, new_line=False)
+        if _trace.enabled:
+            logging.info(
+                f"in visit_AugAssign, target={node.target} "
+                f"op={self.ar_ops[type(node.op)]}, value={node.value}"
+            )
+        yield node.target, False
         self.print(f" {self.ar_ops[type(node.op)]}= ")
-        self.visit(node.value, new_line=False)
+        yield node.value, False
 
     def visit_Constant(self, node, is_docstring=False):
         """
@@ -396,23 +910,19 @@ class Rewrite(ast.NodeVisitor):
         :param is_docstring: True if the constant is a docstring false otherwise.
         :return: None
         """
-        if is_docstring:
-            logging.info(f"in visit_Constant, visiting docstring")
-        else:
-            logging.info(f"in visit_Constant, value={node.value}")
+        if _trace.enabled:
+            if is_docstring:
+                logging.info(f"in visit_Constant, visiting docstring")
+            else:
+                logging.info(f"in visit_Constant, value={node.value}")
         if isinstance(node.value, str) and not is_docstring:
-            # If the constant is a string, add quotes as a prefix.
-            # If the code contains double quotes, use single quotes.
-            self.print('"' if '"' not in node.value else "'")
-        elif is_docstring:
+            self.print(self.string_literal(node.value))
+            return
+        if is_docstring:
             # If the constant is a docstring, add triple quotes as a prefix.
             self.print('"""')
         self.print(node.value)
-        if isinstance(node.value, str) and not is_docstring:
-            # If the constant is a string, add quotes as a suffix.
-            # If the code contains double quotes, use single quotes.
-            self.print('"' if '"' not in node.value else "'")
-        elif is_docstring:
+        if is_docstring:
             # If the constant is a docstring, add triple quotes as a suffix.
             self.print('"""')
             self.new_line()
@@ -423,7 +933,8 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Name.
         :return: None.
         """
-        logging.info(f"in visit_Name, node.id={node.id}")
+        if _trace.enabled:
+            logging.info(f"in visit_Name, node.id={node.id}")
         self.print(node.id)
 
     def visit_Continue(self, node):
@@ -432,7 +943,8 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Continue.
         :return: None.
         """
-        logging.info(f"in visit_Continue")
+        if _trace.enabled:
+            logging.info(f"in visit_Continue")
         self.print("continue")
 
     def visit_Break(self, node):
@@ -441,7 +953,8 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Break.
         :return: None.
         """
-        logging.info(f"in visit_Break")
+        if _trace.enabled:
+            logging.info(f"in visit_Break")
         self.print("break")
 
     def visit_Delete(self, node):
@@ -450,10 +963,11 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Delete.
         :return: None
         """
-        logging.info(f"in visit_Delete")
+        if _trace.enabled:
+            logging.info(f"in visit_Delete")
         self.print("del ")
         for i, target in enumerate(node.targets):
-            self.visit(target, new_line=False)
+            yield target, False
             if i + 1 != len(node.targets):
                 self.print(", ")
 
@@ -465,9 +979,17 @@ class Rewrite(ast.NodeVisitor):
         """
         assert type(node.op) in [_ast.And, _ast.Or]
         op = "and" if isinstance(node.op, _ast.And) else "or"
-        logging.info(f"in visit_BoolOp, op={op}, number_of_values={len(node.values)}")
+        if _trace.enabled:
+            logging.info(
+                f"in visit_BoolOp, op={op}, number_of_values={len(node.values)}"
+            )
+        if self._layout == DOCUMENT_LAYOUT:
+            yield from self._print_operations(
+                node.values, [op] * (len(node.values) - 1)
+            )
+            return
         for i, value in enumerate(node.values):
-            self.visit(value, new_line=False)
+            yield value, False
             if i + 1 != len(node.values):
                 self.print(f" {op} ")
 
@@ -477,9 +999,13 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.List.
         :return: None
         """
-        logging.info(f"in visit_List")
+        if _trace.enabled:
+            logging.info(f"in visit_List")
+        if self._layout == DOCUMENT_LAYOUT:
+            yield from self._print_group("[", node.elts, "]")
+            return
         self.print("[")
-        self.print(node.elts, _is_iterable=True, _use_visit=True)
+        yield from self._visit_elements(node.elts)
         self.print("]")
 
     def visit_Set(self, node):
@@ -488,9 +1014,13 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Set.
         :return: None
         """
-        logging.info(f"in visit_Set")
+        if _trace.enabled:
+            logging.info(f"in visit_Set")
+        if self._layout == DOCUMENT_LAYOUT:
+            yield from self._print_group("{", node.elts, "}")
+            return
         self.print("{")
-        self.print(node.elts, _is_iterable=True, _use_visit=True)
+        yield from self._visit_elements(node.elts)
         self.print("}")
 
     def visit_Dict(self, node):
@@ -499,15 +1029,32 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Dict.
         :return: None
         """
-        logging.info(f"in visit_Dict")
+        if _trace.enabled:
+            logging.info(f"in visit_Dict")
+        if self._layout == DOCUMENT_LAYOUT:
+
+            def print_item(item):
+                key, value = item
+                if key is None:
+                    # Dictionary unpacking, e.g. {**a}.
+                    self.print("**")
+                else:
+                    yield key, False
+                    self.print(": ")
+                yield value, False
+
+            # Unlike the legacy layout, dictionaries that fit in a line are not broken.
+            items = list(zip(node.keys, node.values))
+            yield from self._print_group("{", items, "}", print_element=print_item)
+            return
         self.print("{")
         self.new_line()
         # TODO small dictionaries should not use multiple lines.
         with self:
             for key, value in zip(node.keys, node.values):
-                self.visit(key, new_line=False)
+                yield key, False
                 self.print(": ")
-                self.visit(value, new_line=False)
+                yield value, False
                 self.print(",")
                 self.new_line()
         self.print("}")
@@ -518,9 +1065,19 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Tuple.
         :return: None
         """
-        logging.info(f"in visit_Tuple")
+        if _trace.enabled:
+            logging.info(f"in visit_Tuple")
+        if self._layout == DOCUMENT_LAYOUT:
+            if len(node.elts) == 1:
+                # A tuple with a single element must end with a comma.
+                self.print("(")
+                yield node.elts[0], False
+                self.print(",)")
+            else:
+                yield from self._print_group("(", node.elts, ")")
+            return
         self.print("(")
-        self.print(node.elts, _is_iterable=True, _use_visit=True)
+        yield from self._visit_elements(node.elts)
         self.print(")")
 
     def visit_Pass(self, node):
@@ -529,7 +1086,8 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Pass.
         :return: None
         """
-        logging.info(f"in visit_Pass")
+        if _trace.enabled:
+            logging.info(f"in visit_Pass")
         self.print("pass")
 
     def visit_Return(self, node):
@@ -538,11 +1096,12 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Return.
         :return: None
         """
-        logging.info(f"in visit_Return")
+        if _trace.enabled:
+            logging.info(f"in visit_Return")
         self.print("return")
         if node.value:
             self.print(" ")
-            self.visit(node.value, new_line=False)
+            yield node.value, False
 
     def visit_Global(self, node):
         """
@@ -550,7 +1109,8 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Global.
         :return: None
         """
-        logging.info(f"in visit_Global")
+        if _trace.enabled:
+            logging.info(f"in visit_Global")
         self.print("global ")
         self.print(node.names, _is_iterable=True)
 
@@ -560,7 +1120,8 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Nonlocal.
         :return: None
         """
-        logging.info(f"in visit_Nonlocal")
+        if _trace.enabled:
+            logging.info(f"in visit_Nonlocal")
         self.print("nonlocal ")
         self.print(node.names, _is_iterable=True)
 
@@ -571,11 +1132,12 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.NamedExpr.
         :return: None
         """
-        logging.info(f"in visit_NamedExpr")
+        if _trace.enabled:
+            logging.info(f"in visit_NamedExpr")
         self.print("(")
-        self.visit(node.target, new_line=False)
+        yield node.target, False
         self.print(f" := ")
-        self.visit(node.value, new_line=False)
+        yield node.value, False
         self.print(")")
 
     def visit_Assign(self, node):
@@ -584,11 +1146,12 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Assign.
         :return: None
         """
-        logging.info(f"in visit_Assign")
+        if _trace.enabled:
+            logging.info(f"in visit_Assign")
         for target in node.targets:
-            self.visit(target, False)
+            yield target, False
             self.print(" = ")
-        self.visit(node.value, False)
+        yield node.value, False
 
     def visit_Compare(self, node):
         """
@@ -596,30 +1159,18 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Compare.
         :return: None
         """
-        logging.info(f"in visit_Compare")
-        ops = {
-            _ast.Eq: "==",
-            _ast.NotEq: "!=",
-            _ast.Lt: "<",
-            _ast.LtE: "<=",
-            _ast.Gt: ">",
-            _ast.GtE: ">=",
-            _ast.Is: "is",
-            _ast.IsNot: "is not",
-            _ast.In: "in",
-            _ast.NotIn: "not in",
-        }
-        self.visit(node.left, new_line=False)
+        if _trace.enabled:
+            logging.info(f"in visit_Compare")
+        yield node.left, False
         self.print(" ")
         # Note that node.ops contains the operators as instances of _ast.op_type,
-        # therefor, they must be casted to a string using the previously declared ops
-        # dictionary.
+        # therefor, they must be casted to a string using the compare_ops dictionary.
         # Note that the node.comparators contains the all operands of the comparison
         # except for the first left hand side operand, node.comparators could store
         # multiple operands when using chained comparisons.
         for i, (op, comp) in enumerate(zip(node.ops, node.comparators)):
-            self.print(f"{ops[type(op)]} ")
-            self.visit(comp, new_line=False)
+            self.print(f"{self.compare_ops[type(op)]} ")
+            yield comp, False
             if i + 1 != len(node.ops):
                 self.print(" ")
 
@@ -629,39 +1180,48 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Subscript.
         :return: None
         """
-        logging.info(f"in visit_Subscript")
-        self.visit(node.value, new_line=False)
-        self.visit(node.slice, new_line=False)
+        if _trace.enabled:
+            logging.info(f"in visit_Subscript")
+        yield node.value, False
+        self.print("[")
+        if isinstance(node.slice, _ast.Tuple):
+            # Several indices, e.g. x[1:2, 3], are printed without parentheses since
+            # slices cannot be put in parentheses.
+            yield from self._visit_elements(node.slice.elts)
+            if len(node.slice.elts) == 1:
+                self.print(",")
+        else:
+            yield node.slice, False
+        self.print("]")
 
     def visit_Index(self, node):
         """
-        Implements Indexing.
+        Implements Indexing, the brackets are printed by visit_Subscript().
         :param node: _ast.Index.
         :return: None
         """
-        logging.info(f"in visit_Index")
-        self.print("[")
-        self.visit(node.value, new_line=False)
-        self.print("]")
+        if _trace.enabled:
+            logging.info(f"in visit_Index")
+        yield node.value, False
 
     def visit_Slice(self, node):
         """
         Implements Slicing.
         When slicing, there are three optional options [lower:upper:step].
+        Note that the brackets are printed by visit_Subscript().
         :param node: _ast.Slice.
         :return: None
         """
-        logging.info(f"in visit_Slice")
-        self.print("[")
+        if _trace.enabled:
+            logging.info(f"in visit_Slice")
         if node.lower:
-            self.visit(node.lower, new_line=False)
+            yield node.lower, False
         self.print(":")
         if node.upper:
-            self.visit(node.upper, new_line=False)
+            yield node.upper, False
         if node.step:
             self.print(":")
-            self.visit(node.step, new_line=False)
-        self.print("]")
+            yield node.step, False
 
     def visit_Assert(self, node):
         """
@@ -669,12 +1229,13 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Assert.
         :return: None
         """
-        logging.info(f"in visit_Assert")
+        if _trace.enabled:
+            logging.info(f"in visit_Assert")
         self.print("assert ")
-        self.visit(node.test, new_line=False)
+        yield node.test, False
         if node.msg:
             self.print(", ")
-            self.visit(node.msg, new_line=False)
+            yield node.msg, False
 
     def visit_keyword(self, node):
         """
@@ -682,7 +1243,8 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.keyword.
         :return: None
         """
-        logging.info(f"in visit_keyword")
+        if _trace.enabled:
+            logging.info(f"in visit_keyword")
         if node.arg:
             self.print(
                 f"{node.arg}" + (" = " if self.space_between_arguments else f"=")
@@ -691,7 +1253,7 @@ class Rewrite(ast.NodeVisitor):
             # Keyword argument containing all keyword arguments except for those
             # corresponding to a formal parameter.
             self.print(f"**")
-        self.visit(node.value, new_line=False)
+        yield node.value, False
 
     def visit_Attribute(self, node):
         """
@@ -699,8 +1261,9 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Attribute.
         :return: None
         """
-        logging.info(f"in visit_Attribute")
-        self.visit(node.value, new_line=False)
+        if _trace.enabled:
+            logging.info(f"in visit_Attribute")
+        yield node.value, False
         self.print(".")
         self.print(node.attr)
 
@@ -710,14 +1273,15 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Raise.
         :return: None
         """
-        logging.info(f"in visit_Raise")
+        if _trace.enabled:
+            logging.info(f"in visit_Raise")
         self.print("raise")
         if node.exc:
             self.print(" ")
-            self.visit(node.exc, new_line=False)
+            yield node.exc, False
         if node.cause:
             self.print(" from ")
-            self.visit(node.cause, new_line=False)
+            yield node.cause, False
 
     def visit_Try(self, node):
         """
@@ -725,27 +1289,28 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Try.
         :return: None
         """
-        logging.info(f"in visit_Try")
+        if _trace.enabled:
+            logging.info(f"in visit_Try")
         self.print("try:", _new_line=True)
         with self:
             # Try block
-            self._visit_list(node.body)
+            yield from self._visit_list(node.body)
         for handle in node.handlers:
             # Except handlers
-            self.visit(handle, new_line=False)
+            yield handle, False
         if node.orelse:
             # Handle else statements after except statements
             self.new_line()
             self.print("else:", _new_line=True)
             with self:
                 # Else block
-                self._visit_list(node.orelse)
+                yield from self._visit_list(node.orelse)
         if node.finalbody:
             # Handle finally.
             self.print("finally:", _new_line=True)
             with self:
                 # Finally block.
-                self._visit_list(node.finalbody, _new_line_at_finish=False)
+                yield from self._visit_list(node.finalbody, _new_line_at_finish=False)
 
     def visit_ExceptHandler(self, node):
         """
@@ -753,16 +1318,17 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.ExceptHandler node.
         :return: None
         """
-        logging.info(f"in visit_ExceptHandler")
+        if _trace.enabled:
+            logging.info(f"in visit_ExceptHandler")
         self.print("except")
         if node.type:
             self.print(" ")
-            self.visit(node.type, new_line=False)
+            yield node.type, False
         if node.name:
             self.print(f" as {node.name}")
         self.print(":", _new_line=True)
         with self:
-            self._visit_list(node.body, _new_line_at_finish=False)
+            yield from self._visit_list(node.body, _new_line_at_finish=False)
 
     def visit_Starred(self, node):
         """
@@ -770,9 +1336,10 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Starred node.
         :return: None
         """
-        logging.info(f"in visit_Starred")
+        if _trace.enabled:
+            logging.info(f"in visit_Starred")
         self.print("*")
-        self.visit(node.value, new_line=False)
+        yield node.value, False
 
     def visit_arguments(self, node):
         """
@@ -780,16 +1347,18 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.arguments node.
         :return: None
         """
-        logging.info(f"in visit_arguments")
+        if _trace.enabled:
+            logging.info(f"in visit_arguments")
         # Get all the positional arguments ordered.
         ordered_only_pos, ordered_args = Rewrite._ordered_pos_arg_default(
             node.posonlyargs, node.args, node.defaults
         )
+        exceeding_nodes = self.state.exceeding_nodes
         # When the line length of the arguments exceeds the maximum line length spaces
         # after the commas should not be printed, instead, move to
         # a new line to print the next argument.
-        comma = "," + (" " if not node.exceeds_maximum_length else "")
-        if node.exceeds_maximum_length:
+        comma = "," + (" " if node not in exceeding_nodes else "")
+        if node in exceeding_nodes:
             # Add indentation in case the node exceeds the maximum line length.
             self.__enter__()
             self.new_line()
@@ -797,28 +1366,28 @@ class Rewrite(ast.NodeVisitor):
             self.print(key)
             if value:
                 self.print(" = " if self.space_between_arguments else "=")
-                self.visit(value[0], new_line=False)
+                yield value[0], False
             if i + 1 != len(ordered_only_pos):
-                self.print(comma, _new_line=node.exceeds_maximum_length)
+                self._print_separator(comma, node in exceeding_nodes)
             else:
-                self.print(comma, _new_line=node.exceeds_maximum_length)
-                self.print("/", _new_line=node.exceeds_maximum_length)
+                self._print_separator(comma, node in exceeding_nodes)
+                self.print("/", _new_line=node in exceeding_nodes)
         if ordered_only_pos and (
             ordered_args or node.vararg or node.kwonlyargs or node.kwarg
         ):
-            self.print(comma, _new_line=node.exceeds_maximum_length)
+            self._print_separator(comma, node in exceeding_nodes)
         for i, (key, value) in enumerate(ordered_args.items()):
             self.print(key)
             if value:
                 self.print(" = " if self.space_between_arguments else "=")
-                self.visit(value[0], new_line=False)
+                yield value[0], False
             if (
                 i + 1 != len(ordered_args)
                 or node.vararg
                 or node.kwonlyargs
                 or node.kwarg
             ):
-                self.print(comma, _new_line=node.exceeds_maximum_length)
+                self._print_separator(comma, node in exceeding_nodes)
         if (ordered_args or ordered_only_pos) and (
             node.vararg or node.kwonlyargs or node.kwarg
         ):
@@ -829,23 +1398,23 @@ class Rewrite(ast.NodeVisitor):
             self.print(f"{node.vararg.arg}")
         elif not (ordered_args or ordered_only_pos) and (node.kwonlyargs or node.kwarg):
             self.print("*")
-            self.print(comma, _new_line=node.exceeds_maximum_length)
+            self._print_separator(comma, node in exceeding_nodes)
         if (ordered_args or ordered_only_pos) and (node.kwonlyargs or node.kwarg):
-            self.print(comma, _new_line=node.exceeds_maximum_length)
+            self._print_separator(comma, node in exceeding_nodes)
         for i, item in enumerate(node.kwonlyargs):
             self.print(item.arg)
             if node.kw_defaults:
                 if node.kw_defaults[0] is not None:
                     self.print(" = " if self.space_between_arguments else "=")
-                    self.visit(node.kw_defaults[i], new_line=False)
+                    yield node.kw_defaults[i], False
             if i + 1 != len(node.kwonlyargs):
-                self.print(comma, _new_line=node.exceeds_maximum_length)
+                self._print_separator(comma, node in exceeding_nodes)
         if (
             ordered_args or ordered_only_pos or node.vararg or node.kwonlyargs
         ) and node.kwarg:
-            self.print(comma, _new_line=node.exceeds_maximum_length)
+            self._print_separator(comma, node in exceeding_nodes)
             self.print(f"**{node.kwarg.arg}")
-        if node.exceeds_maximum_length:
+        if node in exceeding_nodes:
             self.__exit__(None, None, None)
 
     def visit_withitem(self, node):
@@ -854,11 +1423,12 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.withitem.
         :return: None
         """
-        logging.info(f"in visit_withitem")
-        self.visit(node.context_expr, new_line=False)
+        if _trace.enabled:
+            logging.info(f"in visit_withitem")
+        yield node.context_expr, False
         if node.optional_vars:
             self.print(" as ")
-            self.visit(node.optional_vars, new_line=False)
+            yield node.optional_vars, False
 
     def visit_With(self, node):
         """
@@ -866,18 +1436,18 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.With.
         :return: None
         """
-        logging.info(f"in visit_With")
+        if _trace.enabled:
+            logging.info(f"in visit_With")
         self.print("with ")
         for i, element in enumerate(node.items):
             # Visit with items.
-            self.visit(element, new_line=False)
+            yield element, False
             if i + 1 != len(node.items):
                 self.print(", ")
         self.print(":", _new_line=True)
         with self:
             # with block.
-            for i, element in enumerate(node.body):
-                self.visit(element, new_line=i + 1 != len(node.body))
+            yield from self._visit_list(node.body, _new_line_at_finish=False)
 
     def visit_FunctionDef(self, node):
         """
@@ -885,44 +1455,53 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.FunctionDef node.
         :return: None
         """
-        logging.info(f"in visit_FunctionDef")
+        if _trace.enabled:
+            logging.info(f"in visit_FunctionDef")
         # Handle function decorators.
         for decorator in node.decorator_list:
             self.print("@")
-            self.visit(decorator)
-        self.print(f"def {node.name}(")
-        # Handle function arguments.
-        if node.args:
-            node.args.exceeds_maximum_length = node.exceeds_maximum_length
-            self.visit(node.args, new_line=False)
-        # If the function definition exceeds the maximum line length, a new line should
-        # be dedicated for the closing parenthesis.
-        if node.exceeds_maximum_length:
-            self.new_line()
-        self.print("):", _new_line=True)
-        if node.exceeds_maximum_length:
+            yield decorator, True
+        if self._layout == DOCUMENT_LAYOUT:
+            yield from self._print_definition_header(node)
+        else:
+            self.print(f"def {node.name}(")
+            # Handle function arguments.
+            if node.args:
+                if node in self.state.exceeding_nodes:
+                    self.state.exceeding_nodes.add(node.args)
+                else:
+                    self.state.exceeding_nodes.discard(node.args)
+                yield node.args, False
+            # If the function definition exceeds the maximum line length, a new line
+            # should be dedicated for the closing parenthesis.
+            if node in self.state.exceeding_nodes:
+                self.new_line()
+            self.print("):", _new_line=True)
+        if node in self.state.exceeding_nodes:
             # Note that if the function continues, the body will be printed twice.
             return
 
         # Append to last_body_node the last definition node in the class's body.
-        self.last_body_node.append(self._get_latest_definition_node(node.body))
+        self.state.last_body_node.append(self.body_metadata.last_definition(node))
 
         # Start new indentation in order to print the function's body.
         with self:
             # Print docstring if exists.
-            if ast.get_docstring(node):
+            has_docstring = self.body_metadata.has_docstring(node)
+            if has_docstring:
                 self.visit_Constant(node.body[0].value, is_docstring=True)
             # Handle the rest of the function's body.
             for i, element in enumerate(node.body):
-                if ast.get_docstring(node) and i == 0:
+                if has_docstring and i == 0:
                     continue
-                self.starting_new_line_node = element
-                self.visit(element, new_line=i + 1 != len(node.body))
-        if self.latest_class:
+                yield from self._visit_body_node(
+                    element, new_line=i + 1 != len(node.body)
+                )
+        if self.state.latest_class:
             return
         # Since we're done printing the function, we can remove the last last_body_node
         # element.
-        self.last_body_node.pop()
+        self.state.last_body_node.pop()
         # Handle new lines after the definition is over.
         self.print_new_lines_after_definition(node)
 
@@ -932,46 +1511,53 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.ClassDef node.
         :return: None
         """
-        logging.info(f"in visit_ClassDef")
+        if _trace.enabled:
+            logging.info(f"in visit_ClassDef")
         # Handle decorators if they exist.
         for decorator in node.decorator_list:
             self.print("@")
-            self.visit(decorator)
+            yield decorator, True
         self.print(f"class {node.name}")
         # Handle node bases and keywords (e.g. baseclass or keyword like metaclass="").
-        if node.bases or node.keywords:
-            self.print("(")
-        if node.bases:
-            for i, base in enumerate(node.bases):
-                self.visit(base, new_line=False)
-                if i + 1 != len(node.bases):
+        if self._layout == DOCUMENT_LAYOUT:
+            if node.bases or node.keywords:
+                yield from self._print_group("(", node.bases + node.keywords, ")")
+        else:
+            if node.bases or node.keywords:
+                self.print("(")
+            if node.bases:
+                for i, base in enumerate(node.bases):
+                    yield base, False
+                    if i + 1 != len(node.bases):
+                        self.print(", ")
+                if node.keywords:
                     self.print(", ")
             if node.keywords:
-                self.print(", ")
-        if node.keywords:
-            for i, keyword in enumerate(node.keywords):
-                self.visit(keyword, new_line=False)
-                if i + 1 != len(node.keywords):
-                    self.print(", ")
-        if node.bases or node.keywords:
-            self.print(")")
+                for i, keyword in enumerate(node.keywords):
+                    yield keyword, False
+                    if i + 1 != len(node.keywords):
+                        self.print(", ")
+            if node.bases or node.keywords:
+                self.print(")")
         self.print(":", _new_line=True)
 
         # Append to last_body_node the last definition node in the class's body.
-        self.last_body_node.append(self._get_latest_definition_node(node.body))
+        self.state.last_body_node.append(self.body_metadata.last_definition(node))
+        has_docstring = self.body_metadata.has_docstring(node)
         with self:
             for i, element in enumerate(node.body):
-                if ast.get_docstring(node) and i == 0:
+                if has_docstring and i == 0:
                     self.visit_Constant(node.body[0].value, is_docstring=True)
                     continue
                 if i + 1 == len(node.body):
-                    self.latest_class = True
-                self.starting_new_line_node = element
-                self.visit(element, new_line=i + 1 != len(node.body))
-                self.latest_class = False
+                    self.state.latest_class = True
+                yield from self._visit_body_node(
+                    element, new_line=i + 1 != len(node.body)
+                )
+                self.state.latest_class = False
         # Since we're done printing the class, we can remove the last last_body_node
         # element.
-        self.last_body_node.pop()
+        self.state.last_body_node.pop()
         # Handle new lines after the definition is over.
         self.print_new_lines_after_definition(node)
 
@@ -981,9 +1567,10 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.If node.
         :return: None.
         """
-        logging.info(f"in visit_If")
+        if _trace.enabled:
+            logging.info(f"in visit_If")
         self.print("if ")
-        self._block_flow(node=node, first_attr="test", is_if=True)
+        yield from self._block_flow(node=node, first_attr="test", is_if=True)
 
     def visit_While(self, node):
         """
@@ -991,9 +1578,10 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.While
         :return: None
         """
-        logging.info(f"in visit_While")
+        if _trace.enabled:
+            logging.info(f"in visit_While")
         self.print("while ")
-        self._block_flow(node=node, first_attr="test")
+        yield from self._block_flow(node=node, first_attr="test")
 
     def visit_For(self, node):
         """
@@ -1001,11 +1589,12 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.For node.
         :return: None
         """
-        logging.info(f"in visit_For")
+        if _trace.enabled:
+            logging.info(f"in visit_For")
         self.print("for ")
-        self.visit(node.target, new_line=False)
+        yield node.target, False
         self.print(" in ")
-        self._block_flow(node=node, first_attr="iter")
+        yield from self._block_flow(node=node, first_attr="iter")
 
     def visit_Call(self, node):
         """
@@ -1013,32 +1602,44 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.Call node.
         :return: None
         """
-        logging.info(f"in visit_Call")
+        if _trace.enabled:
+            logging.info(f"in visit_Call")
         # Visit the function identifier node.
         comma = ","
-        comma += "" if node.exceeds_maximum_length else " "
-        self.visit(node.func, new_line=False)
+        comma += "" if node in self.state.exceeding_nodes else " "
+        yield node.func, False
+        if self._layout == DOCUMENT_LAYOUT:
+            arguments = node.args + node.keywords
+            # A generator expression that is the only argument cannot be followed by a
+            # comma.
+            trailing_comma = not (
+                len(arguments) == 1 and isinstance(arguments[0], _ast.GeneratorExp)
+            )
+            yield from self._print_group(
+                "(", arguments, ")", trailing_comma=trailing_comma
+            )
+            return
         self.print("(")
         # Handle the function argument.
-        if node.exceeds_maximum_length:
+        if node in self.state.exceeding_nodes:
             # Start a new line.
             self.new_line()
             # Open new scope.
             self.__enter__()
         for i, arg in enumerate(node.args):
-            self.visit(arg, new_line=False)
+            yield arg, False
             if i + 1 != len(node.args) or node.keywords:
-                self.print(comma, _new_line=node.exceeds_maximum_length)
+                self.print(comma, _new_line=node in self.state.exceeding_nodes)
         for i, kwarg in enumerate(node.keywords):
-            self.visit(kwarg, new_line=False)
+            yield kwarg, False
             if i + 1 != len(node.keywords):
-                self.print(comma, _new_line=node.exceeds_maximum_length)
-        if node.exceeds_maximum_length:
+                self.print(comma, _new_line=node in self.state.exceeding_nodes)
+        if node in self.state.exceeding_nodes:
             # The closing parentheses must be on an independent line.
             self.new_line()
             # Close scope.
             self.__exit__(None, None, None)
-        self.print(")", _new_line=node.exceeds_maximum_length)
+        self.print(")", _new_line=node in self.state.exceeding_nodes)
 
     def visit_ListComp(self, node):
         """
@@ -1046,13 +1647,14 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.ListComp.
         :return: None
         """
-        logging.info(f"in visit_ListComp")
+        if _trace.enabled:
+            logging.info(f"in visit_ListComp")
         self.print("[")
-        self.visit(node.elt, new_line=False)
+        yield node.elt, False
         for generator in node.generators:
             # Note that a list comprehension usage could contain multiple ifs.
             self.print(" for ")
-            self.visit(generator, new_line=False)
+            yield generator, False
         self.print("]")
 
     def visit_IfExp(self, node):
@@ -1061,12 +1663,13 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.IfExp
         :return: None
         """
-        logging.info(f"in visit_IfExp")
-        self.visit(node.body, new_line=False)
+        if _trace.enabled:
+            logging.info(f"in visit_IfExp")
+        yield node.body, False
         self.print(" if ")
-        self.visit(node.test, new_line=False)
+        yield node.test, False
         self.print(" else ")
-        self.visit(node.orelse, new_line=False)
+        yield node.orelse, False
 
     def visit_comprehension(self, node):
         """
@@ -1074,15 +1677,16 @@ class Rewrite(ast.NodeVisitor):
         :param node: _ast.comprehension node.
         :return: None
         """
-        logging.info(f"in visit_comprehension")
-        self.visit(node.target, new_line=False)
+        if _trace.enabled:
+            logging.info(f"in visit_comprehension")
+        yield node.target, False
         self.print(" in ")
-        self.visit(node.iter, new_line=False)
+        yield node.iter, False
         if node.ifs:
             # Handle "if" statement if node contains ifs.
             for if_liner in node.ifs:
                 self.print(" if ")
-                self.visit(if_liner, new_line=False)
+                yield if_liner, False
 
     def _block_flow(self, node, first_attr, is_if=False):
         """
@@ -1095,45 +1699,159 @@ class Rewrite(ast.NodeVisitor):
         """
         # Get the node of the first attribute.
         node_attr = getattr(node, first_attr)
-        self.visit(node_attr, new_line=False)
+        yield node_attr, False
         self.print(":", _new_line=True)
         # Open new indentation.
         with self:
             # Visit all the the nodes body block.
-            for i, element in enumerate(node.body):
-                if i + 1 != len(node.body):
-                    self.visit(element)
-                else:
-                    self.visit(element, False)
+            yield from self._visit_list(node.body, _new_line_at_finish=False)
         if node.orelse:
             # Handle else statement blocks if the node has an else block.
             self.new_line()
             if is_if and type(node.orelse[0]) is _ast.If:
                 self.print("el")
                 # Note that the statement should be an elif statement.
-                self.visit(node.orelse[0], False)
+                yield node.orelse[0], False
             else:
                 self.print("else:", _new_line=True)
                 # Handle the else block
                 with self:
-                    for i, element in enumerate(node.orelse):
-                        if i + 1 != len(node.orelse):
-                            self.visit(element)
-                        else:
-                            self.visit(element, False)
+                    yield from self._visit_list(node.orelse, _new_line_at_finish=False)
 
     def _visit_list(self, nodes_list, *, _new_line_at_finish=True):
         """
-        Calls visit() for each node in a list.
+        Visits the body of a compound statement (e.g. if, try, with), each node starts
+        a line, see _visit_body_node().
         When calling visit(), new_line argument will be always True except for the
         last node unless specified otherwise.
+        Note that once the body is over, the compound statement is the node that
+        starts the line again, e.g. for a long "elif" line.
         :param nodes_list: List of nodes
         :param _new_line_at_finish: Should new line be printed when visiting the last
                                     node.
         :return: None
         """
+        starting_new_line = (
+            self.state.starting_new_line_node,
+            self.state.starting_new_line_checkpoint,
+        )
         for i, node in enumerate(nodes_list):
-            self.visit(node, new_line=i + 1 != len(nodes_list) or _new_line_at_finish)
+            yield from self._visit_body_node(
+                node, new_line=i + 1 != len(nodes_list) or _new_line_at_finish
+            )
+        if not _new_line_at_finish and not self.emitter.in_new_line:
+            # The last line of the body is not finished, check it while its node is
+            # still the node that starts the line. Its long form finishes the line,
+            # which is left to the caller.
+            self.check_line()
+            if self.emitter.in_new_line:
+                self.emitter.reopen_line()
+        self.state.starting_new_line_node, self.state.starting_new_line_checkpoint = (
+            starting_new_line
+        )
+
+    def _print_group(
+        self, opening, elements, closing, *, print_element=None, trailing_comma=True
+    ):
+        """
+        Prints a comma separated list of elements between brackets as a group of the
+        document layout, e.g. the arguments of a call. If the group does not fit in the
+        line, each element is printed in its own line and followed by a comma.
+        :param opening: Opening bracket.
+        :param elements: List of nodes, or of items that are printed by print_element.
+        :param closing: Closing bracket.
+        :param print_element: Generator function that prints an element, like the
+                              visitors do, visit() if None.
+        :param trailing_comma: Should the last element be followed by a comma when the
+                               group is broken.
+        :return: None
+        """
+        emitter = self.emitter
+        emitter.begin_group()
+        self.print(opening)
+        if elements:
+            emitter.indent()
+            emitter.softline()
+            for i, element in enumerate(elements):
+                if print_element is None:
+                    yield element, False
+                else:
+                    yield from print_element(element)
+                if i + 1 != len(elements):
+                    self.print(",")
+                    emitter.line()
+            if trailing_comma:
+                emitter.if_break(",")
+            emitter.dedent()
+            emitter.softline()
+        self.print(closing)
+        emitter.end_group()
+
+    def _print_operations(self, operands, operators):
+        """
+        Prints a chain of binary or boolean operations as a group of the document
+        layout. If the group does not fit in the line, it is wrapped in parentheses and
+        each operator starts a new line.
+        :param operands: List of nodes.
+        :param operators: List of operators, operators[i] is printed before
+                          operands[i + 1].
+        :return: None
+        """
+        emitter = self.emitter
+        emitter.begin_group()
+        emitter.if_break("(")
+        emitter.indent()
+        emitter.softline()
+        yield operands[0], False
+        for operator, operand in zip(operators, operands[1:]):
+            emitter.line()
+            self.print(f"{operator} ")
+            yield operand, False
+        emitter.dedent()
+        emitter.softline()
+        emitter.if_break(")")
+        emitter.end_group()
+
+    def _print_definition_header(self, node):
+        """
+        Prints the first line of a function definition as a group of the document
+        layout, the arguments are broken like the arguments of a call.
+        :param node: _ast.FunctionDef node.
+        :return: None
+        """
+        emitter = self.emitter
+        arguments = node.args
+        emitter.begin_group()
+        self.print(f"def {node.name}(")
+        if (
+            arguments.posonlyargs
+            or arguments.args
+            or arguments.vararg
+            or arguments.kwonlyargs
+            or arguments.kwarg
+        ):
+            emitter.indent()
+            emitter.softline()
+            yield arguments, False
+            emitter.if_break(",")
+            emitter.dedent()
+            emitter.softline()
+        self.print(")")
+        emitter.end_group()
+        self.print(":", _new_line=True)
+
+    def _print_separator(self, separator, new_line):
+        """
+        Prints the separator between two arguments of a function definition.
+        :param separator: The separator, followed by a space unless new_line is True.
+        :param new_line: Should the legacy layout start a new line after the separator.
+        :return: None
+        """
+        if self._layout == DOCUMENT_LAYOUT:
+            self.print(",")
+            self.emitter.line()
+        else:
+            self.print(separator, _new_line=new_line)
 
     @staticmethod
     def _ordered_pos_arg_default(pos_only_args, args, defaults):
@@ -1197,49 +1915,31 @@ class Rewrite(ast.NodeVisitor):
         :return: None
         """
         assert not value % 4, "Indentation error"
-        self.indentation += value
+        self.emitter.indentation += value
 
     def cleanup(self):
         """
         Resets all the necessary variables in order to start reformatting again.
         :return: None
         """
-        self.current_line_len = 0
-        self.current_line = ""
-        self.first_long_node = False
-        self.indentation = 0
-        self.in_new_line = True
-        self.last_body_node = []
-        self.last_node = False
-        self.latest_class = False
-        self.long_node = False
-        self.nested_scope = 0
+        self.emitter.reset()
+        self.flat_widths.clear()
+        self.body_metadata.clear()
+        self.state = LayoutState()
 
     def _init_values_for_long_line(self):
         """
         Helper function to initialize all the needed variables in case of a long line.
         :return:
         """
-        self.starting_new_line_node.exceeds_maximum_length = True
-        self.current_line_len = 0
-        self.current_line = ""
-        self.in_new_line = True
-        self.long_node = True
-        self.first_long_node = True
-
-    @staticmethod
-    def _get_latest_definition_node(body):
-        """
-        Detects and returns the last function/class definition in a list of nodes and
-        whether the function/class definition is the last item in the body.
-        :param body: list of nodes.
-        :return: Tuple containing the last definition and whether its the last item in
-                 body.
-        """
-        for i, node in enumerate(reversed(body)):
-            if isinstance(node, (_ast.ClassDef, _ast.FunctionDef)):
-                return node, i == 0
-        return None, None
+        self.state.exceeding_nodes.add(self.state.starting_new_line_node)
+        self.emitter.rollback(self.state.starting_new_line_checkpoint)
+        if not self.emitter.in_new_line:
+            # The node did not start a line, the code that precedes it belongs to
+            # other nodes and is kept, the node starts a new line instead.
+            self.emitter.newline()
+        self.state.long_node = True
+        self.state.first_long_node = True
 
     def print_error_messages(self, changed_files):
         """
@@ -1265,95 +1965,693 @@ class Rewrite(ast.NodeVisitor):
         :return: None
         """
         if not (
-            self.last_node
+            self.state.last_node
             or (
-                self.nested_scope
-                and (node == self.last_body_node[-1][0] and self.last_body_node[-1][1])
+                self.state.nested_scope
+                and (
+                    node == self.state.last_body_node[-1][0]
+                    and self.state.last_body_node[-1][1]
+                )
             )
         ):
             self.new_line(
                 self.nested_lines
-                if self.nested_scope
+                if self.state.nested_scope
                 else self.vertical_definition_lines
             )
 
 
-class NodeAttributes(ast.NodeVisitor):
-    def visit(self, node):
-        """Visit a node."""
-        setattr(node, "exceeds_maximum_length", False)
-        method = "visit_" + node.__class__.__name__
-        visitor = getattr(self, method, self.generic_visit)
-        return visitor(node)
+def _no_solution_error(filename):
+    """
+    Creates the error raised when the formatter runs out of recursion, see
+    Rewrite.format_source().
+    :param filename: Name of the file.
+    :return: NoSolutionError object.
+    """
+    message = (
+        "maximum recursion depth exceeded while calling a Python object"
+        f", check maximum line length: {filename}"
+    )
+    return NoSolutionError(message)
+
+
+class _Mismatch(Exception):
+    """Raised by _ComparingSink at the first difference, see Rewrite.check_source()."""
+
+
+class _ComparingSink:
+    """
+    Receives formatted code piece by piece and compares it with the source code, so
+    the formatting can stop as soon as the code differs.
+    """
+
+    def __init__(self, source):
+        """
+        Initializes all the object's variables.
+        :param source: The source code.
+        """
+        self.source = source
+        # Length of the source code that was compared.
+        self.position = 0
+
+    def write(self, text):
+        """
+        Compares the next piece of formatted code, raises _Mismatch if it differs.
+        :param text: The formatted code.
+        :return: None
+        """
+        if not self.source.startswith(text, self.position):
+            raise _Mismatch()
+        self.position += len(text)
+
+    def finished(self):
+        """True if all of the source code was compared, i.e. no code is missing."""
+        return self.position == len(self.source)
+
+
+class FormatterPool:
+    """
+    Keeps the formatters that are not in use, so formatting many files creates a
+    formatter once for each configuration and thread instead of once for each file.
+    A formatter is reset when it returns to the pool, even if formatting failed, so a
+    formatter taken from the pool is always ready to format a new file.
+    Only the formatters of the max_configs configurations that were used last are
+    kept, so a long running process (e.g. the daemon) that sees many configurations
+    does not keep formatters for all of them.
+    """
+
+    def __init__(self, max_configs=8):
+        """
+        Initializes all the object's variables.
+        :param max_configs: Maximum number of configurations with idle formatters.
+        """
+        # Dictionary mapping a (formatter class, Config) tuple to the list of idle
+        # formatters of the class having these configurations, from the least
+        # recently used.
+        self.idle = OrderedDict()
+        self.max_configs = max_configs
+        self._lock = threading.Lock()
+
+    def acquire(self, config, formatter_class=Rewrite):
+        """
+        Takes an idle formatter out of the pool, or creates a new one.
+        :param config: The formatting configurations, see Rewrite.config().
+        :param formatter_class: Rewrite or a subclass of it.
+        :return: Rewrite object, it must be returned by release().
+        """
+        with self._lock:
+            formatters = self.idle.get((formatter_class, config))
+            if formatters:
+                return formatters.pop()
+        return formatter_class.from_settings(config._asdict())
+
+    def release(self, formatter):
+        """
+        Resets a formatter and returns it to the pool.
+        Note that the formatter is kept according to its current configurations.
+        :param formatter: Rewrite object.
+        :return: None
+        """
+        formatter.cleanup()
+        key = type(formatter), formatter.config()
+        with self._lock:
+            self.idle.setdefault(key, []).append(formatter)
+            self.idle.move_to_end(key)
+            while len(self.idle) > self.max_configs:
+                self.idle.popitem(last=False)
+
+    @contextlib.contextmanager
+    def formatter(self, config, formatter_class=Rewrite):
+        """
+        Lends a formatter for the duration of a "with" statement.
+        :param config: The formatting configurations, see Rewrite.config().
+        :param formatter_class: Rewrite or a subclass of it.
+        :return: Context manager returning a Rewrite object.
+        """
+        formatter = self.acquire(config, formatter_class)
+        try:
+            yield formatter
+        finally:
+            self.release(formatter)
+
+
+# Formatters shared by all the threads of the process, see map_files().
+formatter_pool = FormatterPool()
+
+
+def read_file(target_file, skip_policy=None):
+    """
+    Reads a Python file.
+    The file is decoded according to its encoding declaration and its new lines are
+    not translated, so the comparison with the formatted code finds files whose line
+    endings have to change as well.
+    :param target_file: Path of the file.
+    :param skip_policy: _skip.SkipPolicy object, if given, a skipped file is not read
+                        entirely nor decoded.
+    :return: Tuple containing the content of the file, its stat result, its source
+             code and its encoding, or None if the file is skipped.
+    """
+    content = _read_bytes(target_file, skip_policy)
+    if content is None:
+        return None
+    data, stat = content
+    return (data, stat, *_decode(data))
+
+
+def _read_bytes(target_file, skip_policy=None):
+    """
+    Reads a file without decoding it, see read_file().
+    :param target_file: Path of the file.
+    :param skip_policy: _skip.SkipPolicy object, if given, a skipped file is not read
+                        entirely.
+    :return: Tuple containing the content of the file and its stat result, or None if
+             the file is skipped.
+    """
+    with open(target_file, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if skip_policy is None:
+            return f.read(), stat
+        data = skip_policy.read(f, stat.st_size)
+    return None if data is None else (data, stat)
+
+
+def _decode(data):
+    """
+    Decodes the content of a Python file, see read_file().
+    :param data: The content of the file.
+    :return: Tuple containing the source code and its encoding.
+    """
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    return data.decode(encoding), encoding
+
+
+def format_file(formatter, target_file, line_ranges=None):
+    """
+    Reads and formats a file.
+    Note that the file itself is not changed.
+    :param formatter: Rewrite object, it must not be used by other threads meanwhile.
+    :param target_file: Path of the file.
+    :param line_ranges: If given, only these lines are formatted, see format_ranges().
+    :return: Tuple containing the source code of the file and the formatted code.
+    """
+    _, _, source, _ = read_file(target_file)
+    return source, formatter.format_source(source, target_file, line_ranges)
+
+
+def format_stdin(visitor):
+    """
+    Formats the code read from stdin and writes the formatted code to stdout, no file
+    is read or written. The code is passed through as is if visitor.stdin_filename does
+    not have an allowed suffix or if its first line contains "Ignore file".
+    In check only mode nothing is written, the exit code is 1 if the code must change.
+    If visitor.stream is set, the code is formatted while it is being read, see
+    Rewrite.format_stream().
+    :param visitor: Rewrite() object, containing all the necessary configurations.
+    :return: 0 if the code is formatted or was formatted.
+    """
+    if visitor.stream and visitor.line_ranges is not None:
+        # The statements that contain the lines are not known while streaming.
+        raise ValueError("--line-ranges cannot be used with --stream.")
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    encoding, first_lines = tokenize.detect_encoding(stdin.readline)
+    lines = itertools.chain(first_lines, iter(stdin.readline, b""))
+    # The code is compared by digests, so a stream is never kept in memory.
+    source_digest = hashlib.blake2b()
+    formatted_digest = hashlib.blake2b()
+
+    def readline():
+        line = next(lines, b"")
+        source_digest.update(line)
+        return line.decode(encoding)
+
+    def write(text):
+        data = text.encode(encoding)
+        formatted_digest.update(data)
+        if not visitor.check_only:
+            stdout.write(data)
+
+    if not (
+        visitor.stdin_filename == "<stdin>"
+        or any(
+            visitor.stdin_filename.endswith(suffix)
+            for suffix in visitor.allowed_suffixes
+        )
+    ) or (first_lines and _skip.IGNORE_MARKER in first_lines[0]):
+        for line in iter(readline, ""):
+            write(line)
+    elif visitor.stream:
+        visitor.format_stream(readline, write, visitor.stdin_filename)
+    else:
+        source = "".join(iter(readline, ""))
+        write(
+            visitor.format_source(source, visitor.stdin_filename, visitor.line_ranges)
+        )
+    stdout.flush()
+    if visitor.check_only and source_digest.digest() != formatted_digest.digest():
+        exit(1)
+    return 0
+
+
+def rewrite_file(
+    formatter,
+    target_file,
+    check_only=False,
+    formatted_digests=frozenset(),
+    fsync=False,
+    line_ranges=None,
+    skip_policy=None,
+):
+    """
+    Formats a file and writes the formatted code to it if the code has changed.
+    The formatted code is compared in memory with the source that was read, only
+    files that have changed are written, see _write.write_atomic().
+    :param formatter: Rewrite object, it must not be used by other threads meanwhile.
+    :param target_file: Path of the file.
+    :param check_only: If True, the file is never changed.
+    :param formatted_digests: Content digests of files that are known to be formatted,
+                              these files are not formatted again.
+    :param fsync: If True, changed files are flushed to the disk.
+    :param line_ranges: If given, only these lines are formatted, see format_ranges().
+    :param skip_policy: _skip.SkipPolicy object, deciding which files are skipped.
+    :return: Tuple containing True if the file has changed (or must be changed), and
+             the cache entry of the file if it is formatted (None otherwise).
+    """
+    content = _read_bytes(target_file, skip_policy)
+    if content is None:
+        return False, None
+    data, stat = content
+    read_file = target_file, data, stat, _cache.digest(data)
+    file_changed, entry, _ = _rewrite_read_file(
+        formatter, read_file, check_only, formatted_digests, fsync, line_ranges
+    )
+    return file_changed, entry
+
+
+def _rewrite_read_file(
+    formatter, read_file, check_only, formatted_digests, fsync, line_ranges
+):
+    """
+    Formats a file that was read already, see rewrite_file().
+    :param formatter: Rewrite object, it must not be used by other threads meanwhile.
+    :param read_file: Tuple containing the path of the file, its content, its stat
+                      result and its content digest.
+    :return: Tuple containing the result of rewrite_file() and the formatted code of
+             the file, encoded, if the file was changed (None otherwise), so that the
+             files with the same content can be changed without formatting them, see
+             reformat().
+    """
+    target_file, data, stat, digest = read_file
+    source, encoding = _decode(data)
+    entry = (stat.st_mtime_ns, stat.st_size, digest)
+    if digest in formatted_digests:
+        return False, entry, None
+    if check_only and line_ranges is None:
+        # Nothing is written, so the formatting stops at the first difference.
+        if formatter.check_source(source, target_file):
+            return True, None, None
+        return False, entry, None
+    formatted = formatter.format_source(source, target_file, line_ranges)
+    if formatted == source:
+        # The lines outside the ranges may still need formatting.
+        return False, entry if line_ranges is None else None, None
+    if check_only:
+        return True, None, None
+    formatted = formatted.encode(encoding)
+    _write_formatted(target_file, formatted, stat, fsync)
+    return True, None, formatted
+
+
+def _write_formatted(target_file, formatted, stat, fsync):
+    """
+    Writes the formatted code of a file, see _write.write_atomic().
+    :param target_file: Path of the file.
+    :param formatted: The formatted code, encoded.
+    :param stat: Stat result of the file, its mode is kept.
+    :param fsync: If True, the file is flushed to the disk.
+    :return: None
+    """
+    # When in pytest environment, the system should not change the original files
+    # content.
+    if "PYTEST_CURRENT_TEST" not in os.environ:
+        _write.write_atomic(target_file, formatted, stat.st_mode, fsync)
+
+
+# Configurations of a worker process and the function that the worker calls for each
+# file, set once by _init_worker(). The formatters of the worker are taken from
+# formatter_pool, so they are reused for all the files that the worker handles.
+_worker_config = None
+_worker_job = None
+
+
+def _init_worker(config, trace, function, args):
+    """
+    Initializes a worker process of the process pool.
+    :param config: The formatting configurations, see Rewrite.config().
+    :param trace: True if tracing is enabled in the main process.
+    :param function: Function receiving a formatter and a path, e.g. format_file().
+    :param args: Additional arguments of function, the same for all files.
+    :return: None
+    """
+    global _worker_config, _worker_job
+    _worker_config = config
+    _worker_job = function, args
+    if trace and not _trace.enabled:
+        _trace.enable()
+
+
+def _format_batch(batch):
+    """
+    Handles a batch of files in a worker process.
+    :param batch: List of paths.
+    :return: List of results.
+    """
+    function, args = _worker_job
+    with formatter_pool.formatter(_worker_config) as formatter:
+        return [function(formatter, target_file, *args) for target_file in batch]
+
+
+def _batches(files, batch_size):
+    """
+    Splits files into batches, each batch contains consecutive files of about
+    batch_size bytes in total, so many small files are sent to a worker process at
+    once, while big files are sent alone.
+    :param files: Iterable of paths, or of tuples starting with a path and the content
+                  of the file (see _rewrite_read_file()), a batch is yielded once it is
+                  full, so the first batches are formatted while the next files are
+                  found.
+    :param batch_size: Size of a batch in bytes.
+    :return: Generator of batches.
+    """
+    batch = []
+    size = 0
+    for target_file in files:
+        if size >= batch_size:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(target_file)
+        if isinstance(target_file, tuple):
+            size += len(target_file[1])
+            continue
+        try:
+            size += os.path.getsize(target_file)
+        except OSError:
+            # The error is raised when the file is formatted.
+            pass
+    yield batch
+
+
+def map_files(visitor, function, files, *args):
+    """
+    Calls function(formatter, target_file, *args) for each file, see imap_files().
+    :return: List containing the results, in the same order of files.
+    """
+    return list(imap_files(visitor, function, files, *args))
+
+
+def imap_files(visitor, function, files, *args):
+    """
+    Calls function(formatter, target_file, *args) for each file, the results are
+    yielded as soon as they are ready, and closing the generator cancels the files
+    that were not handled yet.
+    If visitor.threads is greater than one, the files are handled by a pool of threads
+    and each file is formatted by a formatter taken from formatter_pool, which has the
+    configurations of the visitor. Otherwise, if visitor.jobs is greater than one, the
+    files are handled in batches by a pool of processes, each process reuses its
+    formatters for all of its batches.
+    :param visitor: Rewrite() object, containing all the necessary configurations.
+    :param function: Function receiving a formatter and a path, e.g. format_file().
+                     Note that the function must be defined at module level in order
+                     to be sent to worker processes.
+    :param files: Iterable of paths, or of the tuples that function receives instead
+                  of paths (see _batches()). The files are taken as the results are
+                  taken, a few jobs ahead (see JOBS_AHEAD), so the first files are
+                  handled while the next files are found, e.g. by _search.walk().
+    :param args: Additional arguments of function, the same for all files. Note that
+                 the arguments are sent once to each worker process.
+    :return: Generator of the results, in the same order of files.
+    """
+    if visitor.threads > 1:
+        config = visitor.config()
+
+        def job(target_file):
+            with formatter_pool.formatter(config, type(visitor)) as formatter:
+                return function(formatter, target_file, *args)
+
+        with ThreadPoolExecutor(max_workers=visitor.threads) as executor:
+            yield from _map_ahead(executor, job, files, JOBS_AHEAD * visitor.threads)
+        return
+    batches = _batches(files, BATCH_SIZE) if visitor.jobs > 1 else iter([files])
+    # The process pool is not started if all the files fit in a single batch.
+    first_batch = next(batches)
+    second_batch = next(batches, None)
+    if second_batch is None:
+        for target_file in first_batch:
+            yield function(visitor, target_file, *args)
+        return
+    with ProcessPoolExecutor(
+        max_workers=visitor.jobs,
+        initializer=_init_worker,
+        initargs=(visitor.config(), _trace.enabled, function, args),
+    ) as executor:
+        batches = itertools.chain([first_batch, second_batch], batches)
+        for batch_results in _map_ahead(
+            executor, _format_batch, batches, JOBS_AHEAD * visitor.jobs
+        ):
+            yield from batch_results
+
+
+def _map_ahead(executor, function, items, ahead):
+    """
+    Calls function(item) for each item in an executor, like Executor.map(), but the
+    items are taken from the iterable only as the results are taken, at most <ahead>
+    items are submitted and not taken yet. Unlike Executor.map(), which submits all
+    the items at once, the memory in use does not depend on the number of items.
+    Closing the generator cancels the items that were submitted and did not start.
+    :param executor: The executor, e.g. a ThreadPoolExecutor.
+    :param function: Function receiving an item.
+    :param items: Iterable of items.
+    :param ahead: Maximum number of items submitted ahead of the results.
+    :return: Generator of the results, in the same order of items.
+    """
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _modification_time(target_file):
+    """
+    Returns the modification time of a file, see reformat().
+    :param target_file: Path of the file.
+    :return: Modification time in nanoseconds, 0 if the file cannot be accessed.
+    """
+    try:
+        return os.stat(target_file).st_mtime_ns
+    except OSError:
+        # The error is raised when the file is formatted.
+        return 0
 
 
 def reformat(visitor):
     """
     Rewrites all the given files.
+    Each file is read once, here, and its content is handed over to the formatting.
+    The files are read as the formatting goes on, see imap_files(), so only the
+    content of a few files is held in memory at once.
+    Files with the same content are formatted once: the first file is formatted, and
+    its result applies to the other files, see _copy_formatted().
     :param visitor: Rewrite() object, containing all the necessary configurations.
     :return: 0 if no changes are needed, 1 otherwise.
     """
-    global file
-    attribute_setter = NodeAttributes()
-    modified_file = "modified_file.py"
+    cache = _cache.Cache(visitor.settings()) if visitor.use_cache else None
+    # Ignored files, generated files and large files are skipped when they are read.
+    skip_policy = _skip.SkipPolicy(visitor.generated_markers, visitor.max_file_size)
+    # The (path, position, content digest) tuples of the files that are formatted, in
+    # the order of the results of imap_files(). The position of a file is its index in
+    # the order the files are found, or its place in the order of _search.walk() when
+    # the files are found concurrently. Note that the files are gathered and read while
+    # the first files are formatted.
+    files = []
+    # Dictionary mapping a content digest to the first file with this content.
+    originals = {}
+    # Dictionary mapping a content digest to the result of its first file, a tuple
+    # containing True if the file has changed and its cache entry.
+    results_by_digest = {}
+    # Dictionary mapping a content digest to the formatted code of its first file, if
+    # the file has changed, up to MAX_KEPT_FORMATTED bytes in total.
+    kept_formatted = {}
+    kept_size = 0
+    # Dictionary mapping a content digest to the (path, position, stat result) tuples
+    # of the files with this content that were found before the result of its first
+    # file.
+    waiting = {}
+    # List of (path, position, stat result, content digest) tuples of the files whose
+    # content is the same as the content of a file whose result is known, they are
+    # handled with the next result.
+    ready = []
+    # Number of files with the same content as an earlier file, of files that are
+    # known to be formatted and of files that are skipped.
+    copies_count = 0
+    cached_count = 0
+    skipped_count = 0
+    # The (position, path) tuples of the changed files, the copies are handled after
+    # their first file, so the files are listed by their positions.
     changed_files = []
-    for target_file in visitor.files:
-        with open(target_file) as f:
-            # Parse the python files and extract the AST.
-            parsed = ast.parse(f.read(), target_file)
 
-        # Add necessary attributes to the AST nodes.
-        attribute_setter.visit(parsed)
-
-        # Write the changes to an external file.
-        file = open(modified_file, "w+")
-        try:
-            # Rewrite the code by using the AST.
-            visitor.visit(parsed)
-        # Files with SyntaxErrors cannot be reformatted as parsing the AST tree of
-        # these files is not possible.
-        except SyntaxError as e:
-            raise e
-        # Recursion Error usually happens when the system fails to format the file.
-        # An example of this would be a maximum line length that exceeds an
-        # identifier's name.
-        except RecursionError:
-            message = (
-                "maximum recursion depth exceeded while calling a Python object"
-                ", check maximum line length: " + target_file
+    def pending_files():
+        nonlocal copies_count, cached_count, skipped_count
+        target_files = visitor.files
+        if visitor.fail_fast:
+            # The files that were modified recently are the most likely to change.
+            target_files = sorted(target_files, key=_modification_time, reverse=True)
+        # _search.walk_concurrently() finds the files in no particular order, so they
+        # are listed in the order _search.walk() would find them, see rewrite().
+        walked_concurrently = (
+            visitor.directory is not None
+            and visitor.search_threads > 1
+            and visitor.changed_since is None
+        )
+        for position, target_file in enumerate(target_files):
+            if walked_concurrently:
+                position = _search.walk_order(target_file)
+            # Files that did not change since they were found formatted are not read.
+            if cache is not None and cache.is_formatted(target_file):
+                cached_count += 1
+                continue
+            content = _read_bytes(target_file, skip_policy)
+            if content is None:
+                skipped_count += 1
+                if cache is not None:
+                    cache.forget(target_file)
+                continue
+            data, stat = content
+            digest = _cache.digest(data)
+            if digest in originals:
+                # The file is not formatted, only its path and stat result are kept.
+                copies_count += 1
+                if digest in results_by_digest:
+                    ready.append((target_file, position, stat, digest))
+                else:
+                    copy = target_file, position, stat
+                    waiting.setdefault(digest, []).append(copy)
+                continue
+            originals[digest] = target_file
+            files.append((target_file, position, digest))
+            yield target_file, data, stat, digest
+
+    def record(target_file, position, file_changed, entry):
+        if file_changed:
+            changed_files.append((position, target_file))
+        if cache is not None:
+            if entry is not None:
+                cache.record(target_file, entry)
+            else:
+                cache.forget(target_file)
+
+    def handle_copy(target_file, position, stat, digest):
+        file_changed, entry = results_by_digest[digest]
+        if file_changed and not visitor.check_only:
+            _copy_formatted(
+                originals[digest],
+                target_file,
+                kept_formatted.get(digest),
+                stat,
+                visitor.fsync,
             )
-            raise NoSolutionError(message)
-        # Finish writing to the file
-        file.close()
-        # Check if file has changed
-        if not filecmp.cmp(modified_file, target_file):
-            # If the file has changed, add it to changed_files
-            changed_files.append(target_file)
-        if visitor.check_only:
-            continue
-        # When in pytest environment, the system should not change the original files
-        # content.
-        if "PYTEST_CURRENT_TEST" not in os.environ:
-            # Move the external file's content to the original file
-            copyfile(modified_file, target_file)
-            # Remove the external file.
-            os.remove(modified_file)
-        # Reset all the object's attributes to their default value.
-        visitor.cleanup()
-        # Print summary
+        if entry is not None:
+            # The file has its own modification time.
+            entry = (stat.st_mtime_ns, stat.st_size, digest)
+        record(target_file, position, file_changed, entry)
+        return file_changed
+
+    results = imap_files(
+        visitor,
+        _rewrite_read_file,
+        pending_files(),
+        visitor.check_only,
+        cache.formatted_digests() if cache is not None else frozenset(),
+        visitor.fsync,
+        visitor.line_ranges,
+    )
+    stopped = False
+    # Note that a result is taken before its file, which is appended to files when the
+    # file is handed over to imap_files().
+    for (file_changed, entry, formatted), (target_file, position, digest) in zip(
+        results, files
+    ):
+        results_by_digest[digest] = file_changed, entry
+        if formatted is not None and kept_size + len(formatted) <= MAX_KEPT_FORMATTED:
+            kept_formatted[digest] = formatted
+            kept_size += len(formatted)
+        record(target_file, position, file_changed, entry)
+        ready.extend((*copy, digest) for copy in waiting.pop(digest, ()))
+        for copy in ready:
+            file_changed = handle_copy(*copy) or file_changed
+        ready.clear()
+        if file_changed and visitor.fail_fast:
+            # The files that were not handled yet are cancelled.
+            results.close()
+            print("Stopped at the first file that must change (--fail-fast)")
+            stopped = True
+            break
+    if not stopped:
+        # The files found after the last result.
+        for copy in ready:
+            handle_copy(*copy)
+    # Note that check only runs never write to the disk.
+    if cache is not None and not visitor.check_only:
+        cache.save()
+    # Print summary
+    print(
+        f"{len(files) + copies_count + cached_count + skipped_count} file(s) found: "
+        f"{len(files)} formatted, {copies_count} with the same content as another "
+        f"file, {cached_count} known to be formatted, {skipped_count} skipped"
+    )
     if changed_files:
-        visitor.print_error_messages(changed_files)
+        changed_files.sort()
+        visitor.print_error_messages([target_file for _, target_file in changed_files])
     else:
         print("No files were changed")
     return 0
 
 
-def rewrite(*argv):
+def _copy_formatted(original_file, target_file, formatted, stat, fsync):
     """
-    Handles the rewriting process by parsing the arguments and configurations, gathers
-    the path of the files that need to be formatted and rewrites them.
+    Writes the formatted code of a file to a file that had the same content, see
+    reformat().
+    :param original_file: Path of the file that was formatted.
+    :param target_file: Path of the file with the same content.
+    :param formatted: The formatted code of original_file, encoded, or None if it was
+                      not kept (see MAX_KEPT_FORMATTED), it is then read from
+                      original_file, which was written already.
+    :param stat: Stat result of target_file.
+    :param fsync: If True, the file is flushed to the disk.
+    :return: None
+    """
+    # When in pytest environment, the system should not change the original files
+    # content, as rewrite_file() does.
+    if "PYTEST_CURRENT_TEST" in os.environ:
+        return
+    if formatted is None:
+        with open(original_file, "rb") as f:
+            formatted = f.read()
+    _write_formatted(target_file, formatted, stat, fsync)
+
+
+def configure(*argv):
+    """
+    Creates a formatter and sets its configurations according to the configuration
+    file and the command line arguments.
     :param argv: The command line arguments provided by the user
-    :return: 0 if the code is formatted, 1 otherwise
+    :return: Rewrite object.
     """
     visitor = Rewrite()
     configurations = _conf.Conf()
@@ -1365,28 +2663,49 @@ def rewrite(*argv):
     # file), it will override the configurations that were given by the command line
     # arguments.
     configurations.parse_arguments(argv, visitor)
+    return visitor
+
+
+def rewrite(*argv):
+    """
+    Handles the rewriting process by parsing the arguments and configurations, gathers
+    the path of the files that need to be formatted and rewrites them.
+    :param argv: The command line arguments provided by the user
+    :return: 0 if the code is formatted, 1 otherwise
+    """
+    visitor = configure(*argv)
+    if visitor.serve_socket is not None:
+        return _serve.serve(visitor)
+    if visitor.stdin:
+        return format_stdin(visitor)
     # If a directory was given, find all the files that need to be formatted in the
     # directory and its sub-directories.
     # Note that these files does not have to be Python files only since additional
     # suffixes could be given by the user.
-    if visitor.directory is not None:
-        _search.walk(
+    file_filter = _search.FileFilter(
+        visitor.allowed_suffixes, visitor.include, visitor.exclude
+    )
+    if visitor.changed_since is not None:
+        # Only the files that git reports are formatted, in the given directory or in
+        # the current directory.
+        visitor.files = _search.changed_since(
+            root_directory=visitor.directory or os.curdir,
+            ref=visitor.changed_since,
+            file_filter=file_filter,
+        )
+    elif visitor.directory is not None and visitor.search_threads > 1:
+        visitor.files = _search.walk_concurrently(
             root_directory=visitor.directory,
-            files_list=visitor.files,
-            suffixes=visitor.allowed_suffixes,
+            file_filter=file_filter,
+            threads=visitor.search_threads,
+        )
+    elif visitor.directory is not None:
+        visitor.files = _search.walk(
+            root_directory=visitor.directory, file_filter=file_filter
         )
     else:
         visitor.files = [visitor.target_file]
 
-    # Remove ignored files:
-    for file in visitor.files:
-        with open(file, "r") as f:
-            if "Ignore file" in f.readline():
-                visitor.files.remove(file)
-
     # Return the exit code this is useful for CI/CD procedure, and particularly when
     # using --check-only argument.
     return reformat(visitor)
-
-
-file = None
@@ -1,20 +1,312 @@
 # Ignore file
+import glob
 import os
+import re
+import subprocess
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+# Directories that are never searched: version control directories, caches, virtual
+# environments and the formatter itself. Note that the patterns end with "/", so they
+# match directories only, see _translate().
+DEFAULT_EXCLUDES = (
+    ".git/",
+    ".hg/",
+    ".svn/",
+    ".tox/",
+    ".nox/",
+    "__pycache__/",
+    "node_modules/",
+    "*venv*/",
+    "*formatter*/",
+)
 
-def walk(root_directory: str, files_list: list, suffixes: list):
+
+class FileFilter:
+    """
+    Decides which files a search gathers. The files and directories are matched by
+    glob patterns relative to the searched directory, see _translate(). All the
+    patterns of a kind are compiled into a single regular expression, so a path is
+    matched once whatever the number of patterns.
+    """
+
+    def __init__(self, suffixes, include=(), exclude=()):
+        """
+        Initializes all the object's variables.
+        :param suffixes: A list containing the allowed suffixes to reformat, a file
+                         with one of the suffixes is included.
+        :param include: Glob patterns of additional files to include.
+        :param exclude: Glob patterns of files and directories to exclude, in addition
+                        to DEFAULT_EXCLUDES. An excluded directory is not searched at
+                        all.
+        """
+        exclude = DEFAULT_EXCLUDES + tuple(exclude)
+        self.include = _compile(
+            [f"*{glob.escape(suffix)}" for suffix in suffixes] + list(include)
+        )
+        self.exclude = _compile(exclude)
+        self.exclude_files = _compile(
+            [pattern for pattern in exclude if not pattern.endswith("/")]
+        )
+
+    def includes_directory(self, relative_path):
+        """
+        True if a directory is searched.
+        :param relative_path: Path of the directory relative to the searched directory,
+                              separated by "/".
+        :return: bool
+        """
+        return not self.exclude.fullmatch(relative_path)
+
+    def includes_file(self, relative_path):
+        """
+        True if a file is gathered, assuming its directory is searched.
+        :param relative_path: Path of the file relative to the searched directory,
+                              separated by "/".
+        :return: bool
+        """
+        return bool(self.include.fullmatch(relative_path)) and not (
+            self.exclude_files.fullmatch(relative_path)
+        )
+
+    def includes_path(self, relative_path):
+        """
+        True if a file is gathered, including the check of the directories it is in.
+        :param relative_path: Path of the file relative to the searched directory,
+                              separated by "/".
+        :return: bool
+        """
+        parts = relative_path.split("/")
+        return all(
+            self.includes_directory("/".join(parts[:i])) for i in range(1, len(parts))
+        ) and self.includes_file(relative_path)
+
+
+def walk(root_directory: str, file_filter: FileFilter):
     """
-    Gathers all permitted files to be formatted and saves the files in a list
+    Gathers all permitted files to be formatted, lazily, so the files can be handled
+    while the search goes on. Excluded directories are pruned before they are listed,
+    and the file types cached by os.scandir() are used, so listing a directory does not
+    stat its entries.
+    The entries of a directory are sorted by name, so the files are gathered in the
+    same order on any file system, see walk_order().
     :param root_directory: Root directory of the files to search in
-    :param files_list: List to append to the file names
-    :param suffixes: A list containing the allowed suffixes to reformat
-    :return: None
+    :param file_filter: FileFilter object, deciding which files are gathered.
+    :return: Generator of the paths of the files.
+    """
+    # Directories to list, as (path, path relative to root_directory) tuples.
+    # Note that the relative path of root_directory is empty.
+    directories = [(root_directory, "")]
+    while directories:
+        directory, relative_directory = directories.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            # The directory was removed or is not readable, as os.walk() does.
+            continue
+        subdirectories = []
+        with entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            relative_path = relative_directory + entry.name
+            try:
+                is_directory = entry.is_dir()
+            except OSError:
+                is_directory = False
+            if is_directory:
+                # Symbolic links to directories are not followed, as os.walk()
+                # does.
+                if not entry.is_symlink() and file_filter.includes_directory(
+                    relative_path
+                ):
+                    subdirectories.append((entry.path, relative_path + "/"))
+            elif file_filter.includes_file(relative_path):
+                yield entry.path
+        # Search the sub-directories in the order they were listed.
+        directories.extend(reversed(subdirectories))
+
+
+def walk_concurrently(root_directory: str, file_filter: FileFilter, threads: int):
+    """
+    Gathers all permitted files to be formatted like walk(), but lists the directories
+    with a pool of threads, for file systems where listing a directory is slow (e.g.
+    NFS). The files are yielded as soon as their directory is listed, in no particular
+    order, sort them with walk_order() to get the order of walk().
+    Unlike walk(), symbolic links to directories are followed, each directory is
+    listed once according to its device and inode, so a directory is not searched
+    twice and a loop of links does not hang the search.
+    :param root_directory: Root directory of the files to search in
+    :param file_filter: FileFilter object, deciding which files are gathered.
+    :param threads: Maximum number of directories that are listed concurrently.
+    :return: Generator of the paths of the files.
+    """
+    # (device, inode) of the directories that were listed or are being listed.
+    listed = set()
+    lock = threading.Lock()
+
+    def list_directory(directory, relative_directory):
+        """
+        Lists a directory, in a thread of the pool.
+        :return: Tuple containing the paths of the files that are gathered, and the
+                 sub-directories to list as (path, relative path) tuples.
+        """
+        files = []
+        subdirectories = []
+        try:
+            stat = os.stat(directory)
+            with lock:
+                if (stat.st_dev, stat.st_ino) in listed:
+                    return files, subdirectories
+                listed.add((stat.st_dev, stat.st_ino))
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    relative_path = relative_directory + entry.name
+                    try:
+                        is_directory = entry.is_dir()
+                    except OSError:
+                        is_directory = False
+                    if is_directory:
+                        if file_filter.includes_directory(relative_path):
+                            subdirectories.append((entry.path, relative_path + "/"))
+                    elif file_filter.includes_file(relative_path):
+                        files.append(entry.path)
+        except OSError:
+            # The directory was removed or is not readable, as walk() does.
+            pass
+        return files, subdirectories
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(list_directory, root_directory, "")}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, subdirectories = future.result()
+                    for subdirectory in subdirectories:
+                        pending.add(executor.submit(list_directory, *subdirectory))
+                    yield from files
+        finally:
+            # The search was stopped before its end, e.g. by an error.
+            for future in pending:
+                future.cancel()
+
+
+def walk_order(path: str):
+    """
+    Sort key of the paths gathered by walk(): the files of a directory come before its
+    sub-directories, and both are sorted by name.
+    :param path: Path of a file, gathered from the same root directory as the other
+                 paths it is sorted with.
+    :return: The sort key.
+    """
+    *directories, name = path.split(os.sep)
+    return tuple((1, directory) for directory in directories) + ((0, name),)
+
+
+def changed_since(root_directory: str, ref: str, file_filter: FileFilter):
+    """
+    Gathers the permitted files that changed since a git revision, i.e. the files that
+    differ from the revision (whether their changes are committed, staged or not) and
+    the untracked files that are not ignored by git. The tree itself is not searched,
+    so the cost depends on the size of the diff.
+    :param root_directory: Directory in a git repository, only the files in it and in
+                           its sub-directories are gathered.
+    :param ref: The git revision, e.g. a branch name or a commit.
+    :param file_filter: FileFilter object, deciding which files are gathered.
+    :return: List of the paths of the files.
+    """
+    # Note that the paths are relative to root_directory and separated by "/", and
+    # that deleted files are not listed.
+    changed = _git(
+        root_directory, "diff", "--name-only", "--diff-filter=d", "--relative", ref
+    )
+    untracked = _git(root_directory, "ls-files", "--others", "--exclude-standard")
+    files = []
+    for relative_path in sorted(set(changed + untracked)):
+        path = os.path.join(root_directory, relative_path)
+        # A path may be a submodule or a file that was deleted after the diff.
+        if file_filter.includes_path(relative_path) and os.path.isfile(path):
+            files.append(path)
+    return files
+
+
+def _git(directory, *args):
+    """
+    Runs a git command that lists paths.
+    :param directory: The directory that git runs in.
+    :param args: The git command and its options, the paths are separated by NUL
+                 characters so any file name can be read.
+    :return: List of the paths that the command printed.
     """
-    for path, subdirs, files in os.walk(root_directory):
-        if "formatter" in path:
+    try:
+        process = subprocess.run(
+            ["git", "-C", directory, *args, "-z", "--"], capture_output=True
+        )
+    except FileNotFoundError:
+        raise ValueError("--changed-since requires git.")
+    if process.returncode:
+        error = process.stderr.decode(errors="replace").strip()
+        raise ValueError(f"git {args[0]} failed: {error}")
+    return [os.fsdecode(path) for path in process.stdout.split(b"\0") if path]
+
+
+def _compile(patterns):
+    """
+    Compiles glob patterns into a single regular expression.
+    :param patterns: Glob patterns, see _translate().
+    :return: Compiled regular expression, matching none of the paths if there are no
+             patterns.
+    """
+    if not patterns:
+        return re.compile("(?!)")
+    return re.compile("|".join(f"(?:{_translate(pattern)})" for pattern in patterns))
+
+
+def _translate(pattern):
+    """
+    Translates a glob pattern into a regular expression matching relative paths.
+    "*" and "?" do not match "/", "**/" matches any number of directories, and
+    "[...]" matches one of the characters in the brackets ("[!...]" one of the others).
+    A pattern without "/" matches a name in any directory, e.g. "*_pb2.py", and a
+    pattern starting with "/" matches from the searched directory, e.g. "/build".
+    :param pattern: The glob pattern.
+    :return: The regular expression, as a string.
+    """
+    if pattern.startswith("/"):
+        pattern = pattern[1:]
+    elif "/" not in pattern.rstrip("/"):
+        pattern = "**/" + pattern
+    # A pattern that ends with "/" matches directories only, see FileFilter.
+    pattern = pattern.rstrip("/")
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
             continue
-        for name in files:
-            if (
-                any(name.endswith(suffix) for suffix in suffixes)
-            ) and "venv" not in path:
-                files_list.append(os.path.join(path, name))
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[" and "]" in pattern[i + 2 :]:
+            # Note that a "]" right after "[" is one of the characters.
+            end = pattern.index("]", i + 2)
+            characters = pattern[i + 1 : end].replace("\\", "\\\\")
+            if characters.startswith("!"):
+                characters = "^" + characters[1:]
+            elif characters.startswith("^"):
+                # A leading "^" is one of the characters, unlike in a regular
+                # expression.
+                characters = "\\" + characters
+            regex.append(f"[{characters}]")
+            i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return "".join(regex)
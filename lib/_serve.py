@@ -0,0 +1,244 @@
+# Ignore file
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import signal
+import socket
+import stat
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import _rewrite
+import _skip
+from _exceptions import NoSolutionError
+
+# The daemon started by --serve <socket_path> formats code for its clients over a Unix
+# socket, so the clients do not pay for starting the interpreter, importing the
+# formatter and reading the configurations. Each request and each response is a JSON
+# object written in a single line, a connection may send any number of requests:
+#   {"command": "format", "source": <code>} -> {"changed": <bool>, "output": <code>}
+#   {"command": "check", "source": <code>} -> {"changed": <bool>}
+#   {"command": "format", "path": <path>} -> {"changed": <bool>}, the file is rewritten
+#   {"command": "check", "path": <path>} -> {"changed": <bool>}
+# A request may override the formatting configurations of the daemon, for example
+# "config": {"max_line": 100}, see _rewrite.Config. A request that fails is answered
+# with {"error": <message>}.
+FORMAT = "format"
+CHECK = "check"
+COMMANDS = (FORMAT, CHECK)
+
+# Maximum number of configurations whose formatted digests are kept, see
+# Server.formatted_digests.
+MAX_CONFIGS = 8
+
+# Maximum size of a single request in bytes.
+MAX_REQUEST = 64 * 1024 * 1024
+
+# Errors that are sent to the client instead of stopping the daemon.
+_REQUEST_ERRORS = (
+    OSError,
+    SyntaxError,
+    ValueError,
+    TypeError,
+    RecursionError,
+    NoSolutionError,
+)
+
+
+class Server:
+    """
+    Serves the requests of concurrent clients with asyncio, the code itself is
+    formatted by a pool of threads using formatters of _rewrite.formatter_pool, so the
+    formatters and their configurations stay ready between requests.
+    """
+
+    def __init__(self, visitor):
+        """
+        Initializes all the object's variables.
+        :param visitor: Rewrite object, containing all the necessary configurations.
+        """
+        # Default configurations of the requests.
+        self.config = visitor.config()
+        self.fsync = visitor.fsync
+        # Ignored files, generated files and large files are not formatted, as in
+        # _rewrite.reformat().
+        self.skip_policy = _skip.SkipPolicy(
+            visitor.generated_markers, visitor.max_file_size
+        )
+        # The requests are handled concurrently by --threads threads, or by the default
+        # number of threads of ThreadPoolExecutor if --threads was not given, so a slow
+        # request does not hold the other clients.
+        self.executor = ThreadPoolExecutor(
+            max_workers=visitor.threads if visitor.threads > 1 else None
+        )
+        # Dictionary mapping a Config to the content digests of the files that were
+        # found formatted with it, these files are not formatted again. Only the
+        # MAX_CONFIGS configurations that were used last are kept.
+        self.formatted_digests = OrderedDict()
+        self._digests_lock = threading.Lock()
+        # Set by serve_forever(), see stop().
+        self._loop = None
+        self._stop = None
+
+    def handle(self, message):
+        """
+        Handles a single request.
+        :param message: The request, see the requests at the top of the module.
+        :return: The response.
+        """
+        try:
+            command = message.get("command")
+            if command not in COMMANDS:
+                raise ValueError(f"unknown command {command}.")
+            config = self.config._replace(**message.get("config", {}))
+            if "source" in message:
+                source = message["source"]
+                filename = message.get("filename", "<unknown>")
+                with _rewrite.formatter_pool.formatter(config) as formatter:
+                    if command == CHECK:
+                        # The formatting stops at the first difference.
+                        return {"changed": formatter.check_source(source, filename)}
+                    output = formatter.format_source(source, filename)
+                return {"changed": output != source, "output": output}
+            formatted_digests = self._formatted_digests(config)
+            with _rewrite.formatter_pool.formatter(config) as formatter:
+                changed, entry = _rewrite.rewrite_file(
+                    formatter,
+                    message["path"],
+                    command == CHECK,
+                    formatted_digests,
+                    self.fsync,
+                    skip_policy=self.skip_policy,
+                )
+            if entry is not None:
+                formatted_digests.add(entry[2])
+            return {"changed": changed}
+        except KeyError as error:
+            return {"error": f"missing {error} in the request"}
+        except _REQUEST_ERRORS as error:
+            return {"error": f"{type(error).__name__}: {error}"}
+
+    def _formatted_digests(self, config):
+        """
+        Returns the content digests of the files found formatted with a configuration.
+        :param config: The formatting configurations.
+        :return: Set of digests.
+        """
+        with self._digests_lock:
+            formatted_digests = self.formatted_digests.setdefault(config, set())
+            self.formatted_digests.move_to_end(config)
+            while len(self.formatted_digests) > MAX_CONFIGS:
+                self.formatted_digests.popitem(last=False)
+        return formatted_digests
+
+    async def serve_client(self, reader, writer):
+        """
+        Answers the requests of a connection until the client closes it.
+        :param reader: asyncio.StreamReader of the connection.
+        :param writer: asyncio.StreamWriter of the connection.
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # The request exceeds MAX_REQUEST, the rest of the connection
+                    # cannot be parsed.
+                    writer.write(b'{"error": "request too long"}\n')
+                    break
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError as error:
+                    response = {"error": f"bad request: {error}"}
+                else:
+                    response = await loop.run_in_executor(
+                        self.executor, self.handle, message
+                    )
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self, socket_path):
+        """
+        Listens on a Unix socket until stop() is called.
+        :param socket_path: Path of the socket, it is removed when the daemon stops.
+        :return: None
+        """
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        _remove_stale_socket(socket_path)
+        server = await asyncio.start_unix_server(
+            self.serve_client, socket_path, limit=MAX_REQUEST
+        )
+        logging.info(f"serving on {socket_path}")
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            # The socket may have been removed meanwhile, which must not hide the
+            # exception that stopped the daemon.
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+            self.executor.shutdown()
+
+    def stop(self):
+        """
+        Stops serve_forever(), may be called from any thread.
+        :return: None
+        """
+        self._loop.call_soon_threadsafe(self._stop.set)
+
+
+def _remove_stale_socket(socket_path):
+    """
+    Removes the socket of a daemon that did not stop properly. Nothing is removed if
+    the path is not a socket, e.g. a mistyped path of a source file.
+    :param socket_path: Path of the socket.
+    :return: None
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ValueError(f"{socket_path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+            return
+    raise OSError(f"a daemon is already serving on {socket_path}")
+
+
+def serve(visitor):
+    """
+    Runs the daemon until it is interrupted.
+    :param visitor: Rewrite object, containing all the necessary configurations.
+    :return: 0
+    """
+    try:
+        asyncio.run(_serve_until_terminated(Server(visitor), visitor.serve_socket))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+async def _serve_until_terminated(server, socket_path):
+    """
+    Runs a server until it is stopped by SIGTERM, so its socket is removed.
+    :param server: Server object.
+    :param socket_path: Path of the socket.
+    :return: None
+    """
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.stop)
+    await server.serve_forever(socket_path)
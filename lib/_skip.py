@@ -0,0 +1,56 @@
+# Ignore file
+# Marker of the files that are never formatted, in their first line.
+IGNORE_MARKER = b"Ignore file"
+# Number of bytes at the start of a file that are searched for the markers of generated
+# code.
+PREFIX_SIZE = 4096
+
+
+class SkipPolicy:
+    """
+    Decides whether a file is skipped by its size and its first bytes, so a skipped
+    file is never read entirely, decoded or parsed. A file is skipped if:
+    - It is larger than the maximum size, the file is not read at all.
+    - Its first line contains IGNORE_MARKER.
+    - Its first PREFIX_SIZE bytes contain a marker of generated code, e.g. @generated.
+    """
+
+    def __init__(self, generated_markers=(), max_size=None):
+        """
+        Initializes all the object's variables.
+        :param generated_markers: Strings marking generated files.
+        :param max_size: Maximum size of a formatted file in bytes, None for no limit.
+        """
+        self.generated_markers = [marker.encode() for marker in generated_markers]
+        self.max_size = max_size
+
+    def skips(self, prefix, size):
+        """
+        Checks whether a file is skipped.
+        :param prefix: The first PREFIX_SIZE bytes of the file, or all of them if the
+                       file is shorter.
+        :param size: Size of the file in bytes.
+        :return: The reason the file is skipped, None if it is not skipped.
+        """
+        if self.max_size is not None and size > self.max_size:
+            return "too large"
+        if IGNORE_MARKER in prefix.split(b"\n", 1)[0]:
+            return "ignored"
+        if any(marker in prefix for marker in self.generated_markers):
+            return "generated"
+        return None
+
+    def read(self, f, size):
+        """
+        Reads a file unless it is skipped, the prefix that is checked is the start of
+        the content that is returned, so the file is read once.
+        :param f: The file, opened in binary mode.
+        :param size: Size of the file in bytes.
+        :return: The content of the file, None if it is skipped.
+        """
+        if self.max_size is not None and size > self.max_size:
+            return None
+        prefix = f.read(PREFIX_SIZE)
+        if self.skips(prefix, size) is not None:
+            return None
+        return prefix + f.read()
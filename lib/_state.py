@@ -0,0 +1,55 @@
+# Ignore file
+
+
+class LayoutState:
+    """
+    State of the file that a formatter is currently formatting.
+    The state is kept apart from the formatter's configurations, so starting a new file
+    replaces it at once with a new LayoutState, and nothing can be left over from the
+    previous file, see Rewrite.cleanup().
+    """
+
+    __slots__ = (
+        "exceeding_nodes",
+        "first_long_node",
+        "last_body_node",
+        "last_node",
+        "latest_class",
+        "long_node",
+        "nested_scope",
+        "starting_new_line_node",
+        "starting_new_line_checkpoint",
+    )
+
+    def __init__(self):
+        """
+        Initializes all the object's variables.
+        """
+        # Nodes that exceed the maximum line length, they are printed in their long
+        # form, see Rewrite.check_line(). Note that the AST itself is never modified.
+        self.exceeding_nodes = set()
+        # Is this the first node that is part of a long node.
+        self.first_long_node = False  # TODO name is not clear, choose better wording.
+        # List which holds data about the nested body of a function, each item in the
+        # list contains a tuple, the first value stores the node of the function, and
+        # the second value holds a boolean value which indicates whether the nested
+        # function is the last item in the body.
+        # Note that in case of a function which does not include any nested function
+        # declaration, the list will hold a tuple containing None values (None, None).
+        self.last_body_node = []
+        # True if the system is handling the last node in Module, False otherwise.
+        self.last_node = False
+        # True if the the system is handling the last node in a class body, False
+        # otherwise.
+        self.latest_class = False
+        # Are we managing a node that exceeds the limit.
+        self.long_node = False
+        # Scope level that indicates the indentation/nested levels.
+        # The starting value is zero which translates to global scope, with each new
+        # scope, the value will be incremented later decremented when the scope ends.
+        self.nested_scope = 0
+        # Latest node that starts a line (in body/function/class).
+        self.starting_new_line_node = None
+        # Emitter checkpoint taken when starting_new_line_node started, a long line
+        # rolls back to it, see Rewrite.check_line().
+        self.starting_new_line_checkpoint = None
@@ -0,0 +1,86 @@
+# Ignore file
+import ast
+import tokenize
+
+# Keywords that continue the compound statement that precedes them.
+_CONTINUATIONS = ("else", "elif", "except", "finally")
+
+
+def split_statements(readline):
+    """
+    Splits Python source code into the source code of its top level statements, while
+    the code is being read. A statement keeps the decorators that precede it and the
+    clauses that follow it (e.g. else), and the blank lines and comments that follow a
+    statement are part of it.
+    :param readline: Function returning the next line of the code, "" at the end.
+    :return: Generator of (first line number, source code) tuples.
+    """
+    # Lines that were read and were not handed over yet, the first one is line number
+    # <first_line>.
+    lines = []
+    first_line = 1
+
+    def read():
+        line = readline()
+        if line:
+            lines.append(line)
+        return line
+
+    depth = 0
+    # True if the next token starts a logical line.
+    line_start = True
+    # True if the latest top level logical line was a decorator.
+    decorated = False
+    started = False
+    try:
+        for token in tokenize.generate_tokens(read):
+            kind = token.type
+            if kind == tokenize.INDENT:
+                depth += 1
+            elif kind == tokenize.DEDENT:
+                depth -= 1
+            elif kind == tokenize.NEWLINE:
+                line_start = True
+            elif kind in (tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER):
+                continue
+            elif line_start:
+                line_start = False
+                if depth:
+                    continue
+                if started and not decorated and token.string not in _CONTINUATIONS:
+                    # The token starts a new statement, hand over the lines that
+                    # precede it.
+                    size = token.start[0] - first_line
+                    yield first_line, "".join(lines[:size])
+                    del lines[:size]
+                    first_line += size
+                started = True
+                decorated = token.string == "@"
+    except tokenize.TokenError:
+        # The code is not valid, parsing the rest of the code reports the error.
+        while read():
+            pass
+    if lines:
+        yield first_line, "".join(lines)
+
+
+def parse_statements(readline, filename="<unknown>"):
+    """
+    Parses Python source code statement by statement, while the code is being read, so
+    only the tree of the current top level statement is kept in memory.
+    :param readline: Function returning the next line of the code, "" at the end.
+    :param filename: Name of the file, used in error messages.
+    :return: Generator of top level statement nodes, see split_statements().
+    """
+    for first_line, source in split_statements(readline):
+        try:
+            module = ast.parse(source, filename)
+        except SyntaxError as error:
+            # Report the line in the whole code.
+            if error.lineno is not None:
+                error.lineno += first_line - 1
+            if getattr(error, "end_lineno", None) is not None:
+                error.end_lineno += first_line - 1
+            raise
+        # Note that the line numbers of the statements start at the statement.
+        yield from module.body
@@ -0,0 +1,18 @@
+# Ignore file
+import logging
+
+# True if the formatter was started with --trace.
+# Every trace message in the formatter is guarded by this flag, so the message is not
+# built and logging is not called at all while tracing is off.
+enabled = False
+
+
+def enable():
+    """
+    Turns tracing on, the trace is written to stderr with the DEBUG level.
+    :return: None
+    """
+    global enabled
+    enabled = True
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+    logging.getLogger().setLevel(logging.DEBUG)
@@ -0,0 +1,253 @@
+# Ignore file
+import _ast
+
+
+class FlatWidths:
+    """
+    Memoized table of the width of nodes when they are printed in a single line by the
+    legacy layout, see Rewrite._visit_body_node().
+    The width of a node is computed bottom up from the widths of its children, and it
+    is kept until the table is cleared, so each node is measured once per file. Nodes
+    that are not always printed in a single line (e.g. compound statements and
+    dictionaries), or whose printing is not modeled here, have no width (None).
+    """
+
+    def __init__(self, formatter):
+        """
+        Initializes all the object's variables.
+        :param formatter: Rewrite object, the operators and the configurations that
+                          affect the width of a line are taken from it.
+        """
+        self.formatter = formatter
+        # Dictionary mapping each measured node to its width.
+        self.table = {}
+        # Dictionary mapping each node type to the function computing its width.
+        self.formulas = {
+            _ast.Assert: self._assert,
+            _ast.Assign: self._assign,
+            _ast.Attribute: self._attribute,
+            _ast.AugAssign: self._aug_assign,
+            _ast.BinOp: self._bin_op,
+            _ast.BoolOp: self._bool_op,
+            _ast.Break: lambda node: len("break"),
+            _ast.Call: self._call,
+            _ast.Compare: self._compare,
+            _ast.Constant: self._constant,
+            _ast.Continue: lambda node: len("continue"),
+            _ast.Delete: self._delete,
+            _ast.Expr: lambda node: self._width(node.value),
+            _ast.Global: self._global,
+            _ast.IfExp: self._if_exp,
+            _ast.Import: self._import,
+            _ast.ImportFrom: self._import_from,
+            _ast.List: self._elements,
+            _ast.ListComp: self._list_comp,
+            _ast.Name: lambda node: len(node.id),
+            _ast.NamedExpr: self._named_expr,
+            _ast.Nonlocal: self._global,
+            _ast.Pass: lambda node: len("pass"),
+            _ast.Raise: self._raise,
+            _ast.Return: self._return,
+            _ast.Set: self._elements,
+            _ast.Slice: self._slice,
+            _ast.Starred: lambda node: 1 + self._width(node.value),
+            _ast.Subscript: self._subscript,
+            _ast.Tuple: self._elements,
+            _ast.UnaryOp: self._unary_op,
+            _ast.comprehension: self._comprehension,
+            _ast.keyword: self._keyword,
+        }
+        # Note that ast.Index was removed in Python 3.9.
+        if hasattr(_ast, "Index") and isinstance(_ast.Index, type):
+            self.formulas[_ast.Index] = self._index
+
+    def clear(self):
+        """
+        Removes all the widths in order to measure another file.
+        :return: None
+        """
+        self.table.clear()
+
+    def width(self, node):
+        """
+        Returns the width of a node when it is printed in a single line.
+        :param node: AST node.
+        :return: Number of characters, or None if the width is unknown.
+        """
+        table = self.table
+        if node in table:
+            return table[node]
+        try:
+            return self._width(node)
+        except (KeyError, RecursionError):
+            # The node, or one of its children, has no width.
+            table[node] = None
+            return None
+
+    def _width(self, node):
+        """
+        Returns the width of a node, computing and storing it unless it is stored.
+        Raises KeyError if the node has no width.
+        :param node: AST node.
+        :return: Number of characters.
+        """
+        table = self.table
+        try:
+            width = table[node]
+        except KeyError:
+            width = table[node] = self.formulas[type(node)](node)
+        if width is None:
+            # The node was measured already, and has no width.
+            raise KeyError(node)
+        return width
+
+    def _sum(self, nodes, separator=", "):
+        """Width of nodes printed one after another, separated by separator."""
+        width = self._width
+        return sum(width(node) for node in nodes) + len(separator) * max(
+            len(nodes) - 1, 0
+        )
+
+    def _assert(self, node):
+        width = len("assert ") + self._width(node.test)
+        if node.msg:
+            width += len(", ") + self._width(node.msg)
+        return width
+
+    def _assign(self, node):
+        return self._sum(node.targets, " = ") + len(" = ") + self._width(node.value)
+
+    def _attribute(self, node):
+        return self._width(node.value) + len(".") + len(node.attr)
+
+    def _aug_assign(self, node):
+        operator = f" {self.formatter.ar_ops[type(node.op)]}= "
+        return self._width(node.target) + len(operator) + self._width(node.value)
+
+    def _bin_op(self, node):
+        operator = f" {self.formatter.ar_ops[type(node.op)]} "
+        return self._width(node.left) + len(operator) + self._width(node.right)
+
+    def _bool_op(self, node):
+        operator = " and " if isinstance(node.op, _ast.And) else " or "
+        return self._sum(node.values, operator)
+
+    def _call(self, node):
+        return self._width(node.func) + 2 + self._sum(node.args + node.keywords)
+
+    def _compare(self, node):
+        width = self._width(node.left) + len(" ")
+        compare_ops = self.formatter.compare_ops
+        for op, comparator in zip(node.ops, node.comparators):
+            width += len(f"{compare_ops[type(op)]} ") + self._width(comparator)
+        return width + len(" ") * (len(node.ops) - 1)
+
+    def _constant(self, node):
+        if isinstance(node.value, str):
+            # Strings are printed between quotes, with escape sequences.
+            return len(self.formatter.string_literal(node.value))
+        return len(f"{node.value}")
+
+    def _delete(self, node):
+        return len("del ") + self._sum(node.targets)
+
+    def _elements(self, node):
+        # Lists, sets and tuples.
+        return 2 + self._sum(node.elts)
+
+    @staticmethod
+    def _global(node):
+        # Global and Nonlocal.
+        keyword = "global " if isinstance(node, _ast.Global) else "nonlocal "
+        return len(keyword) + len(", ".join(node.names))
+
+    def _if_exp(self, node):
+        width = self._width
+        return (
+            width(node.body)
+            + len(" if ")
+            + width(node.test)
+            + len(" else ")
+            + width(node.orelse)
+        )
+
+    def _import(self, node):
+        names = [name.name for name in node.names]
+        if self.formatter.multiple_imports:
+            return len("import ") + len(", ".join(names))
+        if len(names) != 1:
+            # Each module is imported in its own line.
+            raise KeyError(node)
+        return len(f"import {names[0]}")
+
+    @staticmethod
+    def _import_from(node):
+        names = ", ".join(name.name for name in node.names)
+        return len(f"from {node.module} import ") + len(names)
+
+    def _index(self, node):
+        return self._width(node.value)
+
+    def _keyword(self, node):
+        if node.arg:
+            equal = " = " if self.formatter.space_between_arguments else "="
+            return len(node.arg) + len(equal) + self._width(node.value)
+        return len("**") + self._width(node.value)
+
+    def _list_comp(self, node):
+        width = self._width
+        return (
+            2
+            + width(node.elt)
+            + sum(len(" for ") + width(generator) for generator in node.generators)
+        )
+
+    def _comprehension(self, node):
+        width = self._width
+        return (
+            width(node.target)
+            + len(" in ")
+            + width(node.iter)
+            + sum(len(" if ") + width(if_node) for if_node in node.ifs)
+        )
+
+    def _named_expr(self, node):
+        return 2 + self._width(node.target) + len(" := ") + self._width(node.value)
+
+    def _raise(self, node):
+        width = len("raise")
+        if node.exc:
+            width += len(" ") + self._width(node.exc)
+        if node.cause:
+            width += len(" from ") + self._width(node.cause)
+        return width
+
+    def _return(self, node):
+        if node.value:
+            return len("return ") + self._width(node.value)
+        return len("return")
+
+    def _slice(self, node):
+        # Note that the brackets are counted by _subscript().
+        width = len(":")
+        if node.lower:
+            width += self._width(node.lower)
+        if node.upper:
+            width += self._width(node.upper)
+        if node.step:
+            width += len(":") + self._width(node.step)
+        return width
+
+    def _subscript(self, node):
+        width = self._width(node.value) + len("[]")
+        if isinstance(node.slice, _ast.Tuple):
+            # The indices are printed without parentheses, see visit_Subscript().
+            elements = node.slice.elts
+            return width + self._sum(elements) + (len(",") if len(elements) == 1 else 0)
+        return width + self._width(node.slice)
+
+    def _unary_op(self, node):
+        operator = self.formatter.unary_ops[type(node.op)]
+        if isinstance(node.op, _ast.Not):
+            operator += " "
+        return len(operator) + self._width(node.operand)
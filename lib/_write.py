@@ -0,0 +1,46 @@
+# Ignore file
+import os
+import stat
+import tempfile
+
+
+def write_atomic(target_file, data, mode=None, fsync=False):
+    """
+    Replaces the content of a file at once.
+    The data is written to a temporary file in the same directory, which then replaces
+    the file, so readers never see a partially written file and an interrupted run
+    never truncates it.
+    :param target_file: Path of the file, if it is a symbolic link, the file that the
+                        link points to is replaced.
+    :param data: The new content (bytes).
+    :param mode: Permission bits of the new file, None to use the defaults.
+    :param fsync: If True, the data is flushed to the disk before the file is replaced.
+    :return: None
+    """
+    target_file = os.path.realpath(target_file)
+    directory = os.path.dirname(target_file)
+    descriptor, temporary_path = tempfile.mkstemp(
+        dir=directory, prefix=".", suffix=".pyformatter"
+    )
+    try:
+        with os.fdopen(descriptor, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(temporary_path, stat.S_IMODE(mode))
+        os.replace(temporary_path, target_file)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
+    if fsync and hasattr(os, "O_DIRECTORY"):
+        # Make the rename itself durable.
+        directory_descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory_descriptor)
+        finally:
+            os.close(directory_descriptor)
@@ -0,0 +1,90 @@
+# Ignore file
+"""
+Formats Python code in memory, for tools that embed the formatter.
+Unlike the command line, the functions of this module never read conf.txt, never write
+to a file and never exit, the configurations are given explicitly as a Config, for
+example:
+    config = api.DEFAULT_CONFIG._replace(max_line=100)
+    formatted = api.format_string(source, config)
+"""
+import time
+from collections import namedtuple
+
+import _rewrite
+from _exceptions import NoSolutionError
+
+# The formatting configurations, see _rewrite.Config.
+Config = _rewrite.Config
+# The configurations of a formatter that was not configured, the same as the defaults
+# of conf.txt.
+DEFAULT_CONFIG = _rewrite.Rewrite().config()
+
+# Result of formatting a file:
+# path: Path of the file.
+# changed: True if the formatted code differs from the source code.
+# output: The formatted code, None if the file could not be formatted.
+# seconds: Time spent reading and formatting the file.
+# error: The exception that stopped the formatting, None if the file was formatted.
+Result = namedtuple("Result", ("path", "changed", "output", "seconds", "error"))
+
+# Errors that are reported in the result of a file instead of being raised.
+_FILE_ERRORS = (OSError, SyntaxError, ValueError, RecursionError, NoSolutionError)
+
+
+def format_string(
+    source, config=DEFAULT_CONFIG, filename="<unknown>", line_ranges=None
+):
+    """
+    Formats Python source code.
+    :param source: The source code.
+    :param config: The formatting configurations.
+    :param filename: Name of the file, used in error messages.
+    :param line_ranges: List of (first line, last line) tuples, if given, only the
+                        statements that overlap these lines are formatted and the rest
+                        of the code is kept as is, see Rewrite.format_ranges().
+    :return: The formatted code.
+    """
+    with _rewrite.formatter_pool.formatter(config) as formatter:
+        return formatter.format_source(source, filename, line_ranges)
+
+
+def format_stream(readline, write, config=DEFAULT_CONFIG, filename="<unknown>"):
+    """
+    Formats Python source code statement by statement while it is being read, for
+    code that is too large to be kept in memory, see Rewrite.format_stream().
+    :param readline: Function returning the next line of the code, "" at the end.
+    :param write: Function receiving the formatted code, piece by piece.
+    :param config: The formatting configurations.
+    :param filename: Name of the file, used in error messages.
+    :return: None
+    """
+    with _rewrite.formatter_pool.formatter(config) as formatter:
+        formatter.format_stream(readline, write, filename)
+
+
+def format_files(paths, config=DEFAULT_CONFIG, jobs=1):
+    """
+    Formats files without changing them.
+    :param paths: List of paths.
+    :param config: The formatting configurations.
+    :param jobs: Number of processes formatting the files, see _rewrite.map_files().
+    :return: List of Result objects, in the same order of paths.
+    """
+    visitor = _rewrite.Rewrite.from_settings(config._asdict())
+    visitor.jobs = jobs
+    return _rewrite.map_files(visitor, _format_result, list(paths))
+
+
+def _format_result(formatter, path):
+    """
+    Formats a file, see format_files().
+    :param formatter: Rewrite object.
+    :param path: Path of the file.
+    :return: Result object.
+    """
+    start = time.perf_counter()
+    try:
+        source, output = _rewrite.format_file(formatter, path)
+    except _FILE_ERRORS as error:
+        return Result(path, False, None, time.perf_counter() - start, error)
+    return Result(path, output != source, output, time.perf_counter() - start, None)
@@ -8,6 +8,8 @@ import _rewrite
 def main(*argv):
     try:
         _rewrite.rewrite(*argv)
+    except SystemExit:
+        raise
     except:
         traceback.print_exc()
         exit(2)
@@ -1,29 +1,26 @@
-import filecmp
+import ast
 import os
 import pathlib
 import pytest
+from lib import _ranges
 from lib import _rewrite
+from lib import _search
+from lib import _skip
 from _exceptions import NoSolutionError
 import main
 
 
-def confirm(output):
-    compare_to = "modified_file.py"
+def confirm(output, formatted):
+    with open(output) as f:
+        expected = f.read()
     try:
-        assert filecmp.cmp(output, compare_to)
+        assert formatted == expected
     except AssertionError as e:
-        with open(compare_to) as f:
-            if not os.path.isdir("logs"):
-                os.mkdir("logs")
-            lines = f.readlines()
-            lines = [l for l in lines]
-            with open(
-                f"logs/log_{output[:len(output)-len('/output.py')]}.py", "w"
-            ) as f1:
-                f1.writelines(lines)
+        if not os.path.isdir("logs"):
+            os.mkdir("logs")
+        with open(f"logs/log_{output.parent.name}.py", "w") as f:
+            f.write(formatted)
         raise e
-    finally:
-        open(compare_to, "w").close()  # Empty file
 
 
 def make_test(
@@ -34,6 +31,7 @@ def make_test(
     multiple_imports=False,
     vertical_definition_lines=2,
     nested_lines=1,
+    layout="legacy",
 ):
     input_file = pathlib.Path(__file__).parent.absolute().joinpath(input_file)
     output_file = pathlib.Path(__file__).parent.absolute().joinpath(output_file)
@@ -46,14 +44,16 @@ def make_test(
         vertical_definition_lines,
         "--nested-lines",
         nested_lines,
+        "--layout",
+        layout,
     )
     if space_between_arguments:
         args = args + ("--space-between-arguments",)
     if multiple_imports:
         args = args + ("--multiple-imports",)
-    main.main(*args)
-    confirm(output_file)
-    _rewrite.file = open("modified_file.py", "a")
+    visitor = _rewrite.configure(*args)
+    _, formatted = _rewrite.format_file(visitor, visitor.target_file)
+    confirm(output_file, formatted)
 
 
 def test_syntax_error():
@@ -271,6 +271,86 @@ def test_bad_max_line_length():
         make_test(input_file, output_file, max_line=30)
 
 
+def test_document_layout():
+    input_file, output_file = (
+        "test_document_layout/input.py",
+        "test_document_layout/output.py",
+    )
+    make_test(input_file, output_file, layout="document")
+
+
+def test_document_layout_max_line_length():
+    # Lines that cannot be shortened are printed as they are instead of failing.
+    input_file = pathlib.Path(__file__).parent.joinpath(
+        "test_command_line_args/input.py"
+    )
+    visitor = _rewrite.configure("--layout", "document", "--max-line", "30")
+    formatted = visitor.format_source(input_file.read_text())
+    assert "    * 1000000\n" in formatted
+    assert compile(formatted, str(input_file), "exec")
+
+
+def test_long_line_in_block():
+    # Only the statement containing the long line is printed again.
+    source = (
+        "if condition:\n"
+        "    value = 1\n"
+        "    function(first_argument, second_argument, third_argument)\n"
+    )
+    visitor = _rewrite.configure("--max-line", "40")
+    formatted = visitor.format_source(source)
+    assert formatted == (
+        "if condition:\n"
+        "    value = 1\n"
+        "    function(\n"
+        "        first_argument,\n"
+        "        second_argument,\n"
+        "        third_argument\n"
+        "    )\n"
+    )
+
+
+def test_long_statement_without_long_form():
+    # A long statement that cannot be shortened is kept as is, and neither it nor
+    # the statement that follows it is lost.
+    statement = "event = Event(time, priority, next(generator), action, arguments)"
+    blocks = {
+        "": "",
+        "if x:": "",
+        "with x:": "",
+        "for x in y:": "",
+        "while x:": "else:\n    y = 2\n",
+        "try:": "except Error:\n    y = 2\n",
+        "def f():": "",
+    }
+    for header, end in blocks.items():
+        indentation = "    " if header else ""
+        source = f"{header}\n" if header else ""
+        source += f"{indentation}{statement}\n{indentation}y = 1\n{end}"
+        for engine in _rewrite.ENGINES:
+            visitor = _rewrite.configure("--max-line", "60", "--engine", engine)
+            formatted = visitor.format_source(source)
+            assert ast.dump(ast.parse(formatted)) == ast.dump(ast.parse(source))
+
+
+def test_iterative_engine():
+    # The iterative engine formats like the recursive engine, without its depth
+    # limit.
+    recursive = _rewrite.configure("--engine", "recursive")
+    iterative = _rewrite.configure("--engine", "iterative")
+    for input_file in pathlib.Path(__file__).parent.glob("test_*/input.py"):
+        source = input_file.read_text()
+        assert iterative.format_source(source) == recursive.format_source(source)
+    source = "total = " + " + ".join(f"operand_{i}" for i in range(1000)) + "\n"
+    with pytest.raises(NoSolutionError):
+        recursive.format_source(source)
+    formatted = iterative.format_source(source)
+    # Note that ast.dump() is recursive as well.
+    assert [
+        getattr(node, "id", None) for node in ast.walk(ast.parse(formatted))
+    ] == [getattr(node, "id", None) for node in ast.walk(ast.parse(source))]
+
+
 def test_space_arguments():
     input_file, output_file = (
         "test_space_arguments/input.py",
@@ -301,3 +381,654 @@ def test_nested_lines():
         "test_nested_lines/output.py",
     )
     make_test(input_file, output_file, nested_lines=3)
+
+
+def test_threads():
+    # Format every test input several times concurrently, the result must be identical
+    # to formatting the files one after the other.
+    input_files = sorted(pathlib.Path(__file__).parent.absolute().glob("*/input.py"))
+    input_files = [str(input_file) for input_file in input_files] * 8
+    serial = _rewrite.map_files(
+        _rewrite.configure("--jobs", "1"), _rewrite.format_file, input_files
+    )
+    concurrent = _rewrite.map_files(
+        _rewrite.configure("--threads", "8"), _rewrite.format_file, input_files
+    )
+    assert concurrent == serial
+
+
+def test_jobs(monkeypatch):
+    # Formatting the test inputs with worker processes must give the same results, in
+    # the same order, as formatting them in the main process.
+    input_files = sorted(pathlib.Path(__file__).parent.absolute().glob("*/input.py"))
+    input_files = [str(input_file) for input_file in input_files]
+    serial = _rewrite.map_files(
+        _rewrite.configure("--jobs", "1"), _rewrite.format_file, input_files
+    )
+    # Use small batches, so the files are spread over several workers.
+    monkeypatch.setattr(_rewrite, "BATCH_SIZE", 512)
+    parallel = _rewrite.map_files(
+        _rewrite.configure("--jobs", "4"), _rewrite.format_file, input_files
+    )
+    assert parallel == serial
+
+
+def test_cache(tmp_path, monkeypatch):
+    # A file that was found formatted is not read again while it does not change.
+    monkeypatch.chdir(tmp_path)
+    target_file = tmp_path / "formatted.py"
+    formatted = pathlib.Path(__file__).parent.joinpath("test_general/output.py")
+    target_file.write_text(formatted.read_text())
+    visitor = _rewrite.configure("--target-file", str(target_file))
+    visitor.files = [str(target_file)]
+    _rewrite.reformat(visitor)
+    assert os.listdir(tmp_path.joinpath(".pyformatter_cache"))
+
+    def read_file(target_file):
+        raise AssertionError(f"{target_file} was read")
+
+    monkeypatch.setattr(_rewrite, "read_file", read_file)
+    visitor.files = [str(target_file)]
+    _rewrite.reformat(visitor)
+
+
+def test_write_atomic(tmp_path):
+    # The file is replaced as a whole, keeps its mode and no temporary file is left.
+    target_file = tmp_path / "target.py"
+    target_file.write_text("x=1\n")
+    target_file.chmod(0o750)
+    link = tmp_path / "link.py"
+    link.symlink_to(target_file)
+    mode = target_file.stat().st_mode
+    _rewrite._write.write_atomic(str(link), b"x = 1\n", mode, fsync=True)
+    assert target_file.read_text() == "x = 1\n"
+    assert link.is_symlink()
+    assert target_file.stat().st_mode & 0o777 == 0o750
+    assert sorted(os.listdir(tmp_path)) == ["link.py", "target.py"]
+
+
+def test_check_only_does_not_write(tmp_path, monkeypatch):
+    # A check only run must leave the disk untouched, including the cache.
+    monkeypatch.chdir(tmp_path)
+    target_file = tmp_path / "unformatted.py"
+    target_file.write_text("x=(1,\n2)\n")
+    visitor = _rewrite.configure("--target-file", str(target_file), "--check-only")
+    visitor.files = [str(target_file)]
+
+    def write_atomic(*args):
+        raise AssertionError("the disk was written")
+
+    monkeypatch.setattr(_rewrite._write, "write_atomic", write_atomic)
+    with pytest.raises(SystemExit):
+        _rewrite.reformat(visitor)
+    assert os.listdir(tmp_path) == ["unformatted.py"]
+
+
+def test_flat_widths():
+    # The width of each statement is the length of the line printed for it.
+    visitor = _rewrite.configure("--max-line", "1000")
+    measured = 0
+    for input_file in pathlib.Path(__file__).parent.glob("test_*/input.py"):
+        tree = ast.parse(input_file.read_text())
+        for node in ast.walk(tree):
+            body = getattr(node, "body", None)
+            for statement in body if isinstance(body, list) else []:
+                width = visitor.flat_widths.width(statement)
+                if width is None:
+                    continue
+                visitor.visit(statement, new_line=False)
+                assert len(visitor.emitter.current_line) == width
+                visitor.cleanup()
+                measured += 1
+    assert measured > 100
+    # Subscripts print their brackets, and strings their quotes and escapes.
+    source = (
+        "x[i]\n"
+        "x[1:2, ::3]\n"
+        "x[(1,)]\n"
+        "d['key'][0][1:]\n"
+        "y = 'a\\nb\\t\\\\c'\n"
+        "z = 'it\\'s \"quoted\"'\n"
+    )
+    for statement in ast.parse(source).body:
+        width = visitor.flat_widths.width(statement)
+        visitor.visit(statement, new_line=False)
+        line = visitor.emitter.current_line
+        assert ast.dump(ast.parse(line).body[0]) == ast.dump(statement)
+        assert len(line) == width
+        # The width is taken from the table once measured.
+        assert visitor.flat_widths.width(statement) == width
+        visitor.cleanup()
+
+
+def test_body_metadata(monkeypatch):
+    # The docstring of each body is cleaned once, however many statements it has.
+    calls = []
+    get_docstring = ast.get_docstring
+    monkeypatch.setattr(
+        ast, "get_docstring", lambda node: calls.append(node) or get_docstring(node)
+    )
+    source = 'class A:\n    """Doc."""\n' + "    x = 1\n" * 100
+    assert _rewrite.Rewrite().format_source(source).count("x = 1") == 100
+    assert len(calls) == 2
+
+
+def test_formatter_pool():
+    # A formatter returns to the pool reset, even if formatting failed.
+    pool = _rewrite.FormatterPool()
+    config = _rewrite.Rewrite().config()
+    source = "def function(first, second):\n    return first + second\n"
+    with pytest.raises(RuntimeError):
+        with pool.formatter(config) as formatter:
+            formatter.visit(ast.parse(source))
+            raise RuntimeError
+    with pool.formatter(config) as reused:
+        assert reused is formatter
+        assert reused.format_source(source) == _rewrite.Rewrite().format_source(source)
+    assert pool.acquire(config._replace(max_line=40)) is not formatter
+
+
+def test_api(tmp_path):
+    from lib import api
+
+    # The files are formatted in memory, as the command line would format them.
+    input_files = sorted(pathlib.Path(__file__).parent.absolute().glob("*/input.py"))
+    input_files = [str(input_file) for input_file in input_files]
+    broken = tmp_path / "broken.py"
+    broken.write_text("def function(:\n")
+    config = api.DEFAULT_CONFIG
+    results = api.format_files(input_files + [str(broken)], config)
+    parallel = api.format_files(input_files + [str(broken)], config, jobs=2)
+    assert [result[:3] for result in parallel] == [result[:3] for result in results]
+    formatter = _rewrite.Rewrite()
+    for input_file, result in zip(input_files, results):
+        try:
+            expected = formatter.format_source(pathlib.Path(input_file).read_text())
+        except NoSolutionError:
+            assert isinstance(result.error, NoSolutionError)
+            continue
+        assert result.output == expected
+        assert result.changed == (expected != pathlib.Path(input_file).read_text())
+        assert result.error is None
+    assert isinstance(results[-1].error, SyntaxError)
+    assert broken.read_text() == "def function(:\n"
+    source = "def function(first_argument, second_argument):\n    pass\n"
+    assert api.format_string(source, config._replace(max_line=40)) == (
+        "def function(\n    first_argument,\n    second_argument\n):\n    pass\n"
+    )
+
+
+def test_serve(tmp_path):
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    import _client
+    import _serve
+
+    # The daemon answers concurrent clients as the formatter would.
+    socket_path = str(tmp_path / "formatter.sock")
+    server = _serve.Server(_rewrite.configure("--threads", "4"))
+    thread = threading.Thread(
+        target=lambda: _serve.asyncio.run(server.serve_forever(socket_path))
+    )
+    thread.start()
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        sources = [f"value_{i}=[ {i},{i} ]\n" for i in range(20)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(
+                executor.map(
+                    lambda source: _client.request(
+                        socket_path, {"command": "format", "source": source}
+                    ),
+                    sources,
+                )
+            )
+        for i, response in enumerate(responses):
+            assert response == {"changed": True, "output": f"value_{i} = [{i}, {i}]\n"}
+        target_file = tmp_path / "target.py"
+        target_file.write_text("x=1\n")
+        message = {"command": "check", "path": str(target_file)}
+        assert _client.request(socket_path, message) == {"changed": True}
+        assert target_file.read_text() == "x=1\n"
+        message = {"command": "check", "source": "x = 1\n", "config": {"layout": "x"}}
+        assert "error" in _client.request(socket_path, message)
+    finally:
+        server.stop()
+        thread.join()
+    assert not os.path.exists(socket_path)
+
+
+def test_stdin(monkeypatch, capsysbinary):
+    import io
+
+    def run(source, *argv):
+        stdin = io.TextIOWrapper(io.BytesIO(source.encode()))
+        monkeypatch.setattr("sys.stdin", stdin)
+        return _rewrite.format_stdin(_rewrite.configure("--stdin", *argv))
+
+    assert run("x=(1,\n2)\n") == 0
+    assert capsysbinary.readouterr().out == b"x = (1, 2)\n"
+    # Code whose file does not have an allowed suffix is not formatted.
+    assert run("x=(1,\n2)\n", "--stdin-filename", "notes.txt") == 0
+    assert capsysbinary.readouterr().out == b"x=(1,\n2)\n"
+    # Check only runs report through the exit code.
+    assert run("x = (1, 2)\n", "--check-only") == 0
+    with pytest.raises(SystemExit, match="1"):
+        run("x=(1,\n2)\n", "--check-only")
+    assert capsysbinary.readouterr().out == b""
+
+
+def test_format_stream():
+    # Formatting statement by statement gives the same code as formatting at once.
+    import io
+
+    for layout in _rewrite.LAYOUTS:
+        visitor = _rewrite.configure("--layout", layout)
+        for input_file in pathlib.Path(__file__).parent.glob("test_*/input.py"):
+            source = input_file.read_text()
+            try:
+                expected = visitor.format_source(source)
+            except NoSolutionError:
+                continue
+            pieces = []
+            visitor.format_stream(io.StringIO(source).readline, pieces.append)
+            assert "".join(pieces) == expected
+    # Only stdin is streamed.
+    assert _rewrite.configure("--stdin", "--stream").stream
+    with pytest.raises(ValueError, match="--stream requires --stdin"):
+        _rewrite.configure("--target-file", "input.py", "--stream")
+
+
+def test_reuse_after_failure():
+    # A formatter that failed formats the next file as a new formatter would.
+    visitor = _rewrite.configure("--max-line", "40")
+    # The well formed file has nested scopes and a long line, so the state that a
+    # failure could leak (e.g. indentation, long nodes) changes its formatted code.
+    source = (
+        "class A:\n"
+        "    def function(self, argument):\n"
+        "        if argument:\n"
+        "            call(argument, [1, 2], {3: 4})\n"
+        "        return 1\n"
+        "x = 1\n"
+    )
+    expected = _rewrite.configure("--max-line", "40").format_source(source)
+    errors = []
+    for _ in range(3):
+        try:
+            visitor.format_source(
+                "def function(cls, base, state):\n"
+                "    if base:\n"
+                "        pass\n"
+                "    elif base.__init__ != object.__init__:\n"
+                "        pass\n"
+            )
+        except NoSolutionError as error:
+            errors.append(error)
+        assert visitor.format_source(source) == expected
+    assert len(errors) == 3
+    # Free the visitors of the failed files while the visitor is idle.
+    errors.clear()
+    assert visitor.format_source(source) == expected
+
+
+def test_line_ranges():
+    source = (
+        "import os\n"
+        "class A:\n"
+        "    def f(self,x):\n"
+        "        if x:\n"
+        "            y=[1,\n"
+        "               2]\n"
+        "        elif x>2:\n"
+        "            y  =  3\n"
+        "        return y\n"
+        "    def g(self): return  1\n"
+        "x  =  1;  y=2\n"
+    )
+    visitor = _rewrite.Rewrite()
+    # Only the statements in the lines change, the other lines are kept as is.
+    assert visitor.format_source(source, line_ranges=[(5, 5)]) == source.replace(
+        "y=[1,\n               2]", "y = [1, 2]"
+    )
+    assert _ranges.parse_line_ranges("8,11-11") == [(8, 8), (11, 11)]
+    assert visitor.format_source(
+        source, line_ranges=_ranges.parse_line_ranges("8,11-11")
+    ) == source.replace("y  =  3", "y = 3").replace("x  =  1;  y=2", "x = 1\ny = 2")
+    # An "elif" is formatted with its "if", and a body in the line of its header is
+    # formatted with the header.
+    assert visitor.format_source(source, line_ranges=[(7, 7), (10, 10)]) == (
+        "import os\n"
+        "class A:\n"
+        "    def f(self,x):\n"
+        "        if x:\n"
+        "            y = [1, 2]\n"
+        "        elif x > 2:\n"
+        "            y = 3\n"
+        "        return y\n"
+        "    def g(self):\n"
+        "        return 1\n"
+        "x  =  1;  y=2\n"
+    )
+    # Formatting all the lines is the same as formatting the whole code.
+    assert visitor.format_source(source, line_ranges=[(1, 11)]) == (
+        visitor.format_source(source)
+    )
+    # The formatted lines end as the other lines of the code do.
+    crlf_source = source.replace("\n", "\r\n")
+    assert visitor.format_source(crlf_source, line_ranges=[(7, 7)]) == (
+        source.replace("y=[1,\n               2]", "y = [1, 2]")
+        .replace("x>2", "x > 2")
+        .replace("y  =  3", "y = 3")
+        .replace("\n", "\r\n")
+    )
+    with pytest.raises(ValueError, match="invalid line range"):
+        _ranges.parse_line_ranges("40-10")
+
+
+def test_changed_since(tmp_path):
+    import shutil
+    import subprocess
+
+    if shutil.which("git") is None:
+        pytest.skip("git is not installed")
+
+    def git(*args):
+        subprocess.run(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@test", *args],
+            cwd=tmp_path,
+            check=True,
+            capture_output=True,
+        )
+
+    for name in ("same.py", "changed.py", "staged.py", "deleted.py", "notes.txt"):
+        (tmp_path / name).write_text("x = 1\n")
+    (tmp_path / ".gitignore").write_text("ignored.py\n")
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "initial")
+    (tmp_path / "changed.py").write_text("x  =  2\n")
+    (tmp_path / "staged.py").write_text("x  =  2\n")
+    git("add", "staged.py")
+    (tmp_path / "deleted.py").unlink()
+    (tmp_path / "notes.txt").write_text("changed\n")
+    (tmp_path / "ignored.py").write_text("x = 1\n")
+    (tmp_path / "new dir").mkdir()
+    (tmp_path / "new dir" / "untracked.py").write_text("x = 1\n")
+    files = _search.changed_since(str(tmp_path), "HEAD", _search.FileFilter([".py"]))
+    assert files == [
+        str(tmp_path / name)
+        for name in ("changed.py", "new dir/untracked.py", "staged.py")
+    ]
+    with pytest.raises(ValueError, match="git diff failed"):
+        _search.changed_since(str(tmp_path), "no-such-ref", _search.FileFilter([]))
+
+
+def test_walk(tmp_path):
+    for name in (
+        "a.py",
+        "notes.txt",
+        "pkg/b.py",
+        "pkg/b_pb2.py",
+        "pkg/stubs/c.pyi",
+        ".git/hooks/d.py",
+        "node_modules/e.py",
+        "venv/lib/f.py",
+        "build/g.py",
+        "src/build/h.py",
+    ):
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("x = 1\n")
+    # Symbolic links to directories are not followed, so a loop does not hang.
+    (tmp_path / "pkg" / "loop").symlink_to(tmp_path, target_is_directory=True)
+    file_filter = _search.FileFilter([".py"], ["*.pyi"], ["*_pb2.py", "/build/"])
+    files = _search.walk(str(tmp_path), file_filter)
+    assert not isinstance(files, list)
+    assert sorted(files) == [
+        str(tmp_path / name)
+        for name in ("a.py", "pkg/b.py", "pkg/stubs/c.pyi", "src/build/h.py")
+    ]
+
+
+def test_file_filter_brackets():
+    file_filter = _search.FileFilter([], ["[ab].py", "[!ab]_x.py", "[^ab]_y.py"])
+    assert file_filter.includes_path("pkg/a.py")
+    assert not file_filter.includes_path("c.py")
+    assert file_filter.includes_path("c_x.py")
+    assert not file_filter.includes_path("a_x.py")
+    # A leading "^" is one of the characters, as in fnmatch, and not a backslash.
+    assert file_filter.includes_path("^_y.py")
+    assert file_filter.includes_path("a_y.py")
+    assert not file_filter.includes_path("\\_y.py")
+    assert not file_filter.includes_path("c_y.py")
+
+
+def test_walk_concurrently(tmp_path):
+    for name in ("a.py", "pkg/b.py", "pkg/sub/c.py", "other/d.py", ".git/e.py"):
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("x = 1\n")
+    # The links are followed, but each directory is searched once.
+    (tmp_path / "pkg" / "loop").symlink_to(tmp_path, target_is_directory=True)
+    (tmp_path / "link").symlink_to(tmp_path / "other", target_is_directory=True)
+    files = list(
+        _search.walk_concurrently(str(tmp_path), _search.FileFilter([".py"]), 4)
+    )
+    assert len(files) == 4
+    assert sorted(os.path.realpath(path) for path in files) == [
+        str(tmp_path.resolve() / name)
+        for name in ("a.py", "other/d.py", "pkg/b.py", "pkg/sub/c.py")
+    ]
+
+
+def test_skip_policy(tmp_path, capsys):
+    contents = {
+        "a_ignored.py": "# Ignore file\nx  =  1\n",
+        "b_changed.py": "x  =  1\n",
+        "c_generated.py": "# @generated by a tool\nx  =  1\n",
+        "d_large.py": "x  =  1\n" * 2000,
+        "e_late_marker.py": "x  =  1\n" * 1000 + "# @generated\n",
+        "f_formatted.py": "x = 1\n",
+    }
+    for name, content in contents.items():
+        (tmp_path / name).write_text(content)
+    visitor = _rewrite.configure(
+        "--target-file", "", "-nc", "--generated-marker", "@generated"
+    )
+    visitor.max_file_size = 10000
+    visitor.files = sorted(str(tmp_path / name) for name in contents)
+    _rewrite.reformat(visitor)
+    # Note that the files next to skipped files are not skipped.
+    assert capsys.readouterr().out.splitlines()[-2:] == [
+        str(tmp_path / "b_changed.py"),
+        str(tmp_path / "e_late_marker.py"),
+    ]
+    # A file that is too large is not read at all.
+    skip_policy = _skip.SkipPolicy(max_size=10000)
+    with open(tmp_path / "d_large.py", "rb") as f:
+        assert skip_policy.read(f, os.fstat(f.fileno()).st_size) is None
+        assert f.tell() == 0
+
+
+def test_check_source():
+    visitor = _rewrite.configure("--max-line", "40")
+    for input_file in pathlib.Path(__file__).parent.glob("test_*/*.py"):
+        source = input_file.read_text()
+        try:
+            formatted = visitor.format_source(source)
+        except NoSolutionError:
+            continue
+        assert visitor.check_source(source) == (formatted != source)
+    # Code that is missing at the end of the formatted code is a difference too.
+    assert visitor.check_source("x = 1\n\n\n")
+    assert not visitor.check_source("x = 1\n")
+
+
+def test_fail_fast(tmp_path, capsys):
+    for i in range(4):
+        target_file = tmp_path / f"file_{i}.py"
+        target_file.write_text("x  =  1\n")
+        os.utime(target_file, ns=(i * 10**9, i * 10**9))
+    visitor = _rewrite.configure("--target-file", "", "-nc", "--fail-fast", "-c")
+    visitor.files = sorted(str(path) for path in tmp_path.iterdir())
+    with pytest.raises(SystemExit):
+        _rewrite.reformat(visitor)
+    # Only the most recently modified file was handled.
+    assert capsys.readouterr().out.splitlines()[-1] == str(tmp_path / "file_3.py")
+
+
+def test_deduplicate(tmp_path, monkeypatch, capsys):
+    for directory in ("a", "b", "c"):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "changed.py").write_text("x  =  1\n")
+        (tmp_path / directory / "formatted.py").write_text("x = 1\n")
+    # A changed file found after the copies of an earlier changed file.
+    (tmp_path / "c" / "new.py").write_text("y  =  2\n")
+    formatted_files = []
+    opened_files = []
+    format_source = _rewrite.Rewrite.format_source
+
+    def counting_format_source(formatter, source, filename, *args):
+        formatted_files.append(filename)
+        return format_source(formatter, source, filename, *args)
+
+    def counting_open(file, *args, **kwargs):
+        opened_files.append(file)
+        return open(file, *args, **kwargs)
+
+    monkeypatch.setattr(_rewrite.Rewrite, "format_source", counting_format_source)
+    monkeypatch.setattr(_rewrite, "open", counting_open, raising=False)
+    visitor = _rewrite.configure("--target-file", "", "-nc")
+    visitor.files = sorted(str(path) for path in tmp_path.glob("*/*.py"))
+    _rewrite.reformat(visitor)
+    # Each file was read once, each content was formatted once, and every changed
+    # file is listed.
+    assert opened_files == visitor.files
+    assert formatted_files == [
+        str(tmp_path / "a" / "changed.py"),
+        str(tmp_path / "a" / "formatted.py"),
+        str(tmp_path / "c" / "new.py"),
+    ]
+    output = capsys.readouterr().out.splitlines()
+    assert "7 file(s) found: 3 formatted, 4 with the same content" in output[0]
+    # The files are listed in the order they were found, whether they are copies.
+    assert output[-4:] == [
+        str(tmp_path / "a" / "changed.py"),
+        str(tmp_path / "b" / "changed.py"),
+        str(tmp_path / "c" / "changed.py"),
+        str(tmp_path / "c" / "new.py"),
+    ]
+
+
+def test_walk_concurrently_summary(tmp_path, capsys):
+    for i in range(6):
+        for name in ("changed.py", "sub/changed.py", "sub/sub/changed.py"):
+            target_file = tmp_path / f"pkg_{i}" / name
+            target_file.parent.mkdir(parents=True, exist_ok=True)
+            target_file.write_text(f"x  =  {i}\n")
+        (tmp_path / f"pkg_{i}" / "formatted.py").write_text("x = 1\n")
+    (tmp_path / "changed.py").write_text("y  =  2\n")
+    summaries = []
+    for search_args in ((), ("--search-threads", "4")):
+        _rewrite.rewrite("--directory", str(tmp_path), "-nc", *search_args)
+        summaries.append(capsys.readouterr().out.splitlines())
+    # The files found concurrently are listed in the order of the serial search.
+    assert summaries[0][-19:] == summaries[1][-19:]
+    assert summaries[0][-19:-16] == [
+        str(tmp_path / "changed.py"),
+        str(tmp_path / "pkg_0" / "changed.py"),
+        str(tmp_path / "pkg_0" / "sub" / "changed.py"),
+    ]
+
+
+def test_jobs_ahead():
+    # The files are taken a few jobs ahead of the results, not all at once.
+    taken = []
+
+    def files():
+        for i in range(100):
+            taken.append(i)
+            yield str(i)
+
+    visitor = _rewrite.configure("--threads", "2")
+    results = _rewrite.imap_files(visitor, lambda formatter, path: path, files())
+    assert next(results) == "0"
+    assert len(taken) <= _rewrite.JOBS_AHEAD * 2
+    assert list(results) == [str(i) for i in range(1, 100)]
+
+
+def test_serve_on_regular_file(tmp_path):
+    import _serve
+
+    # A path that is not a socket is never removed.
+    source_file = tmp_path / "main.py"
+    source_file.write_text("x = 1\n")
+    with pytest.raises(ValueError, match="not a socket"):
+        _serve._remove_stale_socket(str(source_file))
+    assert source_file.read_text() == "x = 1\n"
+
+
+def test_serve_removed_socket(tmp_path):
+    import threading
+    import time
+    import _serve
+
+    # The daemon stops cleanly if its socket was removed meanwhile.
+    socket_path = str(tmp_path / "formatter.sock")
+    server = _serve.Server(_rewrite.configure())
+    errors = []
+
+    def serve():
+        try:
+            _serve.asyncio.run(server.serve_forever(socket_path))
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+    os.unlink(socket_path)
+    server.stop()
+    thread.join()
+    assert errors == []
+
+
+def test_serve_skip_policy(tmp_path):
+    import _serve
+
+    # The daemon skips the files that a run of the formatter skips.
+    server = _serve.Server(
+        _rewrite.configure("--generated-marker", "@generated", "--max-file-size", "100")
+    )
+    contents = {
+        "ignored.py": "# Ignore file\nx  =  1\n",
+        "generated.py": "# @generated\nx  =  1\n",
+        "large.py": "x  =  1\n" * 20,
+    }
+    for name, content in contents.items():
+        target_file = tmp_path / name
+        target_file.write_text(content)
+        for command in _serve.COMMANDS:
+            message = {"command": command, "path": str(target_file)}
+            assert server.handle(message) == {"changed": False}
+        assert target_file.read_text() == content
+    server.executor.shutdown()
+
+
+def test_bounded_caches():
+    import _serve
+
+    # The formatters and the formatted digests of the configurations that were not
+    # used lately are dropped.
+    pool = _rewrite.FormatterPool(max_configs=2)
+    server = _serve.Server(_rewrite.configure())
+    for max_line in range(80, 90):
+        formatter = _rewrite.configure("--max-line", str(max_line))
+        pool.release(formatter)
+        server._formatted_digests(formatter.config()).add(max_line)
+    assert len(pool.idle) == 2
+    assert len(server.formatted_digests) == _serve.MAX_CONFIGS
+    assert server._formatted_digests(formatter.config()) == {89}
+    server.executor.shutdown()
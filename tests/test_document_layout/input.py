@@ -0,0 +1,22 @@
+import os
+
+
+def short(a, b=1, *args, c, **kwargs):
+    return a + b
+
+
+def configure(first_argument, second_argument=None, *, third_argument=True, **options):
+    settings = {"first": first_argument, "second": second_argument, "third": third_argument}
+    total = first_argument * 1000 + second_argument * 100 + third_argument * 10 + len(options)
+    if first_argument is not None and second_argument is not None and third_argument:
+        print(os.path.join(first_argument, second_argument), sorted(options, key=len), total)
+    return settings
+
+
+class Formatter(BaseFormatter, metaclass=FormatterMeta):
+    pass
+
+
+values = [first_value, second_value, (single,), {"key": "value"}, {value_one, value_two}]
+result = outer(middle(inner(argument_number_one, argument_number_two), argument_three), 4)
+this_name_is_too_long_to_fit_in_any_line_so_it_is_printed_as_it_is_without_any_error = 0